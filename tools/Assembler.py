@@ -1,14 +1,41 @@
+import argparse
+import os
 import re
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from collections.abc import Iterable, Iterator
+from functools import cache, partial
 from typing import Literal, TypedDict
 
-from utils import get_filepath_with_ext
+from buildcache import BuildCache, default_cache_dir, file_digest
+from hackrom import BYTEORDER, ROM_HEADER, pack_rom_image, write_rom_image
+from utils import find_filepaths, get_filepath_with_ext
+
+
+code_matcher = re.compile("^\\s*(?!/)(\\S+)")
+symbol_matcher = re.compile("^[@(]+(\\S+?)[)]*$")
+c_instruction_matcher = re.compile(
+    "^(?P<dest>[0ADM]+(?==))?=?(?P<comp>[!\\-+|&ADM01]+);?(?P<jump>(?<=;)[JMPGTEQLN]+)?$"
+)
 
 
 def read_file_lines(filepath: str) -> list[str]:
-    code_matcher = re.compile("^\\s*(?!/)(\\S+)", re.MULTILINE)
+    return list(iter_file_lines(filepath))
+
+
+def iter_file_lines(filepath: str) -> Iterator[str]:
     with open(filepath, "r") as f:
-        return code_matcher.findall(f.read())
+        yield from iter_code_lines(f)
+
+
+# instructions and labels without whitespace or comments
+def iter_code_lines(lines: Iterable[str]) -> Iterator[str]:
+    for line in lines:
+        code = code_matcher.match(line)
+        if code is not None:
+            yield code.group(1)
 
 
 A_INSTRUCTION = Literal["A"]
@@ -47,6 +74,13 @@ comp_codes = {
     "D&M": "1000000",
     "D|A": "0010101",
     "D|M": "1010101",
+    # commuted forms, e.g. M=M+D as emitted by VMTranslator
+    "A+D": "0000010",
+    "M+D": "1000010",
+    "A&D": "0000000",
+    "M&D": "1000000",
+    "A|D": "0010101",
+    "M|D": "1010101",
 }
 dest_codes = {
     None:  "000",
@@ -89,7 +123,6 @@ def instruction_type(line: str) -> INSTRUCTION_TYPE:
 
 
 def symb(line: str) -> str:
-    symbol_matcher = re.compile("^[@(]+(\\S+?)[)]*$")
     symbol = symbol_matcher.match(line)
     if symbol is None:
         raise ValueError(f"No symbol found for {line}")
@@ -121,10 +154,7 @@ class CInstructionParts(TypedDict):
 
 
 def parse_c_instruction(line: str) -> CInstructionParts:
-    matcher = re.compile(
-        "^(?P<dest>[0ADM]+(?==))?=?(?P<comp>[!\\-+|&ADM01]+);?(?P<jump>(?<=;)[JMPGTEQLN]+)?$"
-    )
-    matches = matcher.match(line)
+    matches = c_instruction_matcher.match(line)
     if matches is None:
         raise ValueError(f"No dest/comp/jump found for {line}")
     else:
@@ -135,64 +165,271 @@ def parse_c_instruction(line: str) -> CInstructionParts:
         }
 
 
-def main():
-    asmpath = sys.argv[1]
-    hackpath = get_filepath_with_ext(asmpath, "hack")
-    lines = read_file_lines(asmpath)
-
-    symbols = {
-        "R0": 0,
-        "R1": 1,
-        "R2": 2,
-        "R3": 3,
-        "R4": 4,
-        "R5": 5,
-        "R6": 6,
-        "R7": 7,
-        "R8": 8,
-        "R9": 9,
-        "R10": 10,
-        "R11": 11,
-        "R12": 12,
-        "R13": 13,
-        "R14": 14,
-        "R15": 15,
-        "SP": 0,
-        "LCL": 1,
-        "ARG": 2,
-        "THIS": 3,
-        "THAT": 4,
-        "SCREEN": 16384,
-        "KBD": 24576,
-    }
-    variable_ptr = 16
+@cache
+def encode_c_instruction(line: str) -> int:
+    parts = parse_c_instruction(line)
+    return int(
+        f"111{bin_comp(parts['comp'])}{bin_dest(parts['dest'])}{bin_jump(parts['jump'])}",
+        2,
+    )
+
+
+predefined_symbols = {
+    "R0": 0,
+    "R1": 1,
+    "R2": 2,
+    "R3": 3,
+    "R4": 4,
+    "R5": 5,
+    "R6": 6,
+    "R7": 7,
+    "R8": 8,
+    "R9": 9,
+    "R10": 10,
+    "R11": 11,
+    "R12": 12,
+    "R13": 13,
+    "R14": 14,
+    "R15": 15,
+    "SP": 0,
+    "LCL": 1,
+    "ARG": 2,
+    "THIS": 3,
+    "THAT": 4,
+    "SCREEN": 16384,
+    "KBD": 24576,
+}
+
+
+# Single pass: unknown symbols remember the ROM addresses referencing them
+# and are backpatched when their label shows up. Whatever is still unresolved
+# at the end is a variable, allocated from 16 in order of first use.
+def assemble(lines: Iterable[str]) -> array:
+    symbols = dict(predefined_symbols)
+    forward_refs: dict[str, list[int]] = {}
+    words = array("H")
 
-    ln = 0
     for l in lines:
-        type = instruction_type(l)
-        if type == "L":
-            symbols[symb(l)] = ln
+        if l[0] == "@":
+            symbol = l[1:]
+            address = symbols.get(symbol)
+            if address is None:
+                if symbol.isdigit():
+                    address = int(symbol)
+                    # the top bit would make it a C-instruction
+                    if address > 32767:
+                        raise ValueError(f"A-instruction value out of range: {symbol}")
+                    symbols[symbol] = address
+                else:
+                    forward_refs.setdefault(symbol, []).append(len(words))
+                    address = 0
+            words.append(address)
+        elif l[0] == "(":
+            label = symb(l)
+            ln = symbols[label] = len(words)
+            for ref in forward_refs.pop(label, ()):
+                words[ref] = ln
         else:
-            ln += 1
+            words.append(encode_c_instruction(l))
+
+    variable_ptr = 16
+    for refs in forward_refs.values():
+        for ref in refs:
+            words[ref] = variable_ptr
+        variable_ptr += 1
+
+    return words
+
+
+def format_hack(words: Iterable[int]) -> str:
+    return "".join(f"{word:016b}\n" for word in words)
+
 
+def write_hack(words: Iterable[int], hackpath: str):
     with open(hackpath, "w") as w:
-        for l in lines:
-            type = instruction_type(l)
-
-            if type == "A":
-                if symb(l) not in symbols:
-                    if symb(l).isdigit():
-                        symbols[symb(l)] = int(symb(l))
-                    else:
-                        symbols[symb(l)] = variable_ptr
-                        variable_ptr += 1
-                w.write(f"0{bin_symb(symbols[symb(l)])}\n")
-
-            if type == "C":
-                parts = parse_c_instruction(l)
-                w.write(
-                    f"111{bin_comp(parts['comp'])}{bin_dest(parts['dest'])}{bin_jump(parts['jump'])}\n"
-                )
+        w.writelines(f"{word:016b}\n" for word in words)
+
+
+# bump whenever the encoding of any output changes, to invalidate caches
+ASSEMBLER_VERSION = "1"
+
+
+class AssembleResult(TypedDict):
+    asmpath: str
+    outpath: str
+    words: int
+    seconds: float
+    cached: bool
+    error: str | None
+
+
+def _count_words(output: bytes, format: str) -> int:
+    if format == "rom":
+        return (len(output) - ROM_HEADER.size) // 2
+    return len(output) // 17
+
+
+def _write_if_changed(outpath: str, output: bytes):
+    try:
+        if os.path.getsize(outpath) == len(output):
+            with open(outpath, "rb") as f:
+                if f.read() == output:
+                    return
+    except FileNotFoundError:
+        pass
+    with open(outpath, "wb") as w:
+        w.write(output)
+
+
+def assemble_file(
+    asmpath: str,
+    format: str = "hack",
+    byteorder: BYTEORDER = "little",
+    cache: BuildCache | None = None,
+) -> AssembleResult:
+    start = time.perf_counter()
+    outpath = get_filepath_with_ext(asmpath, format)
+    cached = False
+    try:
+        if cache is None:
+            words = assemble(iter_file_lines(asmpath))
+            if format == "rom":
+                write_rom_image(words, outpath, byteorder)
+            else:
+                write_hack(words, outpath)
+            count = len(words)
+        else:
+            key = cache.key(ASSEMBLER_VERSION, format, byteorder, file_digest(asmpath))
+            output = cache.get(key)
+            cached = output is not None
+            if output is None:
+                words = assemble(iter_file_lines(asmpath))
+                if format == "rom":
+                    output = pack_rom_image(words, byteorder)
+                else:
+                    output = format_hack(words).encode()
+                cache.put(key, output)
+            _write_if_changed(outpath, output)
+            count = _count_words(output, format)
+    except (OSError, ValueError, KeyError) as e:
+        return {
+            "asmpath": asmpath,
+            "outpath": outpath,
+            "words": 0,
+            "seconds": time.perf_counter() - start,
+            "cached": cached,
+            "error": f"{type(e).__name__}: {e}",
+        }
+    return {
+        "asmpath": asmpath,
+        "outpath": outpath,
+        "words": count,
+        "seconds": time.perf_counter() - start,
+        "cached": cached,
+        "error": None,
+    }
+
+
+def assemble_files(
+    asmpaths: list[str],
+    format: str = "hack",
+    byteorder: BYTEORDER = "little",
+    jobs: int | None = None,
+    cache: BuildCache | None = None,
+) -> Iterator[AssembleResult]:
+    assemble_one = partial(
+        assemble_file, format=format, byteorder=byteorder, cache=cache
+    )
+    if jobs == 1 or len(asmpaths) < 2:
+        yield from map(assemble_one, asmpaths)
+        return
+    workers = jobs or os.cpu_count() or 1
+    chunksize = max(1, len(asmpaths) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(assemble_one, asmpaths, chunksize=chunksize)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hack assembler")
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        help=".asm files, directories (searched recursively) or globs",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["hack", "rom"],
+        default="hack",
+        help="text .hack output or a packed binary .rom image",
+    )
+    parser.add_argument(
+        "--byteorder",
+        choices=["little", "big"],
+        default="little",
+        help="byte order of the words in a .rom image",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of worker processes, defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir("assembler"),
+        help="where assembled outputs are cached by input content hash",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        help="cache size limit in MiB, least recently used outputs are evicted",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always assemble and write every output",
+    )
+    args = parser.parse_args()
+
+    cache = (
+        None
+        if args.no_cache
+        else BuildCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    )
+
+    asmpaths = find_filepaths(args.paths, "asm")
+    start = time.perf_counter()
+    total_words = 0
+    failed = 0
+    # counted from the results, the cache's own counters are in the workers
+    hits = misses = 0
+    results = assemble_files(asmpaths, args.format, args.byteorder, args.jobs, cache)
+    for result in results:
+        if result["error"]:
+            failed += 1
+            print(f"FAIL {result['asmpath']}: {result['error']}", file=sys.stderr)
+        else:
+            hits += result["cached"]
+            misses += not result["cached"]
+            total_words += result["words"]
+            print(
+                f"{result['outpath']}: {result['words']} words"
+                f" in {result['seconds'] * 1000:.1f} ms"
+                + (" (cached)" if result["cached"] else "")
+            )
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"Assembled {len(asmpaths) - failed}/{len(asmpaths)} files,"
+        f" {total_words} words in {elapsed:.2f} s"
+    )
+    if cache is not None:
+        evicted = cache.evict()
+        print(f"Cache: {hits} hits, {misses} misses, {evicted} evicted")
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
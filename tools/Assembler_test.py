@@ -1,4 +1,21 @@
-from Assembler import parse_c_instruction
+import os
+import shutil
+import sys
+
+import pytest
+import Assembler
+from Assembler import (
+    assemble,
+    assemble_files,
+    encode_c_instruction,
+    iter_file_lines,
+    parse_c_instruction,
+)
+from buildcache import BuildCache
+from hackrom import load_rom, read_hack_text
+from utils import find_filepaths
+
+projects_dir = os.path.join(os.path.dirname(__file__), "..", "projects")
 
 
 class TestParseCInstruction:
@@ -61,3 +78,98 @@ class TestParseCInstruction:
         input = "M=D+A"
         expected = {"dest": "M", "comp": "D+A", "jump": None}
         assert parse_c_instruction(input) == expected
+
+
+class TestAssemble:
+    def test_forward_references_and_variables(self):
+        lines = ["@i", "M=1", "@END", "0;JMP", "@j", "(END)", "@END", "0;JMP", "@i"]
+        assert list(assemble(lines)) == [
+            16,
+            0b1110111111001000,
+            5,
+            0b1110101010000111,
+            17,
+            5,
+            0b1110101010000111,
+            16,
+        ]
+
+    def test_commuted_comp(self):
+        assert encode_c_instruction("M=M+D") == encode_c_instruction("M=D+M")
+        assert encode_c_instruction("D=A&D") == encode_c_instruction("D=D&A")
+
+    def test_a_instruction_range(self):
+        assert list(assemble(["@32767"])) == [32767]
+        for value in ("32768", "40000", "70000"):
+            with pytest.raises(ValueError, match="out of range"):
+                assemble([f"@{value}"])
+
+    def test_matches_reference_hack(self):
+        for name in ["add/Add", "max/Max", "rect/RectL", "pong/Pong"]:
+            asmpath = os.path.join(projects_dir, "06", f"{name}.asm")
+            hackpath = os.path.join(projects_dir, "06", f"{name}.hack")
+            with open(hackpath) as f:
+                expected = [int(l, 2) for l in f.read().split()]
+            assert list(assemble(iter_file_lines(asmpath))) == expected
+
+
+class TestAssembleFiles:
+    def test_batch_directory(self, tmp_path):
+        shutil.copytree(os.path.join(projects_dir, "06"), tmp_path / "06")
+        asmpaths = find_filepaths([str(tmp_path / "06")], "asm")
+        assert len(asmpaths) == 7
+
+        results = list(assemble_files(asmpaths, jobs=2))
+        assert [r["asmpath"] for r in results] == asmpaths
+        for result in results:
+            assert result["error"] is None
+            with open(result["outpath"]) as f:
+                reference = result["asmpath"].replace(str(tmp_path), projects_dir)
+                with open(reference[:-3] + "hack") as g:
+                    assert f.read() == g.read()
+
+    def test_glob_filters_by_extension(self, tmp_path):
+        shutil.copytree(os.path.join(projects_dir, "06", "max"), tmp_path / "max")
+        asmpaths = find_filepaths([str(tmp_path / "max" / "*")], "asm")
+        assert [os.path.basename(path) for path in asmpaths] == [
+            "Max.asm",
+            "MaxL.asm",
+        ]
+
+    def test_batch_cached(self, tmp_path):
+        shutil.copytree(os.path.join(projects_dir, "06", "max"), tmp_path / "max")
+        asmpaths = find_filepaths([str(tmp_path / "max")], "asm")
+        cache = BuildCache(str(tmp_path / "cache"))
+
+        first = list(assemble_files(asmpaths, format="rom", jobs=1, cache=cache))
+        assert [r["cached"] for r in first] == [False, False]
+        os.remove(first[0]["outpath"])
+        second = list(assemble_files(asmpaths, format="rom", jobs=1, cache=cache))
+        assert [r["cached"] for r in second] == [True, True]
+        assert [r["words"] for r in second] == [16, 16]
+        assert list(load_rom(second[0]["outpath"])) == list(
+            read_hack_text(os.path.join(projects_dir, "06", "max", "Max.hack"))
+        )
+
+    def test_batch_reports_errors(self, tmp_path):
+        results = list(assemble_files([str(tmp_path / "Missing.asm")]))
+        assert results[0]["error"].startswith("FileNotFoundError")
+        (tmp_path / "Big.asm").write_text("@70000\n")
+        (tmp_path / "Ok.asm").write_text("@1\n")
+        results = list(
+            assemble_files([str(tmp_path / "Big.asm"), str(tmp_path / "Ok.asm")])
+        )
+        assert results[0]["error"].startswith("ValueError: A-instruction value")
+        assert results[1]["error"] is None
+
+
+def test_cli_cache_stats(tmp_path, monkeypatch, capsys):
+    (tmp_path / "Bad.asm").write_text("@70000\n")
+    (tmp_path / "Ok.asm").write_text("@1\n")
+    argv = ["Assembler.py", str(tmp_path), "--cache-dir", str(tmp_path / "cache")]
+    monkeypatch.setattr(sys, "argv", argv + ["-j", "2"])
+    for hits, misses in [(0, 1), (1, 0)]:
+        with pytest.raises(SystemExit):
+            Assembler.main()
+        # the failed file is neither a hit nor a miss
+        assert f"Cache: {hits} hits, {misses} misses" in capsys.readouterr().out
@@ -0,0 +1,390 @@
+import argparse
+import os
+from array import array
+from collections.abc import Callable, Iterable, Sequence
+from functools import cache
+
+from Assembler import assemble, iter_file_lines
+from hackrom import load_rom
+
+RAM_SIZE = 32768
+ROM_SIZE = 32768
+
+
+def to_word(value: int) -> int:
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+# ALU by the 6 c-bits of a C-instruction, over D and the A/M operand.
+# Values are signed 16 bit ints, & | ! never leave that range so only
+# arithmetic needs wrapping.
+# fmt: off
+alu_ops: dict[int, Callable[[int, int], int]] = {
+    0b101010: lambda d, y: 0,
+    0b111111: lambda d, y: 1,
+    0b111010: lambda d, y: -1,
+    0b001100: lambda d, y: d,
+    0b110000: lambda d, y: y,
+    0b001101: lambda d, y: ~d,
+    0b110001: lambda d, y: ~y,
+    0b001111: lambda d, y: to_word(-d),
+    0b110011: lambda d, y: to_word(-y),
+    0b011111: lambda d, y: to_word(d + 1),
+    0b110111: lambda d, y: to_word(y + 1),
+    0b001110: lambda d, y: to_word(d - 1),
+    0b110010: lambda d, y: to_word(y - 1),
+    0b000010: lambda d, y: to_word(d + y),
+    0b010011: lambda d, y: to_word(d - y),
+    0b000111: lambda d, y: to_word(y - d),
+    0b000000: lambda d, y: d & y,
+    0b010101: lambda d, y: d | y,
+}
+# fmt: on
+
+
+# Jump decisions by the 3 j-bits, indexed by the sign of the ALU output:
+# [0] out == 0, [1] out > 0, [-1] out < 0
+jump_tables = tuple(
+    (bool(jump & 0b010), bool(jump & 0b001), bool(jump & 0b100)) for jump in range(8)
+)
+
+
+def alu_generic(c: int) -> Callable[[int, int], int]:
+    # unofficial comp bits, computed the way the ALU chip would
+    zx, nx, zy, ny, f, no = ((c >> bit) & 1 for bit in range(5, -1, -1))
+
+    def op(d: int, y: int) -> int:
+        x = 0 if zx else d
+        x = ~x if nx else x
+        y = 0 if zy else y
+        y = ~y if ny else y
+        out = to_word(x + y) if f else x & y
+        return ~out if no else out
+
+    return op
+
+
+def _wrap(expr: str, offset: int = 0) -> str:
+    return f"(({expr} + {32768 + offset}) & 65535) - 32768"
+
+
+# Python expressions for alu_ops, used when compiling basic blocks
+# fmt: off
+alu_exprs: dict[int, str] = {
+    0b101010: "0",
+    0b111111: "1",
+    0b111010: "-1",
+    0b001100: "d",
+    0b110000: "y",
+    0b001101: "~d",
+    0b110001: "~y",
+    0b001111: _wrap("-d"),
+    0b110011: _wrap("-y"),
+    0b011111: _wrap("d", 1),
+    0b110111: _wrap("y", 1),
+    0b001110: _wrap("d", -1),
+    0b110010: _wrap("y", -1),
+    0b000010: _wrap("d + y"),
+    0b010011: _wrap("d - y"),
+    0b000111: _wrap("y - d"),
+    0b000000: "d & y",
+    0b010101: "d | y",
+}
+jump_exprs = {
+    0b001: "o > 0",
+    0b010: "o == 0",
+    0b011: "o >= 0",
+    0b100: "o < 0",
+    0b101: "o != 0",
+    0b110: "o <= 0",
+}
+# fmt: on
+
+MAX_BLOCK_LENGTH = 256
+
+# A compiled block takes (ram, a, d, cycle budget) and returns
+# (a, d, next pc, cycles executed)
+Block = Callable[[array, int, int, int], tuple[int, int, int, int]]
+
+
+# A-instruction: (None, value, 0, None)
+# C-instruction: (alu op, uses M, dest bits, jump table or None)
+DecodedInstruction = tuple[Callable[[int, int], int] | None, int, int, tuple | None]
+
+
+@cache
+def decode(word: int) -> DecodedInstruction:
+    if not word & 0x8000:
+        return (None, word, 0, None)
+    c = (word >> 6) & 0b111111
+    jump = word & 0b111
+    return (
+        alu_ops.get(c) or alu_generic(c),
+        (word >> 12) & 1,
+        (word >> 3) & 0b111,
+        jump_tables[jump] if jump else None,
+    )
+
+
+# "(END) @END 0;JMP" style loops have no effect other than spinning
+def find_halt_pcs(rom: Sequence[int]) -> set[int]:
+    return {
+        pc
+        for pc in range(1, len(rom))
+        if rom[pc] == 0b1110101010000111 and rom[pc - 1] == pc - 1
+    }
+
+
+class HackCPU:
+    def __init__(self, rom: Iterable[int], jit: bool = False):
+        self.jit = jit
+        self.rom = array("H", rom)
+        if len(self.rom) > ROM_SIZE:
+            raise ValueError(f"Program of {len(self.rom)} words does not fit ROM")
+        self.ram = array("h", bytes(2 * RAM_SIZE))
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+        # empty ROM words are @0, like the rest of the 32K ROM
+        self.program = [decode(word) for word in self.rom]
+        self.program += [decode(0)] * (ROM_SIZE - len(self.program))
+
+        self.halt_pcs = find_halt_pcs(self.rom)
+        # compiled blocks by start pc, None until compiled and False where
+        # there is nothing to compile
+        self.blocks: list[tuple[Block, int] | bool | None] = [None] * ROM_SIZE
+
+    @classmethod
+    def from_file(cls, path: str, jit: bool = False) -> "HackCPU":
+        if os.path.splitext(path)[1] == ".asm":
+            return cls(assemble(iter_file_lines(path)), jit)
+        return cls(load_rom(path), jit)
+
+    def reset(self):
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+    def step(self):
+        self._interpret(1)
+
+    # Runs until max_cycles instructions have executed or the program halts,
+    # returns the number of instructions executed.
+    def run(self, max_cycles: int | None = None) -> int:
+        if self.jit:
+            return self._run_blocks(max_cycles)
+        return self._interpret(max_cycles)
+
+    def _interpret(self, max_cycles: int | None = None) -> int:
+        program = self.program
+        ram = self.ram
+        halt_pcs = self.halt_pcs
+        a, d, pc = self.a, self.d, self.pc
+        start = self.cycles
+        limit = start + max_cycles if max_cycles is not None else -1
+        cycles = start
+
+        while cycles != limit:
+            op, value, dest, jump = program[pc]
+            cycles += 1
+            if op is None:
+                a = value
+                pc += 1
+                continue
+
+            out = op(d, ram[a] if value else a)
+            if dest:
+                if dest & 0b001:
+                    ram[a] = out
+                if dest & 0b010:
+                    d = out
+                if dest & 0b100:
+                    a = out
+            if jump is not None and jump[(out > 0) - (out < 0)]:
+                if pc in halt_pcs:
+                    self.halted = True
+                    pc = a & 0x7FFF
+                    break
+                pc = a & 0x7FFF
+            else:
+                pc += 1
+
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles = cycles
+        return cycles - start
+
+    # Compiles the code reachable from start without dynamic jumps into a
+    # Python function. Conditional jumps leave the block early, unconditional
+    # jumps to a known address are followed, and a jump back to start loops
+    # inside the function while the cycle budget allows. Blocks are keyed by
+    # their start pc, so jumping into the middle of one compiles an
+    # overlapping block. Halt loops and code past the end of the program are
+    # left to the interpreter.
+    def _compile_block(self, start: int) -> tuple[Block, int] | None:
+        end = len(self.rom)
+        body: list[str] = []
+        visited: set[int] = set()
+        loops = False
+        closed = False
+        a_const: int | None = None
+        pc = start
+        count = 0
+
+        def leave(target_pc: int | None, indent: str):
+            nonlocal loops
+            if a_const is not None:
+                body.append(f"{indent}a = {a_const}")
+            target = "a & 32767" if target_pc is None else str(target_pc)
+            if target_pc == start:
+                loops = True
+                body.append(f"{indent}n += {count}")
+                body.append(f"{indent}if n + LENGTH <= budget:")
+                body.append(f"{indent}    continue")
+                body.append(f"{indent}return a, d, {target}, n")
+            else:
+                body.append(f"{indent}return a, d, {target}, n + {count}")
+
+        while count < MAX_BLOCK_LENGTH:
+            if (
+                pc >= end
+                or pc in visited
+                or pc in self.halt_pcs
+                or pc + 1 in self.halt_pcs
+            ):
+                break
+            visited.add(pc)
+            word = self.rom[pc]
+            pc += 1
+            count += 1
+            if not word & 0x8000:
+                # the register is only written out where something reads it
+                a_const = word
+                continue
+
+            a_expr = "a" if a_const is None else str(a_const)
+            uses_m = (word >> 12) & 1
+            c = (word >> 6) & 0b111111
+            dest = (word >> 3) & 0b111
+            jump = word & 0b111
+
+            y = f"ram[{a_expr}]" if uses_m else a_expr
+            if c in alu_exprs:
+                expr = alu_exprs[c].replace("y", y)
+            else:
+                expr = f"alu[{c}](d, {y})"
+
+            # chained assignment runs left to right, so M is written through
+            # the old A before A itself is assigned
+            targets = []
+            if dest & 0b001:
+                targets.append(f"ram[{a_expr}]")
+            if dest & 0b010:
+                targets.append("d")
+            if dest & 0b100:
+                targets.append("a")
+                a_const = None
+
+            if jump:
+                target_pc = None if a_const is None else a_const & 0x7FFF
+                if jump == 0b111:
+                    if targets:
+                        body.append(f"{' = '.join(targets)} = {expr}")
+                    if target_pc is not None and target_pc != start:
+                        pc = target_pc
+                        continue
+                    leave(target_pc, "")
+                    closed = True
+                    break
+                body.append(f"{' = '.join(targets + ['o'])} = {expr}")
+                body.append(f"if {jump_exprs[jump]}:")
+                leave(target_pc, "    ")
+            elif targets:
+                body.append(f"{' = '.join(targets)} = {expr}")
+
+        if count == 0:
+            return None
+        if not closed:
+            leave(pc, "")
+        indent = "        " if loops else "    "
+        lines = ["def block(ram, a, d, budget):", "    n = 0"]
+        if loops:
+            lines.append("    while True:")
+        lines += [indent + line for line in body]
+
+        namespace = {
+            "alu": {c: alu_generic(c) for c in range(64)},
+            "LENGTH": count,
+        }
+        exec(compile("\n".join(lines), f"<block {start}>", "exec"), namespace)
+        return namespace["block"], count
+
+    def _run_blocks(self, max_cycles: int | None = None) -> int:
+        blocks = self.blocks
+        ram = self.ram
+        a, d, pc = self.a, self.d, self.pc
+        start = self.cycles
+        limit = start + max_cycles if max_cycles is not None else None
+        cycles = start
+        unlimited = ROM_SIZE * 1_000_000
+
+        while not self.halted and cycles != limit:
+            compiled = blocks[pc]
+            if compiled is None:
+                compiled = blocks[pc] = self._compile_block(pc) or False
+            budget = unlimited if limit is None else limit - cycles
+            if not compiled or compiled[1] > budget:
+                # not compilable, or the block could overrun the cycle budget
+                self.a, self.d, self.pc, self.cycles = a, d, pc, cycles
+                self._interpret(1)
+                a, d, pc, cycles = self.a, self.d, self.pc, self.cycles
+                continue
+            a, d, pc, n = compiled[0](ram, a, d, budget)
+            cycles += n
+
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles = cycles
+        return cycles - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless Hack CPU emulator")
+    parser.add_argument("path", help=".asm, .hack or .rom program")
+    parser.add_argument("--max-cycles", type=int, default=10_000_000)
+    parser.add_argument(
+        "--jit",
+        action="store_true",
+        help="run compiled basic blocks instead of interpreting instructions",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="ADDRESS=VALUE",
+        help="initial RAM contents, e.g. --set 0=3",
+    )
+    parser.add_argument(
+        "--dump",
+        default="0:16",
+        metavar="START:END",
+        help="RAM range printed after running",
+    )
+    args = parser.parse_args()
+
+    cpu = HackCPU.from_file(args.path, args.jit)
+    for assignment in args.set:
+        address, value = assignment.split("=")
+        cpu.ram[int(address)] = to_word(int(value))
+    cpu.run(args.max_cycles)
+
+    state = "halted" if cpu.halted else "stopped"
+    print(f"{state} after {cpu.cycles} cycles at PC={cpu.pc} A={cpu.a} D={cpu.d}")
+    start, end = (int(i) for i in args.dump.split(":"))
+    for address in range(start, end):
+        print(f"RAM[{address}] = {cpu.ram[address]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+from CPUEmulator import HackCPU, alu_generic, alu_ops
+
+projects_dir = os.path.join(os.path.dirname(__file__), "..", "projects")
+
+
+class TestHackCPU:
+    @pytest.mark.parametrize("jit", [False, True])
+    def test_mult(self, jit):
+        cpu = HackCPU.from_file(
+            os.path.join(projects_dir, "04", "mult", "Mult.asm"), jit
+        )
+        for r0, r1 in [(0, 0), (3, 1), (6, 7), (-2, 3)]:
+            cpu.reset()
+            cpu.ram[0], cpu.ram[1], cpu.ram[2] = r0, r1, -1
+            cpu.run(10_000)
+            assert cpu.halted
+            assert cpu.ram[2] == (r0 * r1 if r0 >= 0 else 0)
+
+    def test_max_hack(self):
+        cpu = HackCPU.from_file(os.path.join(projects_dir, "06", "max", "Max.hack"))
+        cpu.ram[0], cpu.ram[1] = -5, -30000
+        cpu.run(100)
+        assert cpu.halted
+        assert cpu.ram[2] == -5
+
+    @pytest.mark.parametrize("jit", [False, True])
+    def test_max_cycles(self, jit):
+        cpu = HackCPU.from_file(
+            os.path.join(projects_dir, "04", "fill", "Fill.asm"), jit
+        )
+        assert cpu.run(1000) == 1000
+        assert cpu.run(234) == 234
+        assert cpu.cycles == 1234
+        assert not cpu.halted
+
+    def test_arithmetic_wraps(self):
+        # D = 32767 + 1, M[0] = -D
+        cpu = HackCPU(
+            [32767, 0b1110110000010000, 0b1110011111010000, 0, 0b1110001111001000]
+        )
+        cpu.run(5)
+        assert cpu.d == -32768
+        assert cpu.ram[0] == -32768
+
+    def test_alu_table_matches_chip(self):
+        for c, op in alu_ops.items():
+            for d, y in [(0, 0), (5, -3), (-32768, 32767), (12345, 12345)]:
+                assert op(d, y) == alu_generic(c)(d, y), bin(c)
+
+    def test_jit_matches_interpreter(self):
+        pong = os.path.join(projects_dir, "06", "pong", "Pong.hack")
+        interpreted = HackCPU.from_file(pong)
+        compiled = HackCPU.from_file(pong, jit=True)
+        for cycles in [1, 1000, 12345, 200_000]:
+            interpreted.run(cycles)
+            compiled.run(cycles)
+            assert compiled.cycles == interpreted.cycles
+            assert (compiled.a, compiled.d, compiled.pc) == (
+                interpreted.a,
+                interpreted.d,
+                interpreted.pc,
+            )
+            assert compiled.ram == interpreted.ram
@@ -0,0 +1,1087 @@
+import argparse
+import os
+import pickle
+import re
+import sys
+import time
+from array import array
+from collections.abc import Callable
+from typing import NamedTuple, TypedDict
+
+from buildcache import BuildCache, default_cache_dir, file_digest
+from CPUEmulator import to_word
+from hackrom import load_rom
+
+# bump whenever flattening or the netlist format changes, to invalidate caches
+HARDWARE_SIMULATOR_VERSION = "2"
+
+builtin_chips_dir = os.path.join(os.path.dirname(__file__), "builtInChips")
+
+
+class PinRef(NamedTuple):
+    name: str
+    start: int | None
+    end: int | None
+
+
+class Part(NamedTuple):
+    name: str
+    connections: list[tuple[PinRef, PinRef]]
+
+
+class ChipDef(TypedDict):
+    name: str
+    path: str
+    inputs: dict[str, int]
+    outputs: dict[str, int]
+    parts: list[Part]
+    builtin: str | None
+    clocked: list[str]
+
+
+comment_matcher = re.compile(r"//[^\n]*|/\*.*?\*/", re.DOTALL)
+token_matcher = re.compile(r"\.\.|[A-Za-z_][\w.]*|\d+|[{}()\[\],;=:]")
+
+
+def tokenize(hdl: str) -> list[str]:
+    return token_matcher.findall(comment_matcher.sub(" ", hdl))
+
+
+class HdlParser:
+    def __init__(self, hdl: str, path: str):
+        self.tokens = tokenize(hdl)
+        self.position = 0
+        self.path = path
+
+    def peek(self) -> str | None:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self) -> str:
+        token = self.peek()
+        if token is None:
+            raise ValueError(f"Unexpected end of {self.path}")
+        self.position += 1
+        return token
+
+    def expect(self, expected: str):
+        token = self.next()
+        if token != expected:
+            raise ValueError(f"Expected '{expected}' but got '{token}' in {self.path}")
+
+    def parse(self) -> ChipDef:
+        self.expect("CHIP")
+        chip: ChipDef = {
+            "name": self.next(),
+            "path": self.path,
+            "inputs": {},
+            "outputs": {},
+            "parts": [],
+            "builtin": None,
+            "clocked": [],
+        }
+        self.expect("{")
+        while (token := self.next()) != "}":
+            if token == "IN":
+                chip["inputs"] = self.parse_pin_declarations()
+            elif token == "OUT":
+                chip["outputs"] = self.parse_pin_declarations()
+            elif token == "PARTS":
+                self.expect(":")
+                while self.peek() != "}":
+                    chip["parts"].append(self.parse_part())
+            elif token == "BUILTIN":
+                chip["builtin"] = self.next()
+                self.expect(";")
+            elif token == "CLOCKED":
+                chip["clocked"] = list(self.parse_pin_declarations())
+            else:
+                raise ValueError(f"Unexpected '{token}' in {self.path}")
+        return chip
+
+    def parse_pin_declarations(self) -> dict[str, int]:
+        pins = {}
+        while True:
+            name = self.next()
+            width = 1
+            if self.peek() == "[":
+                self.next()
+                width = int(self.next())
+                self.expect("]")
+            pins[name] = width
+            if self.next() == ";":
+                return pins
+
+    def parse_pin_ref(self) -> PinRef:
+        name = self.next()
+        if self.peek() != "[":
+            return PinRef(name, None, None)
+        self.next()
+        start = end = int(self.next())
+        if self.peek() == "..":
+            self.next()
+            end = int(self.next())
+        self.expect("]")
+        return PinRef(name, start, end)
+
+    def parse_part(self) -> Part:
+        name = self.next()
+        self.expect("(")
+        connections = []
+        while True:
+            pin = self.parse_pin_ref()
+            self.expect("=")
+            connections.append((pin, self.parse_pin_ref()))
+            if self.next() == ")":
+                break
+        self.expect(";")
+        return Part(name, connections)
+
+
+def parse_hdl(hdl: str, path: str = "<hdl>") -> ChipDef:
+    return HdlParser(hdl, path).parse()
+
+
+# Finds chip definitions: HDL next to the chip being simulated first,
+# then the builtin chips.
+class ChipLibrary:
+    def __init__(self, dirs: list[str]):
+        self.dirs = dirs + [builtin_chips_dir]
+        self.chips: dict[str, ChipDef] = {}
+
+    def resolve(self, name: str) -> ChipDef:
+        if name not in self.chips:
+            for dirpath in self.dirs:
+                hdlpath = os.path.join(dirpath, f"{name}.hdl")
+                if os.path.isfile(hdlpath):
+                    self.chips[name] = self.load(hdlpath)
+                    break
+            else:
+                raise ValueError(f"Chip {name} not found")
+        return self.chips[name]
+
+    def load(self, hdlpath: str) -> ChipDef:
+        # some course files have stray non UTF-8 bytes in comments
+        with open(hdlpath, "r", errors="replace") as f:
+            chip = parse_hdl(f.read(), hdlpath)
+        if chip["builtin"] is None and not chip["parts"]:
+            # unimplemented project stubs fall back to the builtin chip
+            builtin_path = os.path.join(builtin_chips_dir, f"{chip['name']}.hdl")
+            if os.path.isfile(builtin_path) and builtin_path != hdlpath:
+                return self.load(builtin_path)
+        return chip
+
+    def dependencies(self, chip: ChipDef) -> list[ChipDef]:
+        seen = {chip["name"]: chip}
+        stack = [chip]
+        while stack:
+            for part in stack.pop()["parts"]:
+                if part.name not in seen:
+                    seen[part.name] = self.resolve(part.name)
+                    stack.append(seen[part.name])
+        return list(seen.values())
+
+
+FALSE = 0
+TRUE = 1
+
+# gate kinds, ops are (kind, out, *inputs)
+NAND = 0
+AND = 1
+OR = 2
+XOR = 3
+NOT = 4
+MUX = 5  # (MUX, out, a, b, sel)
+# memory reads, the address is a single wire holding an int
+ADDRESS = 6  # (ADDRESS, out, *address bits)
+READ = 7  # (READ, out, address, memory index, bit)
+
+# state groups, each top level part of the chip is one
+INPUTS = -1
+
+
+class MemoryDef(TypedDict):
+    name: str
+    size: int
+    group: int
+    address: int
+    # no in wires for read only memories
+    input: list[int]
+    load: int
+
+
+class Netlist(TypedDict):
+    name: str
+    wire_count: int
+    inputs: dict[str, list[int]]
+    outputs: dict[str, list[int]]
+    # topologically sorted
+    ops: list[tuple[int, ...]]
+    # (in, out), out holds the state
+    dffs: list[tuple[int, int]]
+    dff_groups: list[int]
+    memories: list[MemoryDef]
+    # state of builtin registers by part name, for probes like ARegister[]
+    registers: dict[str, list[int]]
+
+
+class NetlistBuilder:
+    def __init__(self):
+        self.wire_count = 2
+        self.ops: list[tuple[int, ...]] = []
+        self.dffs: list[tuple[int, int]] = []
+        self.dff_groups: list[int] = []
+        self.memories: list[MemoryDef] = []
+        self.group = 0
+        self.aliases: dict[int, int] = {}
+        self.registers: dict[str, list[int]] = {}
+
+    def wire(self) -> int:
+        self.wire_count += 1
+        return self.wire_count - 1
+
+    def wires(self, width: int) -> list[int]:
+        return [self.wire() for _ in range(width)]
+
+    def gate(self, kind: int, *inputs: int) -> int:
+        out = self.wire()
+        self.ops.append((kind, out, *inputs))
+        return out
+
+    def nand(self, a: int, b: int) -> int:
+        return self.gate(NAND, a, b)
+
+    def and_(self, a: int, b: int) -> int:
+        return self.gate(AND, a, b)
+
+    def or_(self, a: int, b: int) -> int:
+        return self.gate(OR, a, b)
+
+    def xor(self, a: int, b: int) -> int:
+        return self.gate(XOR, a, b)
+
+    def not_(self, a: int) -> int:
+        return self.gate(NOT, a)
+
+    def mux(self, a: int, b: int, sel: int) -> int:
+        return self.gate(MUX, a, b, sel)
+
+    def dff(self, in_wire: int) -> int:
+        out = self.wire()
+        self.dffs.append((in_wire, out))
+        self.dff_groups.append(self.group)
+        return out
+
+    # returns the out wires, reading the word at address
+    def memory(
+        self, name: str, size: int, address: list[int], input: list[int], load: int
+    ) -> list[int]:
+        index = len(self.memories)
+        address_wire = self.gate(ADDRESS, *address)
+        self.memories.append(
+            {
+                "name": name,
+                "size": size,
+                "group": self.group,
+                "address": address_wire,
+                "input": input,
+                "load": load,
+            }
+        )
+        return [self.gate(READ, address_wire, index, bit) for bit in range(16)]
+
+    # placeholder wires stand for signals used before the part driving them
+    def alias(self, placeholder: int, source: int):
+        if placeholder in self.aliases:
+            raise ValueError("Signal driven by more than one part output")
+        self.aliases[placeholder] = source
+
+    def probe(self, name: str, wires: list[int]):
+        self.registers.setdefault(name, wires)
+
+
+Pins = dict[str, list[int]]
+BuiltinChip = Callable[[NetlistBuilder, Pins], Pins]
+
+
+def _mux16(b: NetlistBuilder, x: list[int], y: list[int], sel: int) -> list[int]:
+    return [b.mux(i, j, sel) for i, j in zip(x, y)]
+
+
+def _add(b: NetlistBuilder, x: list[int], y: list[int], carry: int) -> list[int]:
+    out = []
+    for i, j in zip(x, y):
+        partial = b.xor(i, j)
+        out.append(b.xor(partial, carry))
+        carry = b.or_(b.and_(i, j), b.and_(partial, carry))
+    return out
+
+
+def _full_adder(b: NetlistBuilder, x: int, y: int, c: int) -> Pins:
+    partial = b.xor(x, y)
+    carry = b.or_(b.and_(x, y), b.and_(partial, c))
+    return {"sum": [b.xor(partial, c)], "carry": [carry]}
+
+
+def _or_all(b: NetlistBuilder, bits: list[int]) -> int:
+    while len(bits) > 1:
+        bits = [
+            b.or_(*bits[i : i + 2]) if i + 1 < len(bits) else bits[i]
+            for i in range(0, len(bits), 2)
+        ]
+    return bits[0]
+
+
+def _register(name: str, width: int) -> BuiltinChip:
+    def register(b: NetlistBuilder, pins: Pins) -> Pins:
+        state = b.wires(width)
+        out = []
+        for bit, placeholder in zip(pins["in"], state):
+            out.append(b.dff(b.mux(placeholder, bit, pins["load"][0])))
+            b.alias(placeholder, out[-1])
+        b.probe(name, out)
+        return {"out": out}
+
+    return register
+
+
+def _pc(b: NetlistBuilder, pins: Pins) -> Pins:
+    state = b.wires(16)
+    incremented = _add(b, state, [FALSE] * 16, TRUE)
+    next_value = _mux16(b, state, incremented, pins["inc"][0])
+    next_value = _mux16(b, next_value, pins["in"], pins["load"][0])
+    next_value = _mux16(b, next_value, [FALSE] * 16, pins["reset"][0])
+    out = [b.dff(bit) for bit in next_value]
+    for placeholder, bit in zip(state, out):
+        b.alias(placeholder, bit)
+    b.probe("PC", out)
+    return {"out": out}
+
+
+def _memory(name: str, size: int, writable: bool = True) -> BuiltinChip:
+    def memory(b: NetlistBuilder, pins: Pins) -> Pins:
+        address = pins.get("address", [])
+        if not writable:
+            return {"out": b.memory(name, size, address, [], FALSE)}
+        return {"out": b.memory(name, size, address, pins["in"], pins["load"][0])}
+
+    return memory
+
+
+def _alu(b: NetlistBuilder, pins: Pins) -> Pins:
+    x = _mux16(b, pins["x"], [FALSE] * 16, pins["zx"][0])
+    x = [b.xor(bit, pins["nx"][0]) for bit in x]
+    y = _mux16(b, pins["y"], [FALSE] * 16, pins["zy"][0])
+    y = [b.xor(bit, pins["ny"][0]) for bit in y]
+    out = _mux16(
+        b, [b.and_(i, j) for i, j in zip(x, y)], _add(b, x, y, FALSE), pins["f"][0]
+    )
+    out = [b.xor(bit, pins["no"][0]) for bit in out]
+    return {"out": out, "zr": [b.not_(_or_all(b, out))], "ng": [out[15]]}
+
+
+def _dmux(b: NetlistBuilder, bit: int, sel: list[int]) -> list[int]:
+    outs = [bit]
+    for s in reversed(sel):
+        # each select bit splits every output in two, most significant first
+        outs = [o for out in outs for o in (b.and_(out, b.not_(s)), b.and_(out, s))]
+    return outs
+
+
+def _mux_way(b: NetlistBuilder, inputs: list[list[int]], sel: list[int]) -> list[int]:
+    for s in sel:
+        inputs = [
+            _mux16(b, inputs[i], inputs[i + 1], s) for i in range(0, len(inputs), 2)
+        ]
+    return inputs[0]
+
+
+# fmt: off
+builtin_chips: dict[str, BuiltinChip] = {
+    "Nand": lambda b, p: {"out": [b.nand(p["a"][0], p["b"][0])]},
+    "Not": lambda b, p: {"out": [b.not_(p["in"][0])]},
+    "And": lambda b, p: {"out": [b.and_(p["a"][0], p["b"][0])]},
+    "Or": lambda b, p: {"out": [b.or_(p["a"][0], p["b"][0])]},
+    "Xor": lambda b, p: {"out": [b.xor(p["a"][0], p["b"][0])]},
+    "Mux": lambda b, p: {"out": [b.mux(p["a"][0], p["b"][0], p["sel"][0])]},
+    "DMux": lambda b, p: dict(zip("ab", ([o] for o in _dmux(b, p["in"][0], p["sel"])))),
+    "Not16": lambda b, p: {"out": [b.not_(i) for i in p["in"]]},
+    "And16": lambda b, p: {"out": [b.and_(i, j) for i, j in zip(p["a"], p["b"])]},
+    "Or16": lambda b, p: {"out": [b.or_(i, j) for i, j in zip(p["a"], p["b"])]},
+    "Mux16": lambda b, p: {"out": _mux16(b, p["a"], p["b"], p["sel"][0])},
+    "Or8Way": lambda b, p: {"out": [_or_all(b, p["in"])]},
+    "Mux4Way16": lambda b, p: {"out": _mux_way(b, [p[x] for x in "abcd"], p["sel"])},
+    "Mux8Way16": lambda b, p: {"out": _mux_way(b, [p[x] for x in "abcdefgh"], p["sel"])},
+    "DMux4Way": lambda b, p: dict(zip("abcd", ([o] for o in _dmux(b, p["in"][0], p["sel"])))),
+    "DMux8Way": lambda b, p: dict(zip("abcdefgh", ([o] for o in _dmux(b, p["in"][0], p["sel"])))),
+    "HalfAdder": lambda b, p: {"sum": [b.xor(p["a"][0], p["b"][0])], "carry": [b.and_(p["a"][0], p["b"][0])]},
+    "FullAdder": lambda b, p: _full_adder(b, p["a"][0], p["b"][0], p["c"][0]),
+    "Add16": lambda b, p: {"out": _add(b, p["a"], p["b"], FALSE)},
+    "Inc16": lambda b, p: {"out": _add(b, p["in"], [FALSE] * 16, TRUE)},
+    "ALU": _alu,
+    "DFF": lambda b, p: {"out": [b.dff(p["in"][0])]},
+    "Bit": _register("Bit", 1),
+    "Register": _register("Register", 16),
+    "ARegister": _register("ARegister", 16),
+    "DRegister": _register("DRegister", 16),
+    "PC": _pc,
+    "RAM8": _memory("RAM8", 8),
+    "RAM64": _memory("RAM64", 64),
+    "RAM512": _memory("RAM512", 512),
+    "RAM4K": _memory("RAM4K", 4096),
+    "RAM16K": _memory("RAM16K", 16384),
+    "Screen": _memory("Screen", 8192),
+    "Keyboard": _memory("Keyboard", 1, writable=False),
+    "ROM32K": _memory("ROM32K", 32768, writable=False),
+}
+# fmt: on
+
+
+def _range(ref: PinRef, width: int) -> range:
+    if ref.start is None or ref.end is None:
+        return range(width)
+    if not 0 <= ref.start <= ref.end < width:
+        raise ValueError(f"Sub bus {ref.name}[{ref.start}..{ref.end}] out of range")
+    return range(ref.start, ref.end + 1)
+
+
+class Flattener:
+    def __init__(self, library: ChipLibrary):
+        self.library = library
+        self.builder = NetlistBuilder()
+
+    # state in each part of the top chip forms a group, for re-evaluating
+    # only what depends on the state that changed
+    def instantiate(self, chip: ChipDef, inputs: Pins, top: bool = False) -> Pins:
+        b = self.builder
+        if chip["builtin"] is not None:
+            # the builtin names in builtInChips are Java classes, some shared
+            builtin = builtin_chips.get(chip["name"])
+            if builtin is None:
+                raise NotImplementedError(
+                    f"Builtin chip {chip['name']} is not supported"
+                )
+            return builtin(b, inputs)
+
+        # every signal gets placeholder wires first, so parts may use
+        # signals driven by parts further down
+        signals = dict(inputs)
+        for pin, width in chip["outputs"].items():
+            signals[pin] = b.wires(width)
+        for part in chip["parts"]:
+            part_chip = self.library.resolve(part.name)
+            for pin, signal in part.connections:
+                if pin.name in part_chip["outputs"] and signal.name not in signals:
+                    width = len(_range(pin, part_chip["outputs"][pin.name]))
+                    signals[signal.name] = b.wires(width)
+
+        for index, part in enumerate(chip["parts"]):
+            if top:
+                b.group = index
+            part_chip = self.library.resolve(part.name)
+            part_inputs = {
+                pin: [FALSE] * width for pin, width in part_chip["inputs"].items()
+            }
+            for pin, signal in part.connections:
+                if pin.name not in part_chip["inputs"]:
+                    continue
+                bits = _range(pin, part_chip["inputs"][pin.name])
+                source = self._signal_bits(chip, signals, signal, len(bits))
+                for i, bit in zip(bits, source):
+                    part_inputs[pin.name][i] = bit
+
+            part_outputs = self.instantiate(part_chip, part_inputs)
+            for pin, signal in part.connections:
+                if pin.name in part_chip["inputs"]:
+                    continue
+                if pin.name not in part_chip["outputs"]:
+                    raise ValueError(f"{part.name} has no pin {pin.name}")
+                if signal.name in chip["inputs"] or signal.name in ("true", "false"):
+                    raise ValueError(
+                        f"Can't connect {part.name}.{pin.name} to {signal.name}"
+                    )
+                source = [
+                    part_outputs[pin.name][i]
+                    for i in _range(pin, len(part_outputs[pin.name]))
+                ]
+                target = signals[signal.name]
+                target_bits = _range(signal, len(target))
+                if len(target_bits) != len(source):
+                    raise ValueError(
+                        f"Width mismatch connecting {part.name}.{pin.name} to {signal.name}"
+                    )
+                for i, bit in zip(target_bits, source):
+                    b.alias(target[i], bit)
+
+        return {pin: signals[pin] for pin in chip["outputs"]}
+
+    def _signal_bits(
+        self, chip: ChipDef, signals: Pins, signal: PinRef, width: int
+    ) -> list[int]:
+        if signal.name == "true":
+            return [TRUE] * width
+        if signal.name == "false":
+            return [FALSE] * width
+        if signal.name not in signals:
+            raise ValueError(f"Signal {signal.name} is never driven in {chip['name']}")
+        wires = signals[signal.name]
+        bits = [wires[i] for i in _range(signal, len(wires))]
+        if len(bits) != width:
+            raise ValueError(f"Width mismatch for {signal.name} in {chip['name']}")
+        return bits
+
+
+def flatten(chip: ChipDef, library: ChipLibrary) -> Netlist:
+    flattener = Flattener(library)
+    b = flattener.builder
+    inputs = {pin: b.wires(width) for pin, width in chip["inputs"].items()}
+    outputs = flattener.instantiate(chip, inputs, top=True)
+    return _optimize(chip["name"], b, inputs, outputs)
+
+
+# Resolves placeholders, folds constants, drops gates nothing depends on,
+# sorts the rest topologically and renumbers the wires densely.
+def _optimize(name: str, b: NetlistBuilder, inputs: Pins, outputs: Pins) -> Netlist:
+    aliases = b.aliases
+
+    def resolve(wire: int) -> int:
+        seen = []
+        while wire in aliases:
+            seen.append(wire)
+            wire = aliases[wire]
+            if len(seen) > len(aliases):
+                raise ValueError(f"Combinational loop in {name}")
+        for s in seen:
+            aliases[s] = wire
+        return wire
+
+    producers = {op[1] for op in b.ops} | {out for _, out in b.dffs}
+    sources = {FALSE, TRUE} | {w for pin in inputs.values() for w in pin}
+
+    # placeholders nobody drives read as false
+    def final(wire: int) -> int:
+        wire = resolve(wire)
+        if wire not in producers and wire not in sources:
+            return FALSE
+        return wire
+
+    ops = [_map_inputs(op, final) for op in b.ops]
+    dffs = [(final(i), o) for i, o in b.dffs]
+    memories = [_map_memory(m, final) for m in b.memories]
+    outputs = {pin: [final(w) for w in wires] for pin, wires in outputs.items()}
+    registers = {n: [final(w) for w in wires] for n, wires in b.registers.items()}
+
+    ops = _topological_sort(name, ops)
+    ops, constants = _fold_constants(ops)
+
+    def substitute(wire: int) -> int:
+        return constants.get(wire, wire)
+
+    ops = [_map_inputs(op, substitute) for op in ops]
+    dffs = [(substitute(i), o) for i, o in dffs]
+    memories = [_map_memory(m, substitute) for m in memories]
+    outputs = {pin: [substitute(w) for w in wires] for pin, wires in outputs.items()}
+    registers = {n: [substitute(w) for w in wires] for n, wires in registers.items()}
+
+    # dead gate elimination, walking back from everything observable
+    needed = {w for wires in outputs.values() for w in wires}
+    needed |= {w for wires in registers.values() for w in wires}
+    needed |= {w for dff in dffs for w in dff}
+    needed |= {w for m in memories for w in [m["address"], m["load"], *m["input"]]}
+    live = []
+    for op in reversed(ops):
+        if op[1] in needed:
+            live.append(op)
+            needed.update(_op_inputs(op))
+    ops = live[::-1]
+
+    numbering = {FALSE: FALSE, TRUE: TRUE}
+    for wires in inputs.values():
+        for w in wires:
+            numbering[w] = len(numbering)
+    for _, out in dffs:
+        numbering.setdefault(out, len(numbering))
+    for op in ops:
+        numbering[op[1]] = len(numbering)
+
+    def renumber(wire: int) -> int:
+        return numbering[wire]
+
+    return {
+        "name": name,
+        "wire_count": len(numbering),
+        "inputs": {pin: [renumber(w) for w in wires] for pin, wires in inputs.items()},
+        "outputs": {
+            pin: [renumber(w) for w in wires] for pin, wires in outputs.items()
+        },
+        "ops": [_map_inputs((op[0], renumber(op[1]), *op[2:]), renumber) for op in ops],
+        "dffs": [(renumber(i), renumber(o)) for i, o in dffs],
+        "dff_groups": b.dff_groups,
+        "memories": [_map_memory(m, renumber) for m in memories],
+        "registers": {
+            n: [renumber(w) for w in wires] for n, wires in registers.items()
+        },
+    }
+
+
+def _op_inputs(op: tuple[int, ...]) -> tuple[int, ...]:
+    # reads carry the memory index and bit after the address
+    return op[2:3] if op[0] == READ else op[2:]
+
+
+def _map_inputs(op: tuple[int, ...], f: Callable[[int], int]) -> tuple[int, ...]:
+    if op[0] == READ:
+        return (READ, op[1], f(op[2]), *op[3:])
+    return (op[0], op[1], *(f(w) for w in op[2:]))
+
+
+def _map_memory(memory: MemoryDef, f: Callable[[int], int]) -> MemoryDef:
+    return {
+        **memory,
+        "address": f(memory["address"]),
+        "input": [f(w) for w in memory["input"]],
+        "load": f(memory["load"]),
+    }
+
+
+def _topological_sort(name: str, ops: list[tuple[int, ...]]) -> list[tuple[int, ...]]:
+    producer = {op[1]: i for i, op in enumerate(ops)}
+    dependents: list[list[int]] = [[] for _ in ops]
+    waiting = [0] * len(ops)
+    for i, op in enumerate(ops):
+        for w in set(_op_inputs(op)):
+            if w in producer:
+                dependents[producer[w]].append(i)
+                waiting[i] += 1
+    ready = [i for i, count in enumerate(waiting) if count == 0]
+    ordered = []
+    while ready:
+        i = ready.pop()
+        ordered.append(ops[i])
+        for j in dependents[i]:
+            waiting[j] -= 1
+            if waiting[j] == 0:
+                ready.append(j)
+    if len(ordered) != len(ops):
+        raise ValueError(f"Combinational loop in {name}")
+    return ordered
+
+
+gate_functions: dict[int, Callable[..., int]] = {
+    NAND: lambda a, b: 1 ^ (a & b),
+    AND: lambda a, b: a & b,
+    OR: lambda a, b: a | b,
+    XOR: lambda a, b: a ^ b,
+    NOT: lambda a: 1 ^ a,
+    MUX: lambda a, b, sel: b if sel else a,
+}
+
+
+def _fold_constants(
+    ops: list[tuple[int, ...]]
+) -> tuple[list[tuple[int, ...]], dict[int, int]]:
+    constants: dict[int, int] = {}
+    folded = []
+    for op in ops:
+        op = _map_inputs(op, lambda w: constants.get(w, w))
+        kind, out, inputs = op[0], op[1], op[2:]
+        if kind not in gate_functions:
+            folded.append(op)
+            continue
+        if all(w in (FALSE, TRUE) for w in inputs):
+            constants[out] = gate_functions[kind](*inputs)
+            continue
+        replacement = _simplify(kind, inputs)
+        if replacement is not None:
+            constants[out] = replacement
+            continue
+        folded.append(op)
+    return folded, constants
+
+
+# gates that reduce to one of their inputs
+def _simplify(kind: int, inputs: tuple[int, ...]) -> int | None:
+    if kind == MUX:
+        a, b, sel = inputs
+        if sel == FALSE or a == b:
+            return a
+        if sel == TRUE:
+            return b
+    elif kind == AND:
+        a, b = inputs
+        if FALSE in inputs:
+            return FALSE
+        if a == TRUE or a == b:
+            return b
+        if b == TRUE:
+            return a
+    elif kind == OR:
+        a, b = inputs
+        if TRUE in inputs:
+            return TRUE
+        if a == FALSE or a == b:
+            return b
+        if b == FALSE:
+            return a
+    elif kind == XOR:
+        a, b = inputs
+        if a == FALSE:
+            return b
+        if b == FALSE:
+            return a
+    return None
+
+
+gate_exprs = {
+    NAND: "mask ^ (w[{0}] & w[{1}])",
+    AND: "w[{0}] & w[{1}]",
+    OR: "w[{0}] | w[{1}]",
+    XOR: "w[{0}] ^ w[{1}]",
+    NOT: "mask ^ w[{0}]",
+    MUX: "(w[{0}] & ~w[{2}]) | (w[{1}] & w[{2}])",
+    READ: "(m[{1}][w[{0}]] >> {2}) & 1",
+}
+
+Evaluate = Callable[[list[int], int, list[array]], None]
+
+
+# The whole netlist as one generated function over the flat wire list.
+# mask has a 1 for every bit in use, so gates work on many rows at once.
+def compile_netlist(netlist: Netlist) -> Evaluate:
+    return _compile_ops(netlist["name"], netlist["ops"])
+
+
+def _compile_ops(name: str, ops: list[tuple[int, ...]]) -> Evaluate:
+    lines = ["def evaluate(w, mask, m):"]
+    for op in ops:
+        if op[0] == ADDRESS:
+            expr = " | ".join(f"(w[{wire}] << {i})" for i, wire in enumerate(op[2:]))
+            lines.append(f"    w[{op[1]}] = {expr or 0}")
+        else:
+            lines.append(f"    w[{op[1]}] = " + gate_exprs[op[0]].format(*op[2:]))
+    lines.append("    return")
+    namespace: dict = {}
+    exec(compile("\n".join(lines), f"<chip {name}>", "exec"), namespace)
+    return namespace["evaluate"]
+
+
+# The ops to re-run when a state group changes: everything downstream of
+# its DFFs and of reads from its memories. Chip inputs are a group too.
+def _cones(netlist: Netlist) -> dict[int, list[tuple[int, ...]]]:
+    seeds = {INPUTS: {w for wires in netlist["inputs"].values() for w in wires}}
+    for (_, out), group in zip(netlist["dffs"], netlist["dff_groups"]):
+        seeds.setdefault(group, set()).add(out)
+    memory_groups = [memory["group"] for memory in netlist["memories"]]
+    for group in memory_groups:
+        seeds.setdefault(group, set())
+
+    cones = {}
+    for group, changed in seeds.items():
+        cone = []
+        for op in netlist["ops"]:
+            if (op[0] == READ and memory_groups[op[3]] == group) or any(
+                w in changed for w in _op_inputs(op)
+            ):
+                cone.append(op)
+                changed.add(op[1])
+        cones[group] = cone
+    return cones
+
+
+def load_netlist(hdlpath: str, cache: BuildCache | None = None) -> Netlist:
+    library = ChipLibrary([os.path.dirname(hdlpath) or "."])
+    chip = library.load(hdlpath)
+    if cache is None:
+        return flatten(chip, library)
+
+    sources = sorted(
+        f"{c['name']}:{file_digest(c['path'])}" for c in library.dependencies(chip)
+    )
+    key = cache.key(HARDWARE_SIMULATOR_VERSION, *sources)
+    data = cache.get(key)
+    if data is not None:
+        return pickle.loads(data)
+    netlist = flatten(chip, library)
+    cache.put(key, pickle.dumps(netlist))
+    return netlist
+
+
+def _to_int(w: list[int], wires: list[int]) -> int:
+    value = 0
+    for i, wire in enumerate(wires):
+        value |= w[wire] << i
+    if len(wires) == 16 and value & 0x8000:
+        value -= 0x10000
+    return value
+
+
+class Chip:
+    def __init__(self, netlist: Netlist):
+        self.netlist = netlist
+        self.w = [0] * netlist["wire_count"]
+        self.w[TRUE] = 1
+        self.mask = 1
+        self.memories = [array("h", bytes(2 * m["size"])) for m in netlist["memories"]]
+        self.combinational = not netlist["dffs"] and not netlist["memories"]
+        self._evaluate = compile_netlist(netlist)
+        self._cones = {
+            group: _compile_ops(f"{netlist['name']} group {group}", ops)
+            for group, ops in _cones(netlist).items()
+        }
+        self._dirty: set[int] = set()
+        self._latched: list[int] = []
+        self._writes: list[tuple[int, int, int]] = []
+        self._ticked = False
+        self._dff_index = {out: i for i, (_, out) in enumerate(netlist["dffs"])}
+        self._evaluate(self.w, self.mask, self.memories)
+
+    def set(self, pin: str, value: int):
+        w = self.w
+        for i, wire in enumerate(self.netlist["inputs"][pin]):
+            w[wire] = (value >> i) & 1
+        self._dirty.add(INPUTS)
+
+    def get(self, pin: str) -> int:
+        wires = self.netlist["outputs"].get(pin) or self.netlist["inputs"].get(pin)
+        if wires is None:
+            raise KeyError(f"No pin {pin} in {self.netlist['name']}")
+        return _to_int(self.w, wires)
+
+    # builtin registers show their new value from the tick on, like the
+    # Java simulator
+    def register(self, name: str) -> int:
+        wires = self.netlist["registers"][name]
+        if not self._ticked:
+            return _to_int(self.w, wires)
+        state = [0, 1] + self._latched
+        indices = [self._dff_index[w] + 2 if w in self._dff_index else w for w in wires]
+        return _to_int(state, indices)
+
+    # memories by part name, the first one when a chip has several
+    def _memory_index(self, name: str) -> int:
+        for i, memory in enumerate(self.netlist["memories"]):
+            if memory["name"] == name:
+                return i
+        raise KeyError(f"No memory {name} in {self.netlist['name']}")
+
+    def peek(self, name: str, address: int) -> int:
+        return self.memories[self._memory_index(name)][address]
+
+    def poke(self, name: str, address: int, value: int):
+        index = self._memory_index(name)
+        self.memories[index][address] = to_word(value)
+        self._dirty.add(self.netlist["memories"][index]["group"])
+
+    def load_memory(self, name: str, path: str):
+        index = self._memory_index(name)
+        words = array("h", array("H", load_rom(path)).tobytes())
+        memory = self.memories[index]
+        memory[: len(words)] = words
+        memory[len(words) :] = array("h", bytes(2 * (len(memory) - len(words))))
+        self._dirty.add(self.netlist["memories"][index]["group"])
+
+    # re-runs the cones of the groups that changed since the last evaluation
+    def evaluate(self):
+        for group in self._dirty:
+            self._cones[group](self.w, self.mask, self.memories)
+        self._dirty.clear()
+
+    def tick(self):
+        self.evaluate()
+        w = self.w
+        self._latched = [w[i] for i, _ in self.netlist["dffs"]]
+        self._writes = [
+            (i, w[m["address"]], _to_int(w, m["input"]))
+            for i, m in enumerate(self.netlist["memories"])
+            if m["input"] and w[m["load"]]
+        ]
+        self._ticked = True
+
+    def tock(self):
+        w = self.w
+        groups = self.netlist["dff_groups"]
+        for i, ((_, out), value) in enumerate(zip(self.netlist["dffs"], self._latched)):
+            if w[out] != value:
+                w[out] = value
+                self._dirty.add(groups[i])
+        for index, address, value in self._writes:
+            self.memories[index][address] = value
+            self._dirty.add(self.netlist["memories"][index]["group"])
+        self._latched = []
+        self._writes = []
+        self._ticked = False
+        self.evaluate()
+
+    # Bit-parallel evaluation: wire values are ints with one bit per row, so
+    # one pass over the gates evaluates every row. Only meaningful for
+    # combinational chips, state is left alone.
+    def evaluate_rows(self, rows: list[dict[str, int]]) -> list[dict[str, int]]:
+        if not self.combinational:
+            raise ValueError(f"{self.netlist['name']} is not combinational")
+        w = [0] * self.netlist["wire_count"]
+        mask = (1 << len(rows)) - 1
+        w[TRUE] = mask
+        for pin, wires in self.netlist["inputs"].items():
+            for i, wire in enumerate(wires):
+                packed = 0
+                for r, row in enumerate(rows):
+                    packed |= ((row.get(pin, 0) >> i) & 1) << r
+                w[wire] = packed
+        self._evaluate(w, mask, self.memories)
+        return _unpack_rows(w, self.netlist["outputs"], len(rows))
+
+    # every combination of the input pins, the first pin in the low bits
+    def evaluate_all_inputs(self, pins: list[str]) -> tuple[list[int], int]:
+        w = [0] * self.netlist["wire_count"]
+        inputs = self.netlist["inputs"]
+        input_wires = [wire for pin in pins for wire in inputs[pin]]
+        size = 1 << len(input_wires)
+        mask = (1 << size) - 1
+        w[TRUE] = mask
+        for j, wire in enumerate(input_wires):
+            w[wire] = _exhaustive_pattern(j, size)
+        self._evaluate(w, mask, self.memories)
+        return w, size
+
+
+# Row r of an exhaustive evaluation has input bit j set when bit j of r is,
+# i.e. 2**j zeros then 2**j ones, repeated.
+def _exhaustive_pattern(j: int, size: int) -> int:
+    period = 1 << (j + 1)
+    block = ((1 << (1 << j)) - 1) << (1 << j)
+    return block * (((1 << size) - 1) // ((1 << period) - 1))
+
+
+def _unpack_rows(
+    w: list[int], pins: dict[str, list[int]], count: int
+) -> list[dict[str, int]]:
+    rows: list[dict[str, int]] = [{} for _ in range(count)]
+    for pin, wires in pins.items():
+        values = [0] * count
+        for i, wire in enumerate(wires):
+            packed = w[wire]
+            for r in range(count):
+                values[r] |= ((packed >> r) & 1) << i
+        if len(wires) == 16:
+            values = [v - 0x10000 if v & 0x8000 else v for v in values]
+        for row, value in zip(rows, values):
+            row[pin] = value
+    return rows
+
+
+# Largest input space verify() goes through, 2**20 rows are a few seconds.
+MAX_VERIFY_BITS = 20
+
+
+# Checks a combinational chip against a reference over its whole input
+# space, returning the first row where they differ.
+def verify(chip: Chip, reference: Chip) -> dict[str, int] | None:
+    if (
+        chip.netlist["inputs"].keys() != reference.netlist["inputs"].keys()
+        or chip.netlist["outputs"].keys() != reference.netlist["outputs"].keys()
+    ):
+        raise ValueError(
+            f"{chip.netlist['name']} and its reference have different pins"
+        )
+    if not chip.combinational or not reference.combinational:
+        raise ValueError("Only combinational chips can be verified")
+    bits = sum(len(wires) for wires in chip.netlist["inputs"].values())
+    if bits > MAX_VERIFY_BITS:
+        raise ValueError(f"{bits} input bits is too many to verify exhaustively")
+
+    pins = list(chip.netlist["inputs"])
+    w, _ = chip.evaluate_all_inputs(pins)
+    expected, _ = reference.evaluate_all_inputs(pins)
+    diff = 0
+    for pin, wires in chip.netlist["outputs"].items():
+        for wire, reference_wire in zip(wires, reference.netlist["outputs"][pin]):
+            diff |= w[wire] ^ expected[reference_wire]
+    if not diff:
+        return None
+    row = (diff & -diff).bit_length() - 1
+    counterexample = {}
+    j = 0
+    for pin, wires in chip.netlist["inputs"].items():
+        counterexample[pin] = (row >> j) & ((1 << len(wires)) - 1)
+        j += len(wires)
+    return counterexample
+
+
+def load_builtin_netlist(name: str) -> Netlist:
+    library = ChipLibrary([])
+    return flatten(library.resolve(name), library)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flatten and evaluate a chip")
+    parser.add_argument("hdlpath")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="PIN=VALUE",
+        help="input pin values, e.g. --set zx=1",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir("hardware"),
+        help="where flattened netlists are cached by HDL content hash",
+    )
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--rom", help="program to load into ROM32K")
+    parser.add_argument(
+        "--cycles", type=int, default=0, help="clock cycles to run after loading"
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="compare with the builtin chip over every input combination",
+    )
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else BuildCache(args.cache_dir)
+    start = time.perf_counter()
+    netlist = load_netlist(args.hdlpath, cache)
+    chip = Chip(netlist)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{netlist['name']}: {len(netlist['ops'])} gates, {len(netlist['dffs'])} DFFs,"
+        f" {netlist['wire_count']} wires, loaded in {elapsed * 1000:.1f} ms"
+    )
+
+    if args.verify:
+        start = time.perf_counter()
+        try:
+            counterexample = verify(chip, Chip(load_builtin_netlist(netlist["name"])))
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        elapsed = time.perf_counter() - start
+        if counterexample is not None:
+            print(f"Differs from the builtin chip for {counterexample}")
+            sys.exit(1)
+        print(f"Matches the builtin chip on every input ({elapsed * 1000:.1f} ms)")
+        return
+
+    if args.rom:
+        chip.load_memory("ROM32K", args.rom)
+    for assignment in args.set:
+        pin, value = assignment.split("=")
+        chip.set(pin, int(value, 0))
+    chip.evaluate()
+    if args.cycles:
+        start = time.perf_counter()
+        for _ in range(args.cycles):
+            chip.tick()
+            chip.tock()
+        elapsed = time.perf_counter() - start
+        print(f"{args.cycles} cycles in {elapsed:.2f} s")
+        for name in netlist["registers"]:
+            print(f"{name}[] = {chip.register(name)}")
+    for pin in netlist["outputs"]:
+        print(f"{pin} = {chip.get(pin)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import glob
+import os
+
+import pytest
+from buildcache import BuildCache
+from CPUEmulator import HackCPU
+from HardwareSimulator import (
+    Chip,
+    ChipLibrary,
+    flatten,
+    load_builtin_netlist,
+    load_netlist,
+    parse_hdl,
+    verify,
+)
+from TestRunner import run_script
+
+projects_dir = os.path.join(os.path.dirname(__file__), "..", "projects")
+
+
+def load_chip(hdl: str, tmp_path) -> Chip:
+    return Chip(flatten(parse_hdl(hdl), ChipLibrary([str(tmp_path)])))
+
+
+class TestParseHdl:
+    def test_parses_pins_and_sub_buses(self):
+        chip = parse_hdl(
+            """
+            // comment
+            CHIP Foo {
+                IN a[16], sel; /* block
+                comment */
+                OUT out[8], ng;
+                PARTS:
+                Mux16(a=a, b[0..15]=false, sel=sel, out[0..7]=out, out[15]=ng);
+            }
+            """
+        )
+        assert chip["name"] == "Foo"
+        assert chip["inputs"] == {"a": 16, "sel": 1}
+        assert chip["outputs"] == {"out": 8, "ng": 1}
+        (part,) = chip["parts"]
+        assert part.name == "Mux16"
+        assert part.connections[1] == (("b", 0, 15), ("false", None, None))
+        assert part.connections[4] == (("out", 15, 15), ("ng", None, None))
+
+
+class TestChip:
+    def test_parts_in_any_order(self, tmp_path):
+        chip = load_chip(
+            """
+            CHIP Xor2 {
+                IN a, b;
+                OUT out;
+                PARTS:
+                And(a=nota, b=b, out=w1);
+                Or(a=w1, b=w2, out=out);
+                Not(in=a, out=nota);
+                And(a=a, b=notb, out=w2);
+                Not(in=b, out=notb);
+            }
+            """,
+            tmp_path,
+        )
+        for a in range(2):
+            for b in range(2):
+                chip.set("a", a)
+                chip.set("b", b)
+                chip.evaluate()
+                assert chip.get("out") == a ^ b
+
+    def test_constants_are_folded(self, tmp_path):
+        chip = load_chip(
+            """
+            CHIP Id {
+                IN in[16];
+                OUT out[16];
+                PARTS:
+                Mux16(a=in, b[0..15]=true, sel=false, out=out);
+            }
+            """,
+            tmp_path,
+        )
+        assert chip.netlist["ops"] == []
+        chip.set("in", -2)
+        chip.evaluate()
+        assert chip.get("out") == -2
+
+    def test_combinational_loop(self, tmp_path):
+        with pytest.raises(ValueError, match="loop"):
+            load_chip(
+                """
+                CHIP Loop {
+                    IN in;
+                    OUT out;
+                    PARTS:
+                    And(a=in, b=x, out=x, out=out);
+                }
+                """,
+                tmp_path,
+            )
+
+    def test_register_holds_value(self):
+        chip = Chip(load_netlist(os.path.join(projects_dir, "03", "a", "Register.hdl")))
+        chip.set("in", 1234)
+        chip.set("load", 1)
+        chip.tick()
+        assert chip.get("out") == 0
+        chip.tock()
+        assert chip.get("out") == 1234
+        chip.set("in", 99)
+        chip.set("load", 0)
+        chip.tick()
+        chip.tock()
+        assert chip.get("out") == 1234
+
+
+class TestSequential:
+    def test_computer_matches_cpu_emulator(self):
+        chip = Chip(load_netlist(os.path.join(projects_dir, "05", "Computer.hdl")))
+        chip.load_memory("ROM32K", os.path.join(projects_dir, "06", "max", "Max.hack"))
+        chip.poke("RAM16K", 0, 17)
+        chip.poke("RAM16K", 1, -4)
+        cpu = HackCPU.from_file(os.path.join(projects_dir, "06", "max", "Max.hack"))
+        cpu.ram[0] = 17
+        cpu.ram[1] = -4
+        for _ in range(20):
+            chip.tick()
+            chip.tock()
+            cpu.step()
+            assert chip.register("PC") == cpu.pc
+            assert chip.register("ARegister") == cpu.a
+            assert chip.register("DRegister") == cpu.d
+        assert chip.peek("RAM16K", 2) == cpu.ram[2] == 17
+
+    def test_memory_written_on_tock(self, tmp_path):
+        chip = load_chip(
+            """
+            CHIP Mem {
+                IN in[16], load, address[3];
+                OUT out[16];
+                PARTS:
+                RAM8(in=in, load=load, address=address, out=out);
+            }
+            """,
+            tmp_path,
+        )
+        chip.set("in", -7)
+        chip.set("load", 1)
+        chip.set("address", 5)
+        chip.tick()
+        assert chip.get("out") == 0
+        chip.tock()
+        assert chip.get("out") == chip.peek("RAM8", 5) == -7
+        chip.set("load", 0)
+        chip.set("address", 4)
+        chip.evaluate()
+        assert chip.get("out") == 0
+
+
+class TestBitParallel:
+    def test_rows_match_single_evaluation(self):
+        chip = Chip(load_netlist(os.path.join(projects_dir, "02", "ALU.hdl")))
+        rows = [
+            {"x": x, "y": y, "zx": zx, "nx": 1, "zy": 0, "ny": 1, "f": f, "no": 1}
+            for x, y in [(0, -1), (17, 3), (-32768, 32767)]
+            for zx in range(2)
+            for f in range(2)
+        ]
+        for row, outputs in zip(rows, chip.evaluate_rows(rows)):
+            for pin, value in row.items():
+                chip.set(pin, value)
+            chip.evaluate()
+            assert outputs == {pin: chip.get(pin) for pin in ["out", "zr", "ng"]}
+
+    @pytest.mark.parametrize(
+        "name",
+        ["Not", "And", "Or", "Xor", "Mux", "DMux", "Or8Way", "DMux4Way", "DMux8Way"],
+    )
+    def test_project_chips_match_builtins(self, name):
+        chip = Chip(load_netlist(os.path.join(projects_dir, "01", f"{name}.hdl")))
+        assert verify(chip, Chip(load_builtin_netlist(name))) is None
+
+    def test_counterexample(self, tmp_path):
+        chip = load_chip(
+            """
+            CHIP Or8Way {
+                IN in[8];
+                OUT out;
+                PARTS:
+                Or(a=in[0], b=in[1], out=out);
+            }
+            """,
+            tmp_path,
+        )
+        assert verify(chip, Chip(load_builtin_netlist("Or8Way"))) == {"in": 4}
+
+
+class TestLoadNetlist:
+    def test_cached_by_hdl_content(self, tmp_path):
+        hdlpath = str(tmp_path / "Double.hdl")
+        with open(hdlpath, "w") as w:
+            w.write(
+                "CHIP Double { IN in[16]; OUT out[16];"
+                " PARTS: Add16(a=in, b=in, out=out); }"
+            )
+        cache = BuildCache(str(tmp_path / "cache"))
+        first = load_netlist(hdlpath, cache)
+        assert (cache.hits, cache.misses) == (0, 1)
+        assert load_netlist(hdlpath, cache) == first
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        with open(hdlpath, "w") as w:
+            w.write(
+                "CHIP Double { IN in[16]; OUT out[16];"
+                " PARTS: Inc16(in=in, out=out); }"
+            )
+        load_netlist(hdlpath, cache)
+        assert (cache.hits, cache.misses) == (1, 2)
+
+
+@pytest.mark.parametrize(
+    "tstpath",
+    [
+        tstpath
+        for tstpath in sorted(
+            glob.glob(
+                os.path.join(projects_dir, "0[1235]", "**", "*.tst"), recursive=True
+            )
+        )
+        # waits for key presses
+        if os.path.basename(tstpath) != "Memory.tst"
+    ],
+    ids=lambda tstpath: os.path.relpath(tstpath, projects_dir),
+)
+def test_project_scripts(tstpath, tmp_path):
+    result = run_script(tstpath, str(tmp_path))
+    assert result["status"] == "pass", result["message"]
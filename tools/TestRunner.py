@@ -0,0 +1,721 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from typing import Literal, Protocol, TextIO, TypedDict
+
+from buildcache import BuildCache, default_cache_dir
+from CPUEmulator import HackCPU, to_word
+from HardwareSimulator import Chip, load_netlist
+from utils import find_filepaths
+from VMEmulator import VM
+from vmcode import VMError
+
+
+class ScriptError(Exception):
+    pass
+
+
+class ComparisonFailure(Exception):
+    pass
+
+
+# scripts the runner can't run unattended, reported as skipped
+class ScriptSkipped(Exception):
+    pass
+
+
+# Parsed test scripts:
+#   ("command", words)
+#   ("repeat", count or -1 for ever, body)
+#   ("while", (name, op, value), body)
+Statement = tuple
+
+
+comment_matcher = re.compile(r"//[^\n]*|/\*.*?\*/", re.DOTALL)
+token_matcher = re.compile(r'"[^"]*"|[{}]|[,;!]|[^\s,;!{}]+')
+condition_matcher = re.compile(r"^(\S+?)\s*(<>|<=|>=|=|<|>)\s*(\S+)$")
+output_matcher = re.compile(
+    r"^(?P<name>.+?)(%(?P<format>[BDXS])(?P<left>\d+)\.(?P<width>\d+)\.(?P<right>\d+))?$"
+)
+
+
+def tokenize(script: str) -> list[str]:
+    return token_matcher.findall(comment_matcher.sub(" ", script))
+
+
+def parse_script(script: str) -> list[Statement]:
+    tokens = tokenize(script)
+    statements, position = _parse_block(tokens, 0)
+    if position != len(tokens):
+        raise ScriptError("Unexpected '}'")
+    return statements
+
+
+def _parse_block(tokens: list[str], position: int) -> tuple[list[Statement], int]:
+    statements: list[Statement] = []
+    words: list[str] = []
+    while position < len(tokens):
+        token = tokens[position]
+        position += 1
+        if token in (",", ";", "!"):
+            if words:
+                statements.append(("command", words))
+            words = []
+        elif token == "{":
+            body, position = _parse_block(tokens, position)
+            if not words:
+                raise ScriptError("Block without repeat or while")
+            if words[0] == "repeat":
+                count = int(words[1]) if len(words) > 1 else -1
+                statements.append(("repeat", count, body))
+            elif words[0] == "while":
+                condition = condition_matcher.match(" ".join(words[1:]))
+                if condition is None:
+                    raise ScriptError(f"Invalid condition {' '.join(words[1:])}")
+                statements.append(("while", condition.groups(), body))
+            else:
+                raise ScriptError(f"Unexpected block after {' '.join(words)}")
+            words = []
+        elif token == "}":
+            if words:
+                statements.append(("command", words))
+            return statements, position
+        else:
+            words.append(token)
+    if words:
+        statements.append(("command", words))
+    return statements, position
+
+
+def parse_value(value: str) -> int:
+    if value.startswith("%B"):
+        return int(value[2:], 2)
+    if value.startswith("%X"):
+        return int(value[2:], 16)
+    if value.startswith("%D"):
+        return int(value[2:])
+    return int(value)
+
+
+class OutputColumn(TypedDict):
+    name: str
+    format: str
+    left: int
+    width: int
+    right: int
+
+
+def parse_output_column(spec: str) -> OutputColumn:
+    matches = output_matcher.match(spec)
+    if matches is None:
+        raise ScriptError(f"Invalid output-list entry {spec}")
+    if matches.group("format") is None:
+        return {"name": spec, "format": "D", "left": 1, "width": 6, "right": 1}
+    return {
+        "name": matches.group("name"),
+        "format": matches.group("format"),
+        "left": int(matches.group("left")),
+        "width": int(matches.group("width")),
+        "right": int(matches.group("right")),
+    }
+
+
+def format_header(column: OutputColumn) -> str:
+    total = column["left"] + column["width"] + column["right"]
+    name = column["name"][:total]
+    left = (total - len(name)) // 2
+    return " " * left + name + " " * (total - left - len(name))
+
+
+def format_value(column: OutputColumn, value: int | str) -> str:
+    width = column["width"]
+    match column["format"]:
+        case "B":
+            text = f"{int(value) & ((1 << width) - 1):0{width}b}"
+        case "X":
+            text = f"{int(value) & ((1 << (4 * width)) - 1):0{width}X}"
+        case "S":
+            text = str(value).ljust(width)
+        case _:
+            text = str(value).rjust(width)
+    return " " * column["left"] + text + " " * column["right"]
+
+
+def lines_match(output: str, expected: str) -> bool:
+    output = output.rstrip()
+    expected = expected.rstrip()
+    if len(output) != len(expected):
+        return False
+    return all(e == "*" or o == e for o, e in zip(output, expected))
+
+
+# What a test script drives: a chip, the CPU or the VM.
+class Simulator(Protocol):
+    def get(self, name: str) -> int | str:
+        ...
+
+    def set(self, name: str, value: int):
+        ...
+
+    # runs a simulator specific command such as tick, eval or vmstep
+    # the given number of times
+    def run_command(self, words: list[str], times: int = 1):
+        ...
+
+
+ram_matcher = re.compile(r"^RAM\[(\d+)\]$")
+rom_matcher = re.compile(r"^ROM\[(\d+)\]$")
+
+
+class CPUSimulator:
+    # programs are assembled in memory, there is nothing to cache
+    def __init__(self, path: str, cachedir: str | None = None):
+        self.cpu = HackCPU.from_file(path)
+        self.time = 0
+
+    def get(self, name: str) -> int | str:
+        if ram := ram_matcher.match(name):
+            return self.cpu.ram[int(ram.group(1))]
+        if rom := rom_matcher.match(name):
+            return to_word(self.cpu.rom[int(rom.group(1))])
+        match name:
+            case "A":
+                return self.cpu.a
+            case "D":
+                return self.cpu.d
+            case "PC":
+                return self.cpu.pc
+            case "time":
+                return self.time
+        raise ScriptError(f"Unknown variable {name}")
+
+    def set(self, name: str, value: int):
+        if ram := ram_matcher.match(name):
+            self.cpu.ram[int(ram.group(1))] = to_word(value)
+            return
+        match name:
+            case "A":
+                self.cpu.a = to_word(value)
+            case "D":
+                self.cpu.d = to_word(value)
+            case "PC":
+                self.cpu.pc = value & 0x7FFF
+                self.cpu.halted = False
+            case _:
+                raise ScriptError(f"Unknown variable {name}")
+
+    def run_command(self, words: list[str], times: int = 1):
+        match words:
+            case ["ticktock"] | ["tock"]:
+                self.cpu.halted = False
+                remaining = times - self.cpu.run(times)
+                if remaining:
+                    # halted, the end loop alternates between its 2 instructions
+                    self.cpu.cycles += remaining - remaining % 2
+                    if remaining % 2:
+                        self.cpu.step()
+                self.time += times
+            case ["tick"]:
+                pass
+            case _:
+                raise ScriptError(f"Unknown command {' '.join(words)}")
+
+
+# ARegister[] or ARegister[0]
+register_matcher = re.compile(r"^(\w+)\[0?\]$")
+memory_matcher = re.compile(r"^(\w+)\[(\d+)\]$")
+
+
+class ChipSimulator:
+    def __init__(self, path: str, cachedir: str | None = None):
+        cache = BuildCache(cachedir) if cachedir else None
+        self.chip = Chip(load_netlist(path, cache))
+        self.dirpath = os.path.dirname(path)
+        self.time = 0
+        self.ticked = False
+        self.precomputed: Iterator[dict[str, int]] | None = None
+        self.outputs: dict[str, int] | None = None
+
+    # Output values for each eval of a combinational script, computed up
+    # front in one bit-parallel pass.
+    def evaluate_ahead(self, rows: list[dict[str, int]]):
+        if self.chip.combinational:
+            self.precomputed = iter(self.chip.evaluate_rows(rows))
+
+    def get(self, name: str) -> int | str:
+        if self.outputs is not None and name in self.outputs:
+            return self.outputs[name]
+        if name == "time":
+            return f"{self.time}+" if self.ticked else str(self.time)
+        register = register_matcher.match(name)
+        if register and register.group(1) in self.chip.netlist["registers"]:
+            return self.chip.register(register.group(1))
+        try:
+            if memory := memory_matcher.match(name):
+                return self.chip.peek(memory.group(1), int(memory.group(2)))
+            return self.chip.get(name)
+        except (KeyError, IndexError):
+            raise ScriptError(f"Unknown variable {name}")
+
+    def set(self, name: str, value: int):
+        if memory := memory_matcher.match(name):
+            try:
+                self.chip.poke(memory.group(1), int(memory.group(2)), value)
+            except (KeyError, IndexError):
+                raise ScriptError(f"Unknown variable {name}")
+            return
+        if name not in self.chip.netlist["inputs"]:
+            raise ScriptError(f"Unknown input pin {name}")
+        self.chip.set(name, value)
+
+    def run_command(self, words: list[str], times: int = 1):
+        for _ in range(times):
+            match words:
+                case ["eval"] if self.precomputed is not None:
+                    self.outputs = next(self.precomputed)
+                case ["eval"]:
+                    self.chip.evaluate()
+                case ["tick"]:
+                    self.chip.tick()
+                    self.ticked = True
+                case ["tock"]:
+                    self.chip.tock()
+                    self.ticked = False
+                    self.time += 1
+                case ["ticktock"]:
+                    self.chip.tick()
+                    self.chip.tock()
+                    self.time += 1
+                case [memory, "load", filename]:
+                    # e.g. ROM32K load Max.hack
+                    try:
+                        self.chip.load_memory(
+                            memory, os.path.join(self.dirpath, filename)
+                        )
+                    except KeyError:
+                        raise ScriptError(f"Unknown command {' '.join(words)}")
+                case _:
+                    raise ScriptError(f"Unknown command {' '.join(words)}")
+
+
+pointer_addresses = {"sp": 0, "local": 1, "argument": 2, "this": 3, "that": 4}
+segment_matcher = re.compile(r"^(local|argument|this|that|temp)\[(\d+)\]$")
+
+
+# Runs .vm files, a bare load loads every .vm file in the script's
+# directory. OS functions the program doesn't define run natively, as the
+# Java emulator runs its builtin OS.
+class VMSimulator:
+    def __init__(self, path: str, cachedir: str | None = None):
+        if not find_filepaths([path], "vm") and find_filepaths([path], "jack"):
+            raise ScriptSkipped(f"No .vm files in {path}, compile the .jack files")
+        self.vm = VM.from_paths([path], native=True)
+        self.time = 0
+
+    def _segment_address(self, segment: re.Match) -> int:
+        name, index = segment.group(1), int(segment.group(2))
+        if name == "temp":
+            return 5 + index
+        return self.vm.ram[pointer_addresses[name]] + index
+
+    def get(self, name: str) -> int | str:
+        if ram := ram_matcher.match(name):
+            return self.vm.ram[int(ram.group(1))]
+        if segment := segment_matcher.match(name):
+            return self.vm.ram[self._segment_address(segment)]
+        if name in pointer_addresses:
+            return self.vm.ram[pointer_addresses[name]]
+        if name == "time":
+            return self.time
+        raise ScriptError(f"Unknown variable {name}")
+
+    def set(self, name: str, value: int):
+        if ram := ram_matcher.match(name):
+            self.vm.ram[int(ram.group(1))] = to_word(value)
+        elif segment := segment_matcher.match(name):
+            self.vm.ram[self._segment_address(segment)] = to_word(value)
+        elif name in pointer_addresses:
+            self.vm.ram[pointer_addresses[name]] = to_word(value)
+        else:
+            raise ScriptError(f"Unknown variable {name}")
+
+    def run_command(self, words: list[str], times: int = 1):
+        match words:
+            case ["vmstep"]:
+                self.vm.run(times)
+                self.time += times
+            case _:
+                raise ScriptError(f"Unknown command {' '.join(words)}")
+
+
+SimulatorLoader = Callable[[str, str | None], Simulator]
+
+# simulators by the extension of the file a script loads
+simulators: dict[str, SimulatorLoader] = {
+    ".asm": CPUSimulator,
+    ".hack": CPUSimulator,
+    ".hdl": ChipSimulator,
+    ".vm": VMSimulator,
+    "": VMSimulator,
+}
+
+
+# while loops running longer than this don't end
+MAX_WHILE_ITERATIONS = 10000
+
+# course scripts with while loops waiting for a key press
+keyboard_scripts = {"Memory.tst"}
+
+
+class ScriptRunner:
+    def __init__(
+        self, tstpath: str, outdir: str | None = None, cachedir: str | None = None
+    ):
+        self.tstpath = tstpath
+        self.dirpath = os.path.dirname(tstpath) or "."
+        self.outdir = outdir or self.dirpath
+        self.cachedir = cachedir
+        self.simulator: Simulator | None = None
+        self.columns: list[OutputColumn] = []
+        self.output: TextIO | None = None
+        self.compare: TextIO | None = None
+        self.compared = 0
+        self.rows: list[dict[str, int]] | None = None
+
+    def run(self) -> int:
+        with open(self.tstpath, "r") as f:
+            statements = parse_script(f.read())
+        if not any(s[1][0] == "compare-to" for s in _commands(statements)):
+            raise ScriptSkipped("Interactive script without compare-to")
+        self.rows = _collect_rows(statements)
+        try:
+            self._run_block(statements)
+        finally:
+            if self.output is not None:
+                self.output.close()
+            if self.compare is not None:
+                self.compare.close()
+        return self.compared
+
+    def _run_block(self, statements: list[Statement]):
+        for statement in statements:
+            if statement[0] == "command":
+                self._run_command(statement[1])
+            elif statement[0] == "repeat":
+                _, count, body = statement
+                self._run_repeat(count, body)
+            else:
+                _, condition, body = statement
+                self._run_while(condition, body)
+
+    def _run_repeat(self, count: int, body: list[Statement]):
+        if (
+            count > 0
+            and len(body) == 1
+            and body[0][0] == "command"
+            and body[0][1][0] not in script_commands
+        ):
+            # a lone simulator command, e.g. ticktock, runs in the simulator
+            self._require_simulator().run_command(body[0][1], count)
+            return
+        i = 0
+        while count < 0 or i < count:
+            self._run_block(body)
+            i += 1
+
+    def _run_while(self, condition: tuple[str, str, str], body: list[Statement]):
+        iterations = 0
+        while self._check(condition):
+            self._run_block(body)
+            iterations += 1
+            if iterations < MAX_WHILE_ITERATIONS:
+                continue
+            if os.path.basename(self.tstpath) in keyboard_scripts:
+                raise ScriptSkipped(
+                    f"while {' '.join(condition)} waits for keyboard input"
+                )
+            raise ScriptError(
+                f"while {' '.join(condition)} didn't end"
+                f" after {MAX_WHILE_ITERATIONS} iterations"
+            )
+
+    def _check(self, condition: tuple[str, str, str]) -> bool:
+        name, op, value = condition
+        actual = self._require_simulator().get(name)
+        expected = parse_value(value)
+        match op:
+            case "=":
+                return actual == expected
+            case "<>":
+                return actual != expected
+            case "<":
+                return actual < expected
+            case ">":
+                return actual > expected
+            case "<=":
+                return actual <= expected
+            case ">=":
+                return actual >= expected
+        raise ScriptError(f"Unknown operator {op}")
+
+    def _require_simulator(self) -> Simulator:
+        if self.simulator is None:
+            raise ScriptError("No program or chip loaded")
+        return self.simulator
+
+    def _run_command(self, words: list[str]):
+        match words:
+            case ["load", *path]:
+                self._load(path[0] if path else "")
+            case ["output-file", filename]:
+                self.output = open(os.path.join(self.outdir, filename), "w")
+            case ["compare-to", filename]:
+                self.compare = open(os.path.join(self.dirpath, filename), "r")
+            case ["output-list", *specs]:
+                self.columns = [parse_output_column(spec) for spec in specs]
+                self._write_line(
+                    "|" + "|".join(format_header(c) for c in self.columns) + "|"
+                )
+            case ["output"]:
+                simulator = self._require_simulator()
+                values = [
+                    format_value(c, simulator.get(c["name"])) for c in self.columns
+                ]
+                self._write_line("|" + "|".join(values) + "|")
+            case ["set", name, value]:
+                self._require_simulator().set(name, parse_value(value))
+            case ["echo", *_] | ["clear-echo"] | ["breakpoint", *_]:
+                pass
+            case ["clear-breakpoints"]:
+                pass
+            case _:
+                self._require_simulator().run_command(words)
+
+    def _load(self, filename: str):
+        path = os.path.join(self.dirpath, filename)
+        ext = os.path.splitext(filename)[1] if filename else ""
+        loader = simulators.get(ext)
+        if loader is None:
+            raise ScriptSkipped(f"No simulator for '{filename or 'load'}'")
+        self.simulator = loader(path, self.cachedir)
+        if self.rows is not None and isinstance(self.simulator, ChipSimulator):
+            self.simulator.evaluate_ahead(self.rows)
+
+    # Output lines are compared with the .cmp file as they are produced,
+    # so a failing script stops at its first wrong line.
+    def _write_line(self, line: str):
+        if self.output is not None:
+            self.output.write(line + "\n")
+        if self.compare is None:
+            return
+        expected = self.compare.readline()
+        self.compared += 1
+        if not expected:
+            raise ComparisonFailure(f"Output line {self.compared} not in compare file")
+        if not lines_match(line, expected):
+            raise ComparisonFailure(
+                f"Comparison failure at line {self.compared}:"
+                f" expected {expected.rstrip()!r}, got {line!r}"
+            )
+
+
+# commands handled by the script itself rather than the simulator
+script_commands = {
+    "load",
+    "output-file",
+    "compare-to",
+    "output-list",
+    "output",
+    "set",
+    "echo",
+    "clear-echo",
+    "breakpoint",
+    "clear-breakpoints",
+}
+
+
+class TestResult(TypedDict):
+    script: str
+    status: Literal["pass", "fail", "error", "skip"]
+    message: str
+    lines: int
+    seconds: float
+
+
+def run_script(
+    tstpath: str, outdir: str | None = None, cachedir: str | None = None
+) -> TestResult:
+    start = time.perf_counter()
+    runner = ScriptRunner(tstpath, outdir, cachedir)
+    status: Literal["pass", "fail", "error", "skip"] = "pass"
+    message = ""
+    try:
+        runner.run()
+    except ComparisonFailure as e:
+        status, message = "fail", str(e)
+    except ScriptSkipped as e:
+        status, message = "skip", str(e)
+    except (
+        ScriptError,
+        NotImplementedError,
+        VMError,
+        OSError,
+        ValueError,
+        KeyError,
+        IndexError,
+    ) as e:
+        status, message = "error", f"{type(e).__name__}: {e}"
+    return {
+        "script": tstpath,
+        "status": status,
+        "message": message,
+        "lines": runner.compared,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+# The input values at each eval of a script that just sets, evaluates and
+# outputs, in which case every eval can be computed before the script runs.
+def _collect_rows(statements: list[Statement]) -> list[dict[str, int]] | None:
+    commands = list(_commands(statements))
+    if len(commands) != len(statements):
+        return None
+    if sum(words[0] == "load" for _, words in commands) != 1:
+        return None
+    inputs: dict[str, int] = {}
+    rows = []
+    for _, words in commands:
+        match words:
+            case ["set", name, value]:
+                inputs[name] = parse_value(value)
+            case ["eval"]:
+                rows.append(dict(inputs))
+            case [command, *_] if command in script_commands:
+                pass
+            case _:
+                return None
+    return rows
+
+
+def _commands(statements: list[Statement]) -> Iterator[Statement]:
+    for statement in statements:
+        if statement[0] == "command":
+            yield statement
+        else:
+            yield from _commands(statement[2])
+
+
+def run_scripts(
+    tstpaths: list[str],
+    jobs: int | None = None,
+    outdir: str | None = None,
+    cachedir: str | None = None,
+) -> Iterator[TestResult]:
+    if jobs == 1 or len(tstpaths) < 2:
+        yield from (run_script(tstpath, outdir, cachedir) for tstpath in tstpaths)
+        return
+    workers = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(run_script, tstpath, outdir, cachedir)
+            for tstpath in tstpaths
+        ]
+        for future in futures:
+            yield future.result()
+
+
+def write_junit(results: list[TestResult], reportpath: str):
+    suite = ET.Element(
+        "testsuite",
+        name="nand2tetris",
+        tests=str(len(results)),
+        failures=str(sum(r["status"] == "fail" for r in results)),
+        errors=str(sum(r["status"] == "error" for r in results)),
+        skipped=str(sum(r["status"] == "skip" for r in results)),
+        time=f"{sum(r['seconds'] for r in results):.3f}",
+    )
+    for result in results:
+        case = ET.SubElement(
+            suite,
+            "testcase",
+            classname=os.path.dirname(result["script"]),
+            name=os.path.basename(result["script"]),
+            time=f"{result['seconds']:.3f}",
+        )
+        if result["status"] == "fail":
+            ET.SubElement(case, "failure", message=result["message"])
+        elif result["status"] == "error":
+            ET.SubElement(case, "error", message=result["message"])
+        elif result["status"] == "skip":
+            ET.SubElement(case, "skipped", message=result["message"])
+    ET.ElementTree(suite).write(reportpath, encoding="utf-8", xml_declaration=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run .tst test scripts")
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        default=[os.path.join(os.path.dirname(__file__), "..", "projects")],
+        help=".tst files, directories (searched recursively) or globs",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of worker processes, defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "--outdir", help="write output files here instead of next to the scripts"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir("hardware"),
+        help="where flattened chips are cached by HDL content hash",
+    )
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--junit", help="write a JUnit XML report to this path")
+    parser.add_argument("--json", help="write a JSON report to this path")
+    args = parser.parse_args()
+
+    tstpaths = find_filepaths(args.paths, "tst")
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+    start = time.perf_counter()
+    results = []
+    cachedir = None if args.no_cache else args.cache_dir
+    for result in run_scripts(tstpaths, args.jobs, args.outdir, cachedir):
+        results.append(result)
+        line = f"{result['status'].upper():5} {result['script']}"
+        line += f" ({result['seconds'] * 1000:.0f} ms)"
+        if result["message"]:
+            line += f": {result['message']}"
+        print(line)
+    elapsed = time.perf_counter() - start
+
+    counts = {
+        status: sum(r["status"] == status for r in results)
+        for status in ["pass", "fail", "error", "skip"]
+    }
+    print(
+        f"{len(results)} scripts in {elapsed:.2f} s: "
+        + ", ".join(f"{count} {status}" for status, count in counts.items())
+    )
+    if args.junit:
+        write_junit(results, args.junit)
+    if args.json:
+        with open(args.json, "w") as w:
+            json.dump(results, w, indent=2)
+    if counts["fail"] or counts["error"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import os
+import shutil
+
+from TestRunner import (
+    format_header,
+    format_value,
+    lines_match,
+    parse_output_column,
+    parse_script,
+    run_script,
+    run_scripts,
+)
+
+projects_dir = os.path.join(os.path.dirname(__file__), "..", "projects")
+
+
+class TestParseScript:
+    def test_parse(self):
+        script = """
+            load Mult.asm, // comment
+            output-list RAM[0]%D2.6.2 RAM[1]%D2.6.2;
+            /* block
+               comment */
+            set RAM[0] %B101,
+            repeat 20 {
+              ticktock;
+            }
+            while out <> 75 { tick, tock; }
+            output;
+        """
+        assert parse_script(script) == [
+            ("command", ["load", "Mult.asm"]),
+            ("command", ["output-list", "RAM[0]%D2.6.2", "RAM[1]%D2.6.2"]),
+            ("command", ["set", "RAM[0]", "%B101"]),
+            ("repeat", 20, [("command", ["ticktock"])]),
+            (
+                "while",
+                ("out", "<>", "75"),
+                [("command", ["tick"]), ("command", ["tock"])],
+            ),
+            ("command", ["output"]),
+        ]
+
+    def test_format(self):
+        column = parse_output_column("x%B1.16.1")
+        assert "|" + format_header(column) + "|" == "|        x         |"
+        assert format_value(column, -1) == " 1111111111111111 "
+        column = parse_output_column("DRegister[]%D1.6.1")
+        assert format_header(column) == "DRegiste"
+        assert format_value(column, -12) == "    -12 "
+        column = parse_output_column("time%S1.4.1")
+        assert format_value(column, "0+") == " 0+   "
+
+    def test_lines_match_wildcards(self):
+        assert lines_match("|  12 |  3 |", "|  12 |  3 |\n")
+        assert lines_match("|  12 |  3 |", "|**** |  3 |")
+        assert not lines_match("|  12 |  3 |", "|  12 |  4 |")
+
+
+class TestRunScript:
+    def test_cpu_scripts(self, tmp_path):
+        tstpaths = [
+            os.path.join(projects_dir, "04", "mult", "Mult.tst"),
+            os.path.join(
+                projects_dir, "07", "StackArithmetic", "StackTest", "StackTest.tst"
+            ),
+            os.path.join(projects_dir, "04", "fill", "Fill.tst"),
+        ]
+        results = list(run_scripts(tstpaths, jobs=2, outdir=str(tmp_path)))
+        assert [r["status"] for r in results] == ["pass", "pass", "skip"]
+        assert results[0]["lines"] == 7
+        with open(tmp_path / "Mult.out") as f:
+            with open(os.path.join(projects_dir, "04", "mult", "Mult.cmp")) as g:
+                assert f.read().rstrip() == g.read().rstrip()
+
+    def test_comparison_failure(self, tmp_path):
+        shutil.copytree(os.path.join(projects_dir, "04", "mult"), tmp_path / "mult")
+        with open(tmp_path / "mult" / "Mult.cmp", "r+") as f:
+            lines = f.readlines()
+            lines[3] = lines[3].replace("0", "1")
+            f.seek(0)
+            f.writelines(lines)
+
+        result = run_script(str(tmp_path / "mult" / "Mult.tst"))
+        assert result["status"] == "fail"
+        assert result["lines"] == 4
+        assert "line 4" in result["message"]
+
+    def test_unsupported_builtin_is_an_error(self, tmp_path):
+        (tmp_path / "Foo.hdl").write_text("CHIP Foo { IN a; OUT out; BUILTIN Foo; }")
+        (tmp_path / "Foo.cmp").write_text("|a|out|\n")
+        (tmp_path / "Foo.tst").write_text(
+            "load Foo.hdl, compare-to Foo.cmp, output-list a out;"
+        )
+        result = run_script(str(tmp_path / "Foo.tst"))
+        assert result["status"] == "error"
+        assert "NotImplementedError" in result["message"]
+
+    def test_endless_while_is_an_error(self, tmp_path):
+        (tmp_path / "Loop.asm").write_text("(LOOP)\n@LOOP\n0;JMP\n")
+        (tmp_path / "Loop.cmp").write_text("")
+        (tmp_path / "Loop.tst").write_text(
+            "load Loop.asm, compare-to Loop.cmp; while RAM[0] = 0 { ticktock; }"
+        )
+        result = run_script(str(tmp_path / "Loop.tst"))
+        assert result["status"] == "error"
+        assert "didn't end" in result["message"]
+
+    def test_jack_only_directory_is_skipped(self, tmp_path):
+        shutil.copytree(
+            os.path.join(projects_dir, "12", "ArrayTest"), tmp_path / "ArrayTest"
+        )
+        result = run_script(str(tmp_path / "ArrayTest" / "ArrayTest.tst"))
+        assert result["status"] == "skip"
+        assert "No .vm files" in result["message"]
@@ -0,0 +1,409 @@
+import argparse
+import time
+from array import array
+from typing import TypedDict
+
+from CPUEmulator import RAM_SIZE, to_word
+from utils import find_filepaths
+from vmcode import Program, VMError, read_os, read_program
+from vmos import NativeOS, bind_natives, native_classes
+
+# opcodes, each VM command is (opcode, a, b) in the code array
+PUSH_CONSTANT = 0  # a value
+PUSH_SEGMENT = 1  # a address of the segment pointer, b index
+PUSH_FIXED = 2  # a address, for temp, pointer and static
+POP_SEGMENT = 3
+POP_FIXED = 4
+ADD = 5
+SUB = 6
+NEG = 7
+EQ = 8
+GT = 9
+LT = 10
+AND = 11
+OR = 12
+NOT = 13
+GOTO = 14  # a target
+IF_GOTO = 15
+FUNCTION = 16  # a number of locals
+CALL = 17  # a target, b number of arguments
+NATIVE = 18  # a index into natives, b number of arguments
+RETURN = 19
+
+arithmetic_opcodes = {
+    "add": ADD,
+    "sub": SUB,
+    "neg": NEG,
+    "eq": EQ,
+    "gt": GT,
+    "lt": LT,
+    "and": AND,
+    "or": OR,
+    "not": NOT,
+}
+
+segment_pointers = {"local": 1, "argument": 2, "this": 3, "that": 4}
+fixed_segments = {"pointer": 3, "temp": 5}
+
+STATIC_BASE = 16
+STACK_BASE = 256
+
+
+class LinkedProgram(TypedDict):
+    code: array
+    functions: dict[str, int]
+    natives: list[str]
+    # files in link order, OS files pulled in included
+    classes: list[str]
+    entry: int
+    # start of a VM coded Sys.halt, calling it halts
+    halt: int
+
+
+def _class_name(function: str) -> str:
+    return function.split(".")[0]
+
+
+# Functions defined in the program come first, then native OS functions
+# when enabled, then the OS .vm files, which are only linked in when the
+# program calls something they define.
+def link(
+    program: Program, native: bool = False, os_program: Program | None = None
+) -> LinkedProgram:
+    files = dict(program)
+    os_program = read_os() if os_program is None else os_program
+    natives = {
+        f"{cls}.{name}" for cls, names in native_classes.items() for name in names
+    }
+
+    def defined() -> dict[str, str]:
+        return {
+            command.arg1: cls
+            for cls, commands in files.items()
+            for command in commands
+            if command.op == "function"
+        }
+
+    def user_or_native(name: str) -> bool:
+        return name in user_functions or (native and name in natives)
+
+    user_functions = defined()
+    while True:
+        functions = defined()
+        called = {
+            command.arg1
+            for commands in files.values()
+            for command in commands
+            if command.op == "call"
+        }
+        if "Main.main" in functions:
+            # like the Java emulator, a program without Sys.init gets the OS one
+            called.add("Sys.init")
+        missing = {
+            name
+            for name in called
+            if name not in functions and not user_or_native(name)
+        }
+        if not missing:
+            break
+        name = min(missing)
+        cls = _class_name(name)
+        if cls in files or cls not in os_program:
+            raise VMError(f"Function {name} not found")
+        files[cls] = os_program[cls]
+
+    # first pass for the targets, labels are scoped by file and function
+    # and aren't instructions, as steps in the Java emulator don't count them
+    targets: dict[str, int] = {}
+    labels: dict[tuple[str, str, str], int] = {}
+    index = 0
+    for cls, commands in files.items():
+        function = ""
+        for command in commands:
+            if command.op == "function":
+                function = command.arg1
+                if command.arg1 in targets:
+                    raise VMError(f"Function {command.arg1} defined twice")
+                targets[command.arg1] = index
+            elif command.op == "label":
+                labels[(cls, function, command.arg1)] = index
+                continue
+            index += 1
+
+    code = array("i")
+    native_names: list[str] = []
+    static_base = STATIC_BASE
+    for cls, commands in files.items():
+        function = ""
+        statics = 0
+        for command in commands:
+            op, arg1, arg2 = command
+            if op == "function":
+                function = arg1
+            match op:
+                case "push" | "pop" if arg1 == "constant":
+                    if op == "pop":
+                        raise VMError(f"Can't pop to constant in {cls}")
+                    code.extend((PUSH_CONSTANT, arg2, 0))
+                case "push" | "pop" if arg1 in segment_pointers:
+                    opcode = PUSH_SEGMENT if op == "push" else POP_SEGMENT
+                    code.extend((opcode, segment_pointers[arg1], arg2))
+                case "push" | "pop":
+                    if arg1 == "static":
+                        address = static_base + arg2
+                        statics = max(statics, arg2 + 1)
+                    elif arg1 in fixed_segments:
+                        address = fixed_segments[arg1] + arg2
+                    else:
+                        raise VMError(f"Unknown segment {arg1} in {cls}")
+                    opcode = PUSH_FIXED if op == "push" else POP_FIXED
+                    code.extend((opcode, address, 0))
+                case "label":
+                    pass
+                case "goto" | "if-goto":
+                    target = labels.get((cls, function, arg1))
+                    if target is None:
+                        raise VMError(f"Label {arg1} not found in {function or cls}")
+                    code.extend((GOTO if op == "goto" else IF_GOTO, target, 0))
+                case "function":
+                    code.extend((FUNCTION, arg2, 0))
+                case "call" if arg1 in user_functions or not user_or_native(arg1):
+                    code.extend((CALL, targets[arg1], arg2))
+                case "call":
+                    if arg1 not in native_names:
+                        native_names.append(arg1)
+                    code.extend((NATIVE, native_names.index(arg1), arg2))
+                case "return":
+                    code.extend((RETURN, 0, 0))
+                case _:
+                    code.extend((arithmetic_opcodes[op], 0, 0))
+        static_base += statics
+
+    halt = targets.get("Sys.halt", -1) if not native else -1
+    return {
+        "code": code,
+        "functions": targets,
+        "natives": native_names,
+        "classes": list(files),
+        "entry": targets.get("Sys.init", 0),
+        "halt": halt,
+    }
+
+
+def _wrap(value: int) -> int:
+    if value > 32767:
+        return value - 65536
+    if value < -32768:
+        return value + 65536
+    return value
+
+
+class VM:
+    def __init__(self, program: LinkedProgram):
+        self.program = program
+        self.code = program["code"]
+        # return addresses are stored in the 16 bit RAM, unsigned
+        if len(self.code) // 3 > 65535:
+            raise VMError(f"Program of {len(self.code) // 3} commands is too large")
+        self.ram = array("h", bytes(2 * RAM_SIZE))
+        self.native = NativeOS(self.ram)
+        bound = bind_natives(self.native)
+        self.natives = [bound[name] for name in program["natives"]]
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+        self.reset()
+
+    @classmethod
+    def from_paths(cls, paths: list[str], native: bool = False) -> "VM":
+        filepaths = find_filepaths(paths, "vm")
+        if not filepaths:
+            raise VMError(f"No .vm files in {', '.join(paths)}")
+        return cls(link(read_program(filepaths), native))
+
+    def reset(self):
+        self.ram[:] = array("h", bytes(2 * RAM_SIZE))
+        self.ram[0] = STACK_BASE
+        self.native.__init__(self.ram)
+        self.pc = self.program["entry"]
+        self.steps = 0
+        self.halted = False
+
+    def step(self) -> int:
+        return self.run(1)
+
+    # Runs until halted or max_steps VM commands, returning the steps run.
+    # Halting is running past the last command, a goto to itself, calling
+    # Sys.halt or a native OS error.
+    def run(self, max_steps: int | None = None) -> int:
+        code = self.code
+        ram = self.ram
+        natives = self.natives
+        native = self.native
+        halt = self.program["halt"]
+        end = len(code) // 3
+        pc = self.pc
+        sp = ram[0]
+        limit = -1 if max_steps is None else max_steps
+        steps = 0
+        halted = self.halted
+
+        while steps != limit and not halted:
+            if pc >= end:
+                halted = True
+                break
+            i = 3 * pc
+            op = code[i]
+            steps += 1
+            if op == PUSH_CONSTANT:
+                ram[sp] = code[i + 1]
+                sp += 1
+                pc += 1
+            elif op == PUSH_SEGMENT:
+                ram[sp] = ram[ram[code[i + 1]] + code[i + 2]]
+                sp += 1
+                pc += 1
+            elif op == POP_SEGMENT:
+                sp -= 1
+                ram[ram[code[i + 1]] + code[i + 2]] = ram[sp]
+                pc += 1
+            elif op == PUSH_FIXED:
+                ram[sp] = ram[code[i + 1]]
+                sp += 1
+                pc += 1
+            elif op == POP_FIXED:
+                sp -= 1
+                ram[code[i + 1]] = ram[sp]
+                pc += 1
+            elif op == ADD:
+                sp -= 1
+                ram[sp - 1] = _wrap(ram[sp - 1] + ram[sp])
+                pc += 1
+            elif op == SUB:
+                sp -= 1
+                ram[sp - 1] = _wrap(ram[sp - 1] - ram[sp])
+                pc += 1
+            elif op == IF_GOTO:
+                sp -= 1
+                pc = code[i + 1] if ram[sp] else pc + 1
+            elif op == GOTO:
+                if code[i + 1] == pc:
+                    halted = True
+                pc = code[i + 1]
+            elif op == EQ:
+                sp -= 1
+                ram[sp - 1] = -1 if ram[sp - 1] == ram[sp] else 0
+                pc += 1
+            elif op == GT:
+                sp -= 1
+                ram[sp - 1] = -1 if ram[sp - 1] > ram[sp] else 0
+                pc += 1
+            elif op == LT:
+                sp -= 1
+                ram[sp - 1] = -1 if ram[sp - 1] < ram[sp] else 0
+                pc += 1
+            elif op == NOT:
+                ram[sp - 1] = ~ram[sp - 1]
+                pc += 1
+            elif op == AND:
+                sp -= 1
+                ram[sp - 1] &= ram[sp]
+                pc += 1
+            elif op == OR:
+                sp -= 1
+                ram[sp - 1] |= ram[sp]
+                pc += 1
+            elif op == NEG:
+                ram[sp - 1] = _wrap(-ram[sp - 1])
+                pc += 1
+            elif op == NATIVE:
+                count = code[i + 2]
+                args = ram[sp - count : sp]
+                sp -= count
+                ram[0] = sp
+                ram[sp] = to_word(natives[code[i + 1]](*args))
+                sp += 1
+                pc += 1
+                halted = native.halted
+            elif op == CALL:
+                if code[i + 1] == halt:
+                    halted = True
+                    steps -= 1
+                    break
+                ram[sp] = _wrap(pc + 1)
+                ram[sp + 1] = ram[1]
+                ram[sp + 2] = ram[2]
+                ram[sp + 3] = ram[3]
+                ram[sp + 4] = ram[4]
+                ram[2] = sp - code[i + 2]
+                sp += 5
+                ram[1] = sp
+                pc = code[i + 1]
+            elif op == FUNCTION:
+                for _ in range(code[i + 1]):
+                    ram[sp] = 0
+                    sp += 1
+                pc += 1
+            elif op == RETURN:
+                frame = ram[1]
+                pc = ram[frame - 5] & 0xFFFF
+                ram[ram[2]] = ram[sp - 1]
+                sp = ram[2] + 1
+                ram[4] = ram[frame - 1]
+                ram[3] = ram[frame - 2]
+                ram[2] = ram[frame - 3]
+                ram[1] = ram[frame - 4]
+            else:
+                raise VMError(f"Unknown opcode {op} at {pc}")
+
+        ram[0] = sp
+        self.pc = pc
+        self.steps += steps
+        self.halted = halted
+        return steps
+
+    @property
+    def console(self) -> str:
+        return "".join(self.native.console)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run VM programs")
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        help=".vm files, directories (searched recursively) or globs",
+    )
+    parser.add_argument(
+        "--native-os",
+        action="store_true",
+        help="run OS functions not defined by the program natively",
+    )
+    parser.add_argument("--max-steps", type=int, default=None)
+    parser.add_argument(
+        "--dump",
+        default="0:16",
+        metavar="START:END",
+        help="RAM range to print after running",
+    )
+    args = parser.parse_args()
+
+    vm = VM.from_paths(args.paths, args.native_os)
+    start = time.perf_counter()
+    steps = vm.run(args.max_steps)
+    elapsed = time.perf_counter() - start
+
+    status = "halted" if vm.halted else "stopped"
+    print(
+        f"{status} after {steps} VM commands in {elapsed:.2f} s"
+        f" ({steps / max(elapsed, 1e-9) / 1e6:.2f}M commands/s)"
+    )
+    if vm.console:
+        print(vm.console)
+    dump_start, dump_end = (int(x) for x in args.dump.split(":"))
+    for address in range(dump_start, dump_end):
+        print(f"RAM[{address}] = {vm.ram[address]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import glob
+import os
+from array import array
+
+import pytest
+from CPUEmulator import RAM_SIZE
+from TestRunner import run_script
+from VMEmulator import VM, link
+from vmcode import VMError, parse_vm
+from vmos import SCREEN, NativeOS
+
+projects_dir = os.path.join(os.path.dirname(__file__), "..", "projects")
+
+
+def run_vm(text: str, native: bool = False) -> VM:
+    vm = VM(link({"Main": parse_vm(text)}, native))
+    vm.run(100000)
+    return vm
+
+
+class TestVM:
+    def test_arithmetic_wraps(self):
+        vm = run_vm(
+            """
+            push constant 32767
+            push constant 1
+            add
+            push constant 5
+            push constant 9
+            lt
+            """
+        )
+        assert vm.halted
+        assert list(vm.ram[256:258]) == [-32768, -1]
+
+    def test_labels_are_scoped_by_function(self):
+        vm = run_vm(
+            """
+            function Main.start 0
+            call Main.one 0
+            call Main.two 0
+            add
+            pop static 0
+            label END
+            goto END
+            function Main.one 0
+            goto END
+            label END
+            push constant 1
+            return
+            function Main.two 0
+            goto END
+            label END
+            push constant 2
+            return
+            """
+        )
+        assert vm.ram[16] == 3
+
+    def test_no_vm_files(self, tmp_path):
+        (tmp_path / "Main.jack").write_text("class Main {}")
+        with pytest.raises(VMError, match="No .vm files"):
+            VM.from_paths([str(tmp_path)])
+
+    def test_return_address_over_32767(self):
+        program = {
+            "Sys": parse_vm(
+                "function Sys.init 0\n"
+                + "push constant 1\npop temp 0\n" * 17000
+                + "call Sys.seven 0\npop temp 1\nlabel END\ngoto END\n"
+                "function Sys.seven 0\npush constant 7\nreturn\n"
+            )
+        }
+        vm = VM(link(program))
+        vm.run(40000)
+        assert vm.halted and vm.ram[6] == 7
+
+    def test_unknown_function(self):
+        with pytest.raises(VMError, match="Main.nope"):
+            link({"Main": parse_vm("call Main.nope 0")})
+
+
+class TestNativeOS:
+    def test_same_screen_as_vm_os(self):
+        seven = os.path.join(projects_dir, "11", "Seven")
+        native = VM.from_paths([seven], native=True)
+        native.run()
+        vm = VM.from_paths([seven])
+        vm.run()
+        assert native.halted and vm.halted
+        assert native.console == "7"
+        assert native.steps < vm.steps
+        assert native.ram[SCREEN:] == vm.ram[SCREEN:]
+        assert any(native.ram[SCREEN:])
+
+    def test_math_and_strings(self):
+        native = NativeOS(array("h", bytes(2 * RAM_SIZE)))
+        assert native.math_divide(-7, 2) == -3
+        assert native.math_multiply(300, 300) == 24464
+        assert native.math_sqrt(32767) == 181
+        s = native.string_new(6)
+        native.string_setInt(s, -1234)
+        assert native.string_chars(s) == "-1234"
+        assert native.string_intValue(s) == -1234
+        native.math_divide(1, 0)
+        assert native.halted and native.console == ["ERR3"]
+
+    def test_memory_reuses_freed_blocks(self):
+        native = NativeOS(array("h", bytes(2 * RAM_SIZE)))
+        a = native.memory_alloc(10)
+        b = native.memory_alloc(10)
+        native.memory_deAlloc(a)
+        native.memory_deAlloc(b)
+        assert native.memory_alloc(20) == a
+
+
+@pytest.mark.parametrize(
+    "tstpath",
+    sorted(glob.glob(os.path.join(projects_dir, "0[78]", "*", "*", "*VME.tst"))),
+    ids=lambda tstpath: os.path.basename(tstpath),
+)
+def test_project_scripts(tstpath, tmp_path):
+    result = run_script(tstpath, str(tmp_path))
+    assert result["status"] == "pass", result["message"]
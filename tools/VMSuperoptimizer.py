@@ -0,0 +1,246 @@
+import argparse
+import itertools
+import random
+import time
+from collections import Counter
+from collections.abc import Iterable
+from functools import cache
+
+from Assembler import comp_codes, encode_c_instruction, iter_code_lines
+from Assembler import predefined_symbols
+from CPUEmulator import alu_ops, to_word
+from hackopt import peephole
+from utils import find_filepaths
+from VMTranslator import translate_file
+from vmcode import Command, os_dir, read_vm_file
+from vmpatterns import (
+    MAX_PATTERN_LENGTH,
+    default_patterns_path,
+    format_pattern,
+    write_patterns,
+)
+
+# Offline search for the shortest Hack code for common VM command
+# sequences. The translator's code for a sequence is the reference, and
+# windows of it are replaced by shorter instruction sequences for as long
+# as the result still leaves the same RAM on a set of random states. The
+# results go into the pattern table the translator loads.
+
+straight_line_ops = {"add", "sub", "neg", "and", "or", "not"}
+
+
+# Patterns are straight line code without statics, which are named by
+# file, so their code is the same wherever they're used.
+def _patternable(command: Command) -> bool:
+    if command.op in ("push", "pop"):
+        return command.arg1 != "static"
+    return command.op in straight_line_ops
+
+
+def count_sequences(
+    files: Iterable[list[Command]],
+) -> Counter[tuple[Command, ...]]:
+    counts: Counter[tuple[Command, ...]] = Counter()
+    for commands in files:
+        for length in range(2, MAX_PATTERN_LENGTH + 1):
+            for i in range(len(commands) - length + 1):
+                sequence = tuple(commands[i : i + length])
+                if all(map(_patternable, sequence)):
+                    counts[sequence] += 1
+    return counts
+
+
+# RAM of a random machine state. Cells are filled with pseudo-random
+# values as they're first read, the same for every run from the state.
+class Memory(dict):
+    def __init__(self, seed: int, cells: dict[int, int]):
+        super().__init__(cells)
+        self.seed = seed
+
+    def __missing__(self, address: int) -> int:
+        value = self[address] = to_word((address * 2654435761 ^ self.seed) >> 8)
+        return value
+
+    def copy(self) -> "Memory":
+        return Memory(self.seed, self)
+
+
+# States with the stack in 256-2047 and the locals and arguments below SP.
+# THIS and THAT are in the heap, and in some states equal, next to each
+# other, over the arguments or over the top of the stack, so code relying
+# on them not aliasing doesn't pass.
+def random_states(count: int, seed: int = 0) -> list[Memory]:
+    rng = random.Random(seed)
+    states = []
+    for i in range(count):
+        sp = rng.randrange(400, 1900)
+        lcl = sp - rng.randrange(8, 16)
+        arg = lcl - 5 - rng.randrange(8, 12)
+        this = rng.randrange(2048, 16000)
+        that = [
+            rng.randrange(2048, 16000),
+            this,
+            this + 1,
+            sp - rng.randrange(1, 4),
+        ][i % 4]
+        if i % 5 == 4:
+            this = arg
+        cells = {0: sp, 1: lcl, 2: arg, 3: this, 4: that}
+        # edge values on top of the stack
+        if i % 3 == 0:
+            for offset in range(1, 5):
+                cells[sp - offset] = rng.choice([0, 1, -1, 32767, -32768])
+        states.append(Memory(rng.getrandbits(32), cells))
+    return states
+
+
+@cache
+def _compile(line: str) -> tuple:
+    if line[0] == "@":
+        symbol = line[1:]
+        return (int(symbol) if symbol.isdigit() else predefined_symbols[symbol],)
+    word = encode_c_instruction(line)
+    return ((word >> 12) & 1, alu_ops[(word >> 6) & 0b111111], (word >> 3) & 0b111)
+
+
+# A and D start out as garbage too
+def run(code: list[str], state: Memory) -> Memory:
+    ram = state.copy()
+    a, d = to_word(state.seed), to_word(state.seed >> 16)
+    for line in code:
+        instruction = _compile(line)
+        if len(instruction) == 1:
+            a = instruction[0]
+            continue
+        use_m, alu, dest = instruction
+        out = alu(d, ram[a & 0x7FFF] if use_m else a)
+        if dest & 0b001:
+            ram[a & 0x7FFF] = out
+        if dest & 0b010:
+            d = out
+        if dest & 0b100:
+            a = out
+    return ram
+
+
+# A and D aren't kept between VM commands, R13-R15 are scratch and the
+# stack past SP is never read.
+def equivalent(expected: Memory, result: Memory) -> bool:
+    sp = expected[0]
+    if result[0] != sp:
+        return False
+    for address in expected.keys() | result.keys():
+        if 13 <= address <= 15 or sp <= address < 2048:
+            continue
+        if expected[address] != result[address]:
+            return False
+    return True
+
+
+def instruction_set(reference: list[str]) -> list[str]:
+    addresses = sorted({line for line in reference if line[0] == "@"} | {"@SP"})
+    # comps without their commuted forms
+    comps = {code: comp for comp, code in reversed(comp_codes.items())}.values()
+    dests = ["A", "D", "M", "AM", "AD", "MD", "AMD"]
+    return addresses + [f"{dest}={comp}" for dest in dests for comp in comps]
+
+
+def reference_code(commands: tuple[Command, ...]) -> list[str]:
+    return list(iter_code_lines(translate_file(list(commands), "Pattern").splitlines()))
+
+
+# Starts from the peephole optimized reference and replaces any window of
+# up to max_window instructions with up to one less, until none can be.
+def superoptimize(
+    commands: tuple[Command, ...], states: list[Memory], max_window: int = 3
+) -> list[str]:
+    reference = reference_code(commands)
+    expected = [run(reference, state) for state in states]
+
+    def correct(code: list[str]) -> bool:
+        return all(
+            equivalent(result, run(code, state))
+            for result, state in zip(expected, states)
+        )
+
+    best = peephole(reference)
+    if not correct(best):
+        best = reference
+    candidates = instruction_set(reference)
+    improved = True
+    while improved:
+        improved = False
+        for width, start in (
+            (width, start)
+            for width in range(1, max_window + 1)
+            for start in range(len(best) - width + 1)
+        ):
+            for length in range(width):
+                for replacement in itertools.product(candidates, repeat=length):
+                    code = best[:start] + list(replacement) + best[start + width :]
+                    if correct(code):
+                        best = code
+                        improved = True
+                        break
+                if improved:
+                    break
+            if improved:
+                break
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Search for the shortest Hack code for common VM sequences"
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        default=[os_dir],
+        help=".vm files, directories or globs to count sequences in,"
+        " defaults to the OS",
+    )
+    parser.add_argument(
+        "--top", type=int, default=24, help="number of most used sequences to search"
+    )
+    parser.add_argument(
+        "--max-window",
+        type=int,
+        default=3,
+        help="longest run of instructions replaced at once",
+    )
+    parser.add_argument(
+        "--tests", type=int, default=64, help="random states code is checked on"
+    )
+    parser.add_argument(
+        "--output", default=default_patterns_path, help="pattern table to write"
+    )
+    args = parser.parse_args()
+
+    files = [read_vm_file(path) for path in find_filepaths(args.paths, "vm")]
+    states = random_states(args.tests)
+    patterns = []
+    for commands, uses in count_sequences(files).most_common(args.top):
+        start = time.perf_counter()
+        code = superoptimize(commands, states, args.max_window)
+        template_words = len(reference_code(commands))
+        elapsed = time.perf_counter() - start
+        print(
+            f"{'; '.join(format_pattern(commands))}: used {uses} times,"
+            f" {template_words} -> {len(code)} words in {elapsed:.1f} s"
+        )
+        if len(code) < template_words:
+            patterns.append(
+                {
+                    "vm": format_pattern(commands),
+                    "hack": code,
+                    "uses": uses,
+                    "template_words": template_words,
+                }
+            )
+    write_patterns(patterns, args.output)
+    print(f"Wrote {len(patterns)} patterns to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import json
+from array import array
+
+import pytest
+from Assembler import assemble
+from CPUEmulator import HackCPU
+from VMSuperoptimizer import (
+    count_sequences,
+    equivalent,
+    random_states,
+    reference_code,
+    run,
+    superoptimize,
+)
+from vmcode import parse_vm
+from vmpatterns import load_patterns, write_patterns
+
+
+def test_count_sequences():
+    commands = parse_vm("push local 0\npush static 1\nadd\npush local 0\npush static 1")
+    counts = count_sequences([commands, parse_vm("push local 0\npop pointer 1")])
+    assert counts[tuple(parse_vm("push local 0\npop pointer 1"))] == 1
+    # sequences with statics or of one command aren't counted
+    assert set(map(len, counts)) == {2}
+
+
+def test_equivalent():
+    states = random_states(8)
+    commands = tuple(parse_vm("push constant 0\npush constant 0"))
+    reference = reference_code(commands)
+    for state in states:
+        assert equivalent(run(reference, state), run(reference, state))
+    # without the last SP increment
+    assert not equivalent(run(reference, states[0]), run(reference[:-2], states[0]))
+
+
+def test_superoptimize():
+    commands = tuple(parse_vm("push constant 0\npush constant 0"))
+    reference = reference_code(commands)
+    code = superoptimize(commands, random_states(16), max_window=2)
+    assert len(code) < len(reference) // 2 + 1
+
+    # and it leaves the same RAM on the CPU
+    def cpu_ram(code: list[str]) -> list[int]:
+        cpu = HackCPU(assemble(code))
+        cpu.ram[0:5] = array("h", [300, 290, 280, 3000, 3010])
+        cpu.run(len(code))
+        return list(cpu.ram[0:16]) + list(cpu.ram[256:302])
+
+    assert cpu_ram(code) == cpu_ram(reference)
+
+
+def test_pattern_table(tmp_path):
+    path = str(tmp_path / "patterns.json")
+    write_patterns(
+        [
+            {
+                "vm": ["push constant 0", "push constant 0"],
+                "hack": ["@SP", "M=M+1"],
+                "uses": 2,
+                "template_words": 14,
+            }
+        ],
+        path,
+    )
+    patterns = load_patterns(path)
+    assert patterns == {
+        tuple(parse_vm("push constant 0\npush constant 0")): "@SP\nM=M+1\n"
+    }
+
+    with open(path) as f:
+        table = json.load(f)
+    table["version"] = 0
+    with open(path, "w") as w:
+        json.dump(table, w)
+    with pytest.raises(ValueError, match="version"):
+        load_patterns(path)
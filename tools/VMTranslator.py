@@ -1,23 +1,34 @@
-import re
-import sys
+import argparse
+import os
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+from collections.abc import Iterator
 from enum import Enum
+from functools import partial
 from textwrap import dedent
-from typing import Literal
+from typing import Literal, NamedTuple
 
-from utils import (
-    get_asm_filepath_from_path,
-    get_filename_no_ext,
-    get_filepath_with_ext,
-    get_vm_filepaths,
+from Assembler import assemble, iter_code_lines, write_hack
+from buildcache import BuildCache, default_cache_dir
+from CPUEmulator import ROM_SIZE
+from hackopt import PeepholeReport, peephole
+from utils import get_asm_filepath_from_path, get_filepath_with_ext, get_vm_filepaths
+from vmcode import Command, Program, format_command, parse_vm, read_os, read_program
+from vmpatterns import MAX_PATTERN_LENGTH, PatternTable, default_patterns
+from vmopt import (
+    DEFAULT_INLINE_BUDGET,
+    InlineReport,
+    OptimizeReport,
+    TailCallReport,
+    eliminate_dead_functions,
+    eliminate_tail_calls,
+    inline_functions,
+    optimize,
 )
 
 
-def read_file_lines(filepath: str) -> list[str]:
-    code_matcher = re.compile("^\\s*(?!/)(.+)$", re.MULTILINE)
-    with open(filepath, "r") as f:
-        return code_matcher.findall(f.read())
-
-
 class CommandType(Enum):
     C_ARITHMETIC = 0
     C_PUSH = 1
@@ -30,186 +41,221 @@ class CommandType(Enum):
     C_CALL = 8
 
 
-def get_command_type(line: str) -> CommandType:
-    if line.startswith("push"):
-        return CommandType.C_PUSH
-    elif line.startswith("pop"):
-        return CommandType.C_POP
-    elif line.startswith("label"):
-        return CommandType.C_LABEL
-    elif line.startswith("goto"):
-        return CommandType.C_GOTO
-    elif line.startswith("if-goto"):
-        return CommandType.C_IF
-    elif line.startswith("function"):
-        return CommandType.C_FUNCTION
-    elif line.startswith("return"):
-        return CommandType.C_RETURN
-    elif line.startswith("call"):
-        return CommandType.C_CALL
-    else:
-        return CommandType.C_ARITHMETIC
+# Code is generated from templates dedented once, here, and filled in with
+# str.format, so translating is mostly dict lookups and joins.
 
+arithmetic_code = (
+    {
+        op: dedent(
+            f"""\
+        @SP
+        M=M-1
+        A=M
+        D=M
+        A=A-1
+        M={comp}
+        """
+        )
+        for op, comp in {"add": "M+D", "sub": "M-D", "and": "M&D", "or": "M|D"}.items()
+    }
+    | {
+        op: dedent(
+            f"""\
+        @SP
+        A=M-1
+        M={comp}
+        """
+        )
+        for op, comp in {"neg": "-M", "not": "!M"}.items()
+    }
+)
 
-def get_arg1(line: str) -> str:
-    if get_command_type(line) == CommandType.C_ARITHMETIC:
-        return line
-    else:
-        return line.split(" ")[1]
+# {0} is where eq, gt and lt come back to from TRUE or FALSE
+comparison_templates = {
+    op: dedent(
+        f"""\
+        @{{0}}
+        D=A
+        @RET
+        M=D
+        @SP
+        M=M-1
+        A=M
+        D=M
+        @SP
+        M=M-1
+        A=M
+        D=M-D
+        @TRUE
+        D;{jump}
+        @FALSE
+        0;JMP
+        ({{0}})
+        @SP
+        M=M+1
+        """
+    )
+    for op, jump in {"eq": "JEQ", "lt": "JLT", "gt": "JGT"}.items()
+}
 
 
-def get_arg2(line: str) -> int:
-    return int(line.split(" ")[2])
+# Branch-minimal inline comparisons for speed. The result is written as
+# true first and only overwritten when the comparison fails. {0} labels
+# the end.
+inline_comparison_templates = {
+    op: dedent(
+        f"""\
+        @SP
+        AM=M-1
+        D=M
+        A=A-1
+        D=M-D
+        M=-1
+        @{{0}}
+        D;{jump}
+        @SP
+        A=M-1
+        M=0
+        ({{0}})
+        """
+    )
+    for op, jump in {"eq": "JEQ", "lt": "JLT", "gt": "JGT"}.items()
+}
 
+# For size, call sites jump to a routine per comparison with the return
+# address in D
+routine_comparison_templates = {
+    op: f"@{{0}}\nD=A\n@COMPARE_{op.upper()}\n0;JMP\n({{0}})\n"
+    for op in ("eq", "lt", "gt")
+}
 
-jmpindex = 0
 
+def write_comparison_routine(op: str):
+    name = f"COMPARE_{op.upper()}"
+    return (
+        f"({name})\n@R15\nM=D\n"
+        + inline_comparison_templates[op].format(f"{name}.end")
+        + "@R15\nA=M\n0;JMP\n"
+    )
 
-def write_arithmetic(command: str):
-    global jmpindex
-    jmpindex += 1
 
-    if command == "add":
-        return dedent(
-            """\
-            @SP
-            M=M-1
-            A=M
-            D=M
-            A=A-1
-            M=M+D
-            """
-        )
-    elif command == "sub":
-        return dedent(
-            """\
-            @SP
-            M=M-1
-            A=M
-            D=M
-            A=A-1
-            M=M-D
-            """
-        )
-    elif command == "neg":
-        return dedent(
-            """\
-            @SP
-            A=M-1
-            M=-M
-            """
-        )
-    elif command == "eq":
-        return dedent(
-            f"""\
-            @RET{jmpindex}
-            D=A
-            @RET
-            M=D
-            @SP
-            M=M-1
-            A=M
-            D=M
-            @SP
-            M=M-1
-            A=M
-            D=M-D
-            @TRUE
-            D;JEQ
-            @FALSE
-            0;JMP
-            (RET{jmpindex})
-            @SP
-            M=M+1
-            """
-        )
-    elif command == "lt":
-        return dedent(
+ComparisonForm = Literal["jump", "inline", "routine"]
+
+comparison_form_templates: dict[ComparisonForm, dict[str, str]] = {
+    "jump": comparison_templates,
+    "inline": inline_comparison_templates,
+    "routine": routine_comparison_templates,
+}
+
+
+class ComparisonCost(NamedTuple):
+    # words at each comparison
+    words: int
+    # words shared by all the comparisons using the form
+    shared_words: int
+    # cycles for a comparison, the slower of true and false
+    cycles: int
+
+
+# The same for eq, lt and gt, the forms only differ in their jump
+comparison_costs: dict[ComparisonForm, ComparisonCost] = {
+    "jump": ComparisonCost(words=18, shared_words=12, cycles=24),
+    "inline": ComparisonCost(words=11, shared_words=0, cycles=11),
+    "routine": ComparisonCost(words=4, shared_words=16, cycles=20),
+}
+
+
+# return_label is where eq, gt and lt come back to from TRUE or FALSE
+def write_arithmetic(command: str, return_label: str = ""):
+    if command in arithmetic_code:
+        return arithmetic_code[command]
+    if command in comparison_templates:
+        return comparison_templates[command].format(return_label)
+    raise ValueError(f"Unknown arithmetic command {command}")
+
+
+location_names = {
+    "local": "LCL",
+    "argument": "ARG",
+    "this": "THIS",
+    "that": "THAT",
+}
+
+push_d_code = dedent(
+    """\
+    @SP
+    A=M
+    M=D
+    @SP
+    M=M+1
+    """
+)
+
+# {0} is the index for constants and the segments addressed through a
+# pointer, otherwise the address
+push_templates = {
+    "constant": "@{0}\nD=A\n" + push_d_code,
+    **{
+        segment: dedent(
             f"""\
-            @RET{jmpindex}
+            @{{0}}
             D=A
-            @RET
-            M=D
-            @SP
-            M=M-1
-            A=M
+            @{location}
+            A=M+D
             D=M
-            @SP
-            M=M-1
-            A=M
-            D=M-D
-            @TRUE
-            D;JLT
-            @FALSE
-            0;JMP
-            (RET{jmpindex})
-            @SP
-            M=M+1
             """
         )
-    elif command == "gt":
-        return dedent(
+        + push_d_code
+        for segment, location in location_names.items()
+    },
+    **{
+        segment: "@{0}\nD=M\n" + push_d_code
+        for segment in ("pointer", "temp", "static")
+    },
+}
+
+pop_d_code = dedent(
+    """\
+    @R13
+    M=D
+    @SP
+    M=M-1
+    A=M
+    D=M
+    @R13
+    A=M
+    M=D
+    """
+)
+
+pop_templates = {
+    **{
+        segment: dedent(
             f"""\
-            @RET{jmpindex}
+            @{{0}}
             D=A
-            @RET
-            M=D
-            @SP
-            M=M-1
-            A=M
-            D=M
-            @SP
-            M=M-1
-            A=M
-            D=M-D
-            @TRUE
-            D;JGT
-            @FALSE
-            0;JMP
-            (RET{jmpindex})
-            @SP
-            M=M+1
-            """
-        )
-    elif command == "and":
-        return dedent(
-            """\
-            @SP
-            M=M-1
-            A=M
-            D=M
-            A=A-1
-            M=M&D
-            """
-        )
-    elif command == "or":
-        return dedent(
-            """\
-            @SP
-            M=M-1
-            A=M
-            D=M
-            A=A-1
-            M=M|D
-            """
-        )
-    elif command == "not":
-        return dedent(
-            """\
-            @SP
-            A=M-1
-            M=!M
+            @{location}
+            D=M+D
             """
         )
-    raise ValueError(f"Unknown arithmetic command {command}")
+        + pop_d_code
+        for segment, location in location_names.items()
+    },
+    **{
+        segment: "@{0}\nD=A\n" + pop_d_code for segment in ("pointer", "temp", "static")
+    },
+}
 
 
-location_names = {
-    "local": "LCL",
-    "argument": "ARG",
-    "this": "THIS",
-    "that": "THAT",
-}
+def _operand(segment: str, index: int, filename: str | None) -> str | int:
+    match segment:
+        case "pointer":
+            return "THIS" if index == 0 else "THAT"
+        case "temp":
+            return 5 + index
+        case "static":
+            return f"{filename}.{index}" if filename else index
+    return index
 
 
 def write_push_pop(
@@ -218,276 +264,211 @@ def write_push_pop(
     index: int,
     filename: str | None,
 ):
-    address = ""
-
-    if command == CommandType.C_PUSH:
-        match (segment, index):
-            case ("constant", index):
-                address = dedent(
-                    f"""\
-                    @{index}
-                    D=A
-                    """
-                )
-            case ("local", index) | ("argument", index) | ("this", index) | (
-                "that",
-                index,
-            ):
-                location = location_names[segment]
-                address = dedent(
-                    f"""\
-                    @{index}
-                    D=A
-                    @{location}
-                    A=M+D
-                    D=M
-                    """
-                )
-            case ("pointer", 0):
-                address = dedent(
-                    f"""\
-                    @THIS
-                    D=M
-                    """
-                )
-            case ("pointer", 1):
-                address = dedent(
-                    f"""\
-                    @THAT
-                    D=M
-                    """
-                )
-            case ("temp", index):
-                location = 5 + index
-                address = dedent(
-                    f"""\
-                    @{location}
-                    D=M
-                    """
-                )
-            case ("static", index):
-                static_address = f"{filename}.{index}" if filename else index
-                address = dedent(
-                    f"""\
-                    @{static_address}
-                    D=M
-                    """
-                )
-
-        return address + dedent(
-            f"""\
-            @SP
-            A=M
-            M=D
-            @SP
-            M=M+1
-            """
-        )
-    elif command == CommandType.C_POP:
-        match (segment, index):
-            case ("local", index) | ("argument", index) | ("this", index) | (
-                "that",
-                index,
-            ):
-                location = location_names[segment]
-                address = dedent(
-                    f"""\
-                    @{index}
-                    D=A
-                    @{location}
-                    D=M+D
-                    """
-                )
-            case ("pointer", 0):
-                address = dedent(
-                    f"""\
-                    @THIS
-                    D=A
-                    """
-                )
-            case ("pointer", 1):
-                address = dedent(
-                    f"""\
-                    @THAT
-                    D=A
-                    """
-                )
-            case ("temp", index):
-                location = 5 + index
-                address = dedent(
-                    f"""\
-                    @{location}
-                    D=A
-                    """
-                )
-            case ("static", index):
-                static_address = f"{filename}.{index}" if filename else index
-                address = dedent(
-                    f"""\
-                    @{static_address}
-                    D=A
-                    """
-                )
-
-        return address + dedent(
-            f"""\
-            @R13
-            M=D
-            @SP
-            M=M-1
-            A=M
-            D=M
-            @R13
-            A=M
-            M=D
-            """
-        )
+    if command == CommandType.C_PUSH and segment in push_templates:
+        return push_templates[segment].format(_operand(segment, index, filename))
+    if command == CommandType.C_POP and segment in pop_templates:
+        return pop_templates[segment].format(_operand(segment, index, filename))
     raise ValueError(f"unknown command {command} {segment} {index}")
 
 
 def write_label(label: str):
-    return f"({label})"
+    return f"({label})\n"
 
 
 def write_goto(label: str):
-    return dedent(
-        f"""\
-        @{label}
-        0;JMP
-        """
-    )
+    return f"@{label}\n0;JMP\n"
+
+
+if_goto_template = dedent(
+    """\
+    @SP
+    M=M-1
+    A=M
+    D=M
+    @{0}
+    D;JNE
+    """
+)
 
 
 def write_if_goto(label: str):
-    return dedent(
-        f"""\
-        @SP
-        M=M-1
-        A=M
-        D=M
-        @{label}
-        D;JNE
-        """
-    )
+    return if_goto_template.format(label)
+
+
+push_zero_code = push_templates["constant"].format(0)
 
 
 def write_function(name: str, number_vars: int):
-    code = f"({name})\n"
-    for _ in range(number_vars):
-        code += write_push_pop(CommandType.C_PUSH, "constant", 0, None)
-    return code
+    return f"({name})\n" + push_zero_code * number_vars
+
+
+return_code = dedent(
+    """\
+    @LCL // frame = LCL
+    D=M
+    @R13
+    M=D
+    @5 // retAddr = *(frame-5)
+    A=D-A
+    D=M
+    @R14
+    M=D
+    @SP // *ARG = pop()
+    M=M-1
+    A=M
+    D=M
+    @ARG
+    A=M
+    M=D
+    @ARG // SP = ARG+1
+    D=M+1
+    @SP
+    M=D
+    @R13 // THAT = *(frame-1)
+    AM=M-1
+    D=M
+    @THAT
+    M=D
+    @R13 // THIS = *(frame-2)
+    AM=M-1
+    D=M
+    @THIS
+    M=D
+    @R13 // ARG = *(frame-3)
+    AM=M-1
+    D=M
+    @ARG
+    M=D
+    @R13 // LCL = *(frame-4)
+    AM=M-1
+    D=M
+    @LCL
+    M=D
+    @R14 // goto retAddr
+    A=M
+    0;JMP
+    """
+)
 
 
 def write_return():
-    return dedent(
-        """\
-        @LCL // frame = LCL
-        D=M
-        @R13
-        M=D
-        @5 // retAddr = *(frame-5)
-        A=D-A
-        D=M
-        @R14
-        M=D
-        @SP // *ARG = pop()
-        M=M-1
-        A=M
-        D=M
-        @ARG
-        A=M
-        M=D
-        @ARG // SP = ARG+1
-        D=M+1
-        @SP
-        M=D
-        @R13 // THAT = *(frame-1)
-        AM=M-1
-        D=M
-        @THAT
-        M=D
-        @R13 // THIS = *(frame-2)
-        AM=M-1
-        D=M
-        @THIS
-        M=D
-        @R13 // ARG = *(frame-3)
-        AM=M-1
-        D=M
-        @ARG
-        M=D
-        @R13 // LCL = *(frame-4)
-        AM=M-1
-        D=M
-        @LCL
-        M=D
-        @R14 // goto retAddr
-        A=M
-        0;JMP
-        """
-    )
+    return return_code
 
 
-return_index = 0
+# {0} function, {1} number of arguments, {2} return label
+call_template = dedent(
+    """\
+    @{2} // push returnAddress
+    D=A
+    @SP
+    M=M+1
+    A=M-1
+    M=D
+    @LCL // push LCL
+    D=M
+    @SP
+    M=M+1
+    A=M-1
+    M=D
+    @ARG // push ARG
+    D=M
+    @SP
+    M=M+1
+    A=M-1
+    M=D
+    @THIS // push THIS
+    D=M
+    @SP
+    M=M+1
+    A=M-1
+    M=D
+    @THAT // push THAT
+    D=M
+    @SP
+    M=M+1
+    A=M-1
+    M=D
+    @SP // ARG = SP - 5 - number_args
+    D=M
+    @5
+    D=D-A
+    @{1}
+    D=D-A
+    @ARG
+    M=D
+    @SP // LCL = SP
+    D=M
+    @LCL
+    M=D
+    @{0}
+    0;JMP
+    ({2}) // returnAddress
+    """
+)
 
 
-def write_call(name: str, number_args: int):
-    global return_index
+def write_call(name: str, number_args: int, return_label: str):
+    return call_template.format(name, number_args, return_label)
 
-    return_label = f"{name}$ret.{return_index}"
-    return_index += 1
 
-    call_code = dedent(
-        f"""\
-        @{return_label} // push returnAddress
-        D=A
-        @SP
-        M=M+1
-        A=M-1
-        M=D
-        @LCL // push LCL
-        D=M
-        @SP
-        M=M+1
-        A=M-1
-        M=D
-        @ARG // push ARG
-        D=M
-        @SP
-        M=M+1
-        A=M-1
-        M=D
-        @THIS // push THIS
-        D=M
-        @SP
-        M=M+1
-        A=M-1
-        M=D
-        @THAT // push THAT
-        D=M
-        @SP
-        M=M+1
-        A=M-1
-        M=D
-        @SP // ARG = SP - 5 - number_args
-        D=M
-        @5
-        D=D-A
-        @{number_args}
-        D=D-A
-        @ARG
-        M=D
-        @SP // LCL = SP
-        D=M
-        @LCL
-        M=D
-        @{name}
-        0;JMP
-        ({return_label}) // returnAddress
-        """
+# Size mode calls and returns go through one shared routine, each call
+# site only loads the function and return address. There's a call routine
+# per number of arguments so call sites don't have to pass it.
+shared_call_template = dedent(
+    """\
+    @{0}
+    D=A
+    @R13
+    M=D
+    @{2}
+    D=A
+    @CALL_{1}
+    0;JMP
+    ({2})
+    """
+)
+
+
+def write_shared_call(name: str, number_args: int, return_label: str):
+    return shared_call_template.format(name, number_args, return_label)
+
+
+shared_return_code = "@RETURN\n0;JMP\n"
+
+
+def write_shared_return():
+    return shared_return_code
+
+
+# D = return address, R13 = function
+def write_call_routine(number_args: int):
+    push_d = "@SP\nM=M+1\nA=M-1\nM=D\n"
+    return (
+        f"(CALL_{number_args})\n"
+        + push_d
+        + "".join(f"@{pointer}\nD=M\n" + push_d for pointer in location_names.values())
+        + dedent(
+            f"""\
+            @SP // ARG = SP - 5 - number_args
+            D=M
+            @{5 + number_args}
+            D=D-A
+            @ARG
+            M=D
+            @SP // LCL = SP
+            D=M
+            @LCL
+            M=D
+            @R13
+            A=M
+            0;JMP
+            """
+        )
     )
 
-    return call_code
+
+def write_return_routine():
+    return "(RETURN)\n" + write_return()
 
 
 def write_init():
@@ -499,83 +480,800 @@ def write_init():
         M=D
         """
     )
-    call_sys_init = write_call("Sys.init", 0)
-    jump_to_end = dedent(
-        """\
-        @END_LOOP
-        0;JMP
-        """
-    )
+    call_sys_init = write_call("Sys.init", 0, "Sys.init$ret")
+    jump_to_end = write_goto("END_LOOP")
     return set_stack_pointer + call_sys_init + jump_to_end
 
 
+end_loop_code = dedent(
+    """\
+    (END_LOOP)
+    @END_LOOP
+    0;JMP
+    """
+)
+
+true_false_code = dedent(
+    """\
+    (TRUE)
+    @SP
+    A=M
+    M=-1
+    @RET
+    A=M
+    0;JMP
+    (FALSE)
+    @SP
+    A=M
+    M=0
+    @RET
+    A=M
+    0;JMP
+    """
+)
+
+
 def write_end_loop():
-    return dedent(
-        """\
-        (END_LOOP)
-        @END_LOOP
-        0;JMP
-        (TRUE)
-        @SP
-        A=M
-        M=-1
-        @RET
-        A=M
-        0;JMP
-        (FALSE)
+    return end_loop_code + true_false_code
+
+
+Profile = Literal["speed", "size"]
+
+
+# -O speed takes the comparison form with the fewest cycles. -O size the
+# one with the fewest words for the number of times each comparison is
+# used, so a comparison used once is inlined rather than given a routine.
+# Without a profile comparisons jump to TRUE and FALSE as they always have.
+# The cached top of stack comparisons are already branch-minimal and
+# don't change.
+def comparison_forms(
+    program: Program, profile: Profile | None = None
+) -> dict[str, ComparisonForm]:
+    if profile is None:
+        return dict.fromkeys(comparison_templates, "jump")
+    uses = Counter(
+        command.op
+        for commands in program.values()
+        for command in commands
+        if command.op in comparison_templates
+    )
+    forms: dict[str, ComparisonForm] = {}
+    for op in comparison_templates:
+        if profile == "speed":
+            forms[op] = min(
+                comparison_costs,
+                key=lambda form: (
+                    comparison_costs[form].cycles,
+                    comparison_costs[form].words,
+                ),
+            )
+        else:
+            forms[op] = min(
+                comparison_costs,
+                key=lambda form: (
+                    comparison_costs[form].words * uses[op]
+                    + comparison_costs[form].shared_words,
+                    comparison_costs[form].cycles,
+                ),
+            )
+    return forms
+
+
+# The longest sequence at commands[i] with superoptimized code in the table
+def _match_pattern(
+    commands: list[Command], i: int, patterns: PatternTable
+) -> tuple[Command, ...] | None:
+    for length in range(MAX_PATTERN_LENGTH, 1, -1):
+        sequence = tuple(commands[i : i + length])
+        if len(sequence) == length and sequence in patterns:
+            return sequence
+    return None
+
+
+# Each file is a translation unit. Labels are prefixed with their
+# function, f$label, or with the file for code outside functions, and the
+# translator's own labels are numbered per file, File$ret.0, File$cmp.0.
+def translate_file(
+    commands: list[Command],
+    filename: str,
+    shared_calls: bool = False,
+    forms: dict[str, ComparisonForm] | None = None,
+    patterns: PatternTable | None = None,
+) -> str:
+    templates = {
+        op: comparison_form_templates[form][op]
+        for op, form in (forms or comparison_forms({})).items()
+    }
+    pattern_starts = {sequence[0] for sequence in patterns or {}}
+    code = []
+    function_prefix = f"{filename}."
+    labels = 0
+    i = 0
+    while i < len(commands):
+        command = commands[i]
+        if command in pattern_starts:
+            sequence = _match_pattern(commands, i, patterns)
+            if sequence:
+                code.extend(f"// {format_command(c)}\n" for c in sequence)
+                code.append(patterns[sequence])
+                i += len(sequence)
+                continue
+        i += 1
+        code.append(f"// {format_command(command)}\n")
+        match command.op:
+            case "push":
+                code.append(
+                    write_push_pop(
+                        CommandType.C_PUSH, command.arg1, command.arg2, filename
+                    )
+                )
+            case "pop":
+                code.append(
+                    write_push_pop(
+                        CommandType.C_POP, command.arg1, command.arg2, filename
+                    )
+                )
+            case "label":
+                code.append(write_label(function_prefix + command.arg1))
+            case "goto":
+                code.append(write_goto(function_prefix + command.arg1))
+            case "if-goto":
+                code.append(write_if_goto(function_prefix + command.arg1))
+            case "function":
+                function_prefix = f"{command.arg1}$"
+                code.append(write_function(command.arg1, command.arg2))
+            case "call":
+                write = write_shared_call if shared_calls else write_call
+                code.append(
+                    write(command.arg1, command.arg2, f"{filename}$ret.{labels}")
+                )
+                labels += 1
+            case "return" if shared_calls:
+                code.append(write_shared_return())
+            case "return":
+                code.append(write_return())
+            case "eq" | "gt" | "lt":
+                code.append(templates[command.op].format(f"{filename}$cmp.{labels}"))
+                labels += 1
+            case _:
+                code.append(write_arithmetic(command.op, f"{filename}$cmp.{labels}"))
+                labels += 1
+    return "".join(code)
+
+
+# Top of stack caching: while cached, the top of the VM stack is in D and
+# SP points at where it would be stored. It's stored at labels, calls,
+# returns, gotos and the end of a file so every jump lands on the memory
+# only stack. if-goto consumes the cached value.
+flush_code = "@SP\nM=M+1\nA=M-1\nM=D\n"
+pop_to_d_code = "@SP\nAM=M-1\nD=M\n"
+
+
+def write_flush():
+    return flush_code
+
+
+def write_pop_to_d():
+    return pop_to_d_code
+
+
+# A = segment base + index, without touching D
+def write_segment_address(segment: str, index: int):
+    location = location_names[segment]
+    return f"@{location}\nA=M\n" + "A=A+1\n" * index
+
+
+# indexes up to this are addressed with A=A+1 steps rather than through R13
+MAX_STEPPED_INDEX = 3
+
+cached_operators = {"add": "D=M+D", "sub": "D=M-D", "and": "D=M&D", "or": "D=M|D"}
+cached_unary_operators = {"neg": "D=-D", "not": "D=!D"}
+cached_jumps = {"eq": "JEQ", "gt": "JGT", "lt": "JLT"}
+
+# {0} is the index, {1} the segment's pointer
+cached_indexed_pop_template = dedent(
+    """\
+    @R13
+    M=D
+    @{0}
+    D=A
+    @{1}
+    D=M+D
+    @R14
+    M=D
+    @R13
+    D=M
+    @R14
+    A=M
+    M=D
+    """
+)
+
+# {0} is the comparison's label prefix
+cached_comparison_templates = {
+    op: dedent(
+        f"""\
         @SP
-        A=M
-        M=0
-        @RET
-        A=M
+        AM=M-1
+        D=M-D
+        @{{0}}.true
+        D;{jump}
+        D=0
+        @{{0}}.end
         0;JMP
+        ({{0}}.true)
+        D=-1
+        ({{0}}.end)
         """
     )
+    for op, jump in cached_jumps.items()
+}
 
 
-def main():
-    dirpath = sys.argv[1]
-    filepaths = get_vm_filepaths(dirpath)
-    hackpath = get_asm_filepath_from_path(dirpath)
-
-    with open(hackpath, "w") as w:
-        for filepath in filepaths:
-            filename = get_filename_no_ext(filepath)
-            lines = read_file_lines(filepath)
-
-            function_prefix = f"{filename}."
-            w.write(write_init())
-            for line in lines:
-                comment_matcher = re.compile("(^.*)(//.*$)")
-                has_comments = comment_matcher.match(line)
-                if has_comments:
-                    line = has_comments.groups()[0].strip()
-                type = get_command_type(line)
-                w.write(f"// {line}\n")
-                if type == CommandType.C_ARITHMETIC:
-                    w.write(write_arithmetic(line))
-                elif type == CommandType.C_PUSH or type == CommandType.C_POP:
-                    w.write(
-                        write_push_pop(type, get_arg1(line), get_arg2(line), filename)
+def _fixed_address(segment: str, index: int, filename: str) -> str:
+    if segment == "pointer":
+        return "THIS" if index == 0 else "THAT"
+    if segment == "temp":
+        return str(5 + index)
+    return f"{filename}.{index}"
+
+
+def translate_file_cached(
+    commands: list[Command], filename: str, shared_calls: bool = False
+) -> str:
+    code = []
+    function_prefix = f"{filename}."
+    cached = False
+    labels = 0
+
+    def flush():
+        nonlocal cached
+        if cached:
+            code.append(flush_code)
+            cached = False
+
+    for command in commands:
+        code.append(f"// {format_command(command)}\n")
+        op, segment, index = command
+        match op:
+            case "push":
+                flush()
+                if segment == "constant":
+                    code.append(f"@{index}\nD=A\n")
+                elif segment in location_names:
+                    if index <= 1:
+                        code.append(write_segment_address(segment, index))
+                    else:
+                        code.append(f"@{index}\nD=A\n@{location_names[segment]}\n")
+                        code.append("A=M+D\n")
+                    code.append("D=M\n")
+                else:
+                    code.append(f"@{_fixed_address(segment, index, filename)}\nD=M\n")
+                cached = True
+            case "pop":
+                if not cached:
+                    code.append(pop_to_d_code)
+                cached = False
+                if segment in location_names and index > MAX_STEPPED_INDEX:
+                    code.append(
+                        cached_indexed_pop_template.format(
+                            index, location_names[segment]
+                        )
                     )
-                elif type == CommandType.C_LABEL:
-                    w.write(write_label(function_prefix + get_arg1(line)))
-                elif type == CommandType.C_GOTO:
-                    w.write(write_goto(function_prefix + get_arg1(line)))
-                elif type == CommandType.C_IF:
-                    w.write(write_if_goto(function_prefix + get_arg1(line)))
-                elif type == CommandType.C_FUNCTION:
-                    function_name = get_arg1(line)
-                    number_vars = get_arg2(line)
-                    function_prefix += f"{function_name}$"
-                    w.write(write_function(f"{function_name}", number_vars))
-                elif type == CommandType.C_CALL:
-                    function_name = get_arg1(line)
-                    number_args = get_arg2(line)
-                    w.write(write_call(f"{function_name}", number_args))
-                elif type == CommandType.C_RETURN:
-                    w.write(write_return())
-            w.write(write_end_loop())
+                elif segment in location_names:
+                    code.append(write_segment_address(segment, index) + "M=D\n")
+                else:
+                    code.append(f"@{_fixed_address(segment, index, filename)}\nM=D\n")
+            case "add" | "sub" | "and" | "or":
+                if not cached:
+                    code.append(pop_to_d_code)
+                code.append(f"@SP\nAM=M-1\n{cached_operators[op]}\n")
+                cached = True
+            case "neg" | "not":
+                if not cached:
+                    code.append(pop_to_d_code)
+                code.append(cached_unary_operators[op] + "\n")
+                cached = True
+            case "eq" | "gt" | "lt":
+                if not cached:
+                    code.append(pop_to_d_code)
+                label = f"{filename}$cmp.{labels}"
+                labels += 1
+                code.append(cached_comparison_templates[op].format(label))
+                cached = True
+            case "label":
+                flush()
+                code.append(write_label(function_prefix + segment))
+            case "goto":
+                flush()
+                code.append(write_goto(function_prefix + segment))
+            case "if-goto":
+                if not cached:
+                    code.append(pop_to_d_code)
+                cached = False
+                code.append(f"@{function_prefix + segment}\nD;JNE\n")
+            case "function":
+                flush()
+                function_prefix = f"{segment}$"
+                code.append(write_function(segment, index))
+            case "call":
+                flush()
+                write = write_shared_call if shared_calls else write_call
+                code.append(write(segment, index, f"{filename}$ret.{labels}"))
+                labels += 1
+            case "return":
+                flush()
+                code.append(write_shared_return() if shared_calls else write_return())
+    flush()
+    return "".join(code)
+
+
+def translate_unit(
+    unit: tuple[str, list[Command]],
+    cache_top: bool = False,
+    shared_calls: bool = False,
+    forms: dict[str, ComparisonForm] | None = None,
+    patterns: PatternTable | None = None,
+) -> str:
+    filename, commands = unit
+    if cache_top:
+        return translate_file_cached(commands, filename, shared_calls)
+    return translate_file(commands, filename, shared_calls, forms, patterns)
+
+
+# programs smaller than this translate faster than a process pool starts
+MIN_PARALLEL_COMMANDS = 50000
+
+
+# bump whenever the generated code changes, to invalidate cached objects
+TRANSLATOR_VERSION = "1"
+
+
+# Translated files are relocatable, their labels and statics are named by
+# file, so they're cached by content and linked as they are.
+def _object_key(
+    unit: tuple[str, list[Command]],
+    cache_top: bool,
+    shared_calls: bool,
+    forms: dict[str, ComparisonForm] | None,
+    patterns: PatternTable | None,
+) -> str:
+    filename, commands = unit
+    text = "\n".join(map(format_command, commands))
+    options = (
+        f"{cache_top},{shared_calls},{sorted((forms or {}).items())},"
+        f"{sorted((patterns or {}).items())}"
+    )
+    return BuildCache.key(TRANSLATOR_VERSION, options, filename, text)
+
+
+def _translate_units(
+    units: list[tuple[str, list[Command]]],
+    cache_top: bool,
+    shared_calls: bool,
+    jobs: int | None,
+    forms: dict[str, ComparisonForm] | None,
+    patterns: PatternTable | None,
+) -> Iterator[str]:
+    translate_one = partial(
+        translate_unit,
+        cache_top=cache_top,
+        shared_calls=shared_calls,
+        forms=forms,
+        patterns=patterns,
+    )
+    size = sum(len(commands) for _, commands in units)
+    if jobs == 1 or len(units) < 2 or (jobs is None and size < MIN_PARALLEL_COMMANDS):
+        yield from map(translate_one, units)
+        return
+    workers = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(translate_one, units)
+
+
+# Files are translated concurrently and linked in the program's order, so
+# the output is the same however they're scheduled. With a cache, only
+# the files that changed are translated.
+def iter_translated_files(
+    program: Program,
+    cache_top: bool = False,
+    shared_calls: bool = False,
+    jobs: int | None = None,
+    cache: BuildCache | None = None,
+    forms: dict[str, ComparisonForm] | None = None,
+    patterns: PatternTable | None = None,
+) -> Iterator[str]:
+    units = list(program.items())
+    if cache is None:
+        yield from _translate_units(
+            units, cache_top, shared_calls, jobs, forms, patterns
+        )
+        return
+
+    keys = [
+        _object_key(unit, cache_top, shared_calls, forms, patterns) for unit in units
+    ]
+    objects = [cache.get(key) for key in keys]
+    misses = [i for i, data in enumerate(objects) if data is None]
+    translated = _translate_units(
+        [units[i] for i in misses], cache_top, shared_calls, jobs, forms, patterns
+    )
+    for i, asm in zip(misses, translated):
+        objects[i] = asm.encode()
+        cache.put(keys[i], objects[i])
+    for data in objects:
+        yield data.decode()
+
+
+def translate_files(
+    program: Program,
+    cache_top: bool = False,
+    shared_calls: bool = False,
+    jobs: int | None = None,
+    cache: BuildCache | None = None,
+    forms: dict[str, ComparisonForm] | None = None,
+    patterns: PatternTable | None = None,
+) -> str:
+    return "".join(
+        iter_translated_files(
+            program, cache_top, shared_calls, jobs, cache, forms, patterns
+        )
+    )
+
+
+# One bootstrap, when there's a Sys.init to call, then every file, then the
+# end loop and the shared comparison and call routines. Programs without
+# Sys.init, like the projects/07 tests, start at their first command.
+def iter_program(
+    program: Program,
+    cache_top: bool = False,
+    shared_calls: bool = False,
+    jobs: int | None = None,
+    cache: BuildCache | None = None,
+    profile: Profile | None = None,
+) -> Iterator[str]:
+    functions = {
+        command.arg1
+        for commands in program.values()
+        for command in commands
+        if command.op == "function"
+    }
+    if "Sys.init" in functions:
+        yield write_init()
+    forms = comparison_forms(program, profile)
+    # superoptimized code for common sequences, from VMSuperoptimizer.py
+    patterns = default_patterns() if profile else None
+    yield from iter_translated_files(
+        program, cache_top, shared_calls, jobs, cache, forms, patterns
+    )
+    yield end_loop_code
+    if profile is None:
+        yield true_false_code
+    elif not cache_top:
+        yield from (
+            write_comparison_routine(op)
+            for op, form in forms.items()
+            if form == "routine"
+        )
+    if shared_calls:
+        argument_counts = sorted(
+            {
+                command.arg2
+                for commands in program.values()
+                for command in commands
+                if command.op == "call"
+            }
+        )
+        yield from map(write_call_routine, argument_counts)
+        yield write_return_routine()
+
+
+def translate_program(
+    program: Program,
+    cache_top: bool = False,
+    shared_calls: bool = False,
+    jobs: int | None = None,
+    cache: BuildCache | None = None,
+    profile: Profile | None = None,
+) -> str:
+    return "".join(iter_program(program, cache_top, shared_calls, jobs, cache, profile))
+
+
+# The program as the assembler's input lines, a file at a time, without
+# the comments. Assembler.assemble encodes them as they come, so there's
+# never an .asm text of the whole program to write and parse again.
+def iter_program_lines(
+    program: Program,
+    cache_top: bool = False,
+    shared_calls: bool = False,
+    jobs: int | None = None,
+    cache: BuildCache | None = None,
+    profile: Profile | None = None,
+) -> Iterator[str]:
+    for asm in iter_program(program, cache_top, shared_calls, jobs, cache, profile):
+        for line in asm.splitlines():
+            # instructions have no spaces, what follows one is a comment
+            code = line.partition(" ")[0]
+            if code and code[0] != "/":
+                yield code
+
+
+def translate_to_hack(
+    program: Program,
+    cache_top: bool = False,
+    shared_calls: bool = False,
+    jobs: int | None = None,
+    cache: BuildCache | None = None,
+    profile: Profile | None = None,
+) -> array:
+    return assemble(
+        iter_program_lines(program, cache_top, shared_calls, jobs, cache, profile)
+    )
+
+
+# words in the ROM, labels take none
+def rom_size(asm: str) -> int:
+    return sum(line[0] != "(" for line in iter_code_lines(asm.splitlines()))
+
+
+# A function body with every kind of command, repeated as Bench.f0,
+# Bench.f1, ... for the throughput benchmark
+benchmark_function = dedent(
+    """\
+    function Bench.f{0} 2
+    push argument 0
+    push constant 7
+    add
+    pop local 0
+    push local 0
+    push static 3
+    lt
+    if-goto L{0}
+    push this 2
+    push that 5
+    sub
+    pop pointer 1
+    label L{0}
+    push temp 1
+    neg
+    push local 1
+    eq
+    not
+    pop temp 2
+    call Bench.f{0} 1
+    pop that 0
+    push constant 0
+    return
+    """
+)
+
+
+def benchmark(lines: int, cache_top: bool = False, shared_calls: bool = False):
+    count = lines // benchmark_function.count("\n")
+    text = "".join(benchmark_function.format(n) for n in range(count))
+    start = time.perf_counter()
+    commands = parse_vm(text, "Bench.vm")
+    parsed = time.perf_counter() - start
+    print(f"Parsed {len(commands)} VM lines at {len(commands) / parsed:,.0f} lines/s")
+
+    start = time.perf_counter()
+    asm = translate_unit(("Bench", commands), cache_top, shared_calls)
+    translated = time.perf_counter() - start
+    print(
+        f"Translated to {len(asm) // 1024} KiB of assembly"
+        f" at {len(commands) / translated:,.0f} lines/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Translate VM code to Hack assembly")
+    parser.add_argument(
+        "path",
+        nargs="?",
+        help="a .vm file, or a directory path ending in / for all its files",
+    )
+    parser.add_argument(
+        "-O",
+        "--optimize",
+        nargs="?",
+        const="speed",
+        choices=["speed", "size"],
+        help="run the VM optimizer passes before translating, use the"
+        " superoptimized code in vmpatterns.json, and pick the comparison"
+        " code with the fewest cycles (speed, the default) or words",
+    )
+    parser.add_argument(
+        "--cache-top",
+        action="store_true",
+        help="keep the top of the VM stack in D between commands",
+    )
+    parser.add_argument(
+        "--shared-calls",
+        action="store_true",
+        help="call and return through shared routines for smaller code",
+    )
+    parser.add_argument(
+        "--inline",
+        action="store_true",
+        help="inline calls to small leaf functions",
+    )
+    parser.add_argument(
+        "--inline-budget",
+        type=int,
+        default=DEFAULT_INLINE_BUDGET,
+        metavar="SIZE",
+        help="largest function, in commands, --inline inlines"
+        f" (default {DEFAULT_INLINE_BUDGET})",
+    )
+    parser.add_argument(
+        "--tail-calls",
+        action="store_true",
+        help="reuse the frame for calls of a function to itself before returning",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="only translate the functions Sys.init can call",
+    )
+    parser.add_argument(
+        "--peephole",
+        action="store_true",
+        help="run the peephole optimizer over the generated assembly",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of worker processes translating files,"
+        " defaults to the number of CPUs for large programs",
+    )
+    parser.add_argument(
+        "--emit",
+        action="append",
+        choices=["asm", "hack"],
+        help="an output to write, asm (the default) or hack, which assembles in"
+        " memory without an .asm; repeat for both",
+    )
+    parser.add_argument(
+        "--os",
+        action="store_true",
+        help="link in the tools/OS classes the program doesn't define",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir("vmtranslator"),
+        help="where translated files are cached by content hash",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        help="cache size limit in MiB, least recently used files are evicted",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always translate every file",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="LINES",
+        help="time translating a generated program of about LINES VM lines",
+    )
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.cache_top, args.shared_calls)
+        return
+    if args.path is None:
+        parser.error("a path is required")
+    args.emit = args.emit or ["asm"]
+
+    cache = (
+        None
+        if args.no_cache
+        else BuildCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    )
+
+    program = read_program(get_vm_filepaths(args.path))
+    if args.os:
+        program |= {
+            cls: commands for cls, commands in read_os().items() if cls not in program
+        }
+    if args.inline:
+        inline_report: InlineReport = {}
+        program = inline_functions(program, args.inline_budget, inline_report)
+        print(
+            f"Inlined {sum(inline_report.values())} calls"
+            f" to {len(inline_report)} functions"
+        )
+        for name, calls in inline_report.items():
+            print(f"  {name}: {calls}")
+    if args.tail_calls:
+        tail_call_report: TailCallReport = {}
+        program = eliminate_tail_calls(program, tail_call_report)
+        print(f"Rewrote {sum(tail_call_report.values())} tail calls")
+        for name, calls in tail_call_report.items():
+            print(f"  {name}: {calls}")
+    if args.prune:
+        program, dropped = eliminate_dead_functions(program)
+        names = [
+            command.arg1
+            for commands in dropped.values()
+            for command in commands
+            if command.op == "function"
+        ]
+        saved = rom_size(
+            translate_files(
+                dropped,
+                args.cache_top,
+                args.shared_calls,
+                forms=comparison_forms(dropped, args.optimize),
+            )
+        )
+        print(
+            f"Dropped {len(names)} unreachable functions,"
+            f" {saved} words ({2 * saved} bytes)"
+        )
+        for name in names:
+            print(f"  {name}")
+    if args.optimize:
+        report: OptimizeReport = {}
+        program = optimize(program, report)
+        for name, removed in report.items():
+            print(f"{name}: {removed} commands removed")
+
+    asm = ""
+    if args.peephole:
+        peephole_report: PeepholeReport = {}
+        lines = peephole(
+            list(
+                iter_program_lines(
+                    program,
+                    args.cache_top,
+                    args.shared_calls,
+                    args.jobs,
+                    cache,
+                    args.optimize,
+                )
+            ),
+            peephole_report,
+        )
+        for name, savings in peephole_report.items():
+            print(
+                f"{name}: {savings['instructions']} instructions,"
+                f" ~{savings['cycles']} cycles saved"
+            )
+        if "asm" in args.emit:
+            asm = "".join(f"{line}\n" for line in lines)
+        words = assemble(lines)
+    elif "asm" in args.emit:
+        asm = translate_program(
+            program, args.cache_top, args.shared_calls, args.jobs, cache, args.optimize
+        )
+        words = assemble(iter_code_lines(asm.splitlines()))
+    else:
+        words = translate_to_hack(
+            program, args.cache_top, args.shared_calls, args.jobs, cache, args.optimize
+        )
+    if cache is not None:
+        evicted = cache.evict()
+        print(f"Cache: {cache.hits} hits, {cache.misses} misses, {evicted} evicted")
+    if args.shared_calls:
+        inline_size = len(
+            translate_to_hack(program, args.cache_top, profile=args.optimize)
+        )
+        print(f"ROM: {inline_size} words with inline calls, {len(words)} shared")
+
+    print(f"ROM: {len(words)} of {ROM_SIZE} words")
+    asmpath = get_asm_filepath_from_path(args.path)
+    if "asm" in args.emit:
+        with open(asmpath, "w") as w:
+            w.write(asm)
+    if "hack" in args.emit:
+        write_hack(words, get_filepath_with_ext(asmpath, "hack"))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,259 @@
+import glob
+import os
+import shutil
+import sys
+from array import array
+
+import pytest
+from Assembler import assemble, iter_code_lines
+from buildcache import BuildCache
+from CPUEmulator import ROM_SIZE, HackCPU
+from hackopt import peephole
+from TestRunner import run_script
+from VMEmulator import VM, link
+import VMTranslator
+from VMTranslator import (
+    comparison_costs,
+    comparison_forms,
+    rom_size,
+    translate_files,
+    translate_program,
+    translate_to_hack,
+    write_comparison_routine,
+    write_end_loop,
+)
+from vmcode import Program, parse_vm, read_os, read_program
+from vmopt import (
+    eliminate_dead_functions,
+    eliminate_tail_calls,
+    inline_functions,
+    optimize,
+)
+from vmopt_test import count_program
+from vmpatterns import default_patterns
+
+projects_dir = os.path.join(os.path.dirname(__file__), "..", "projects")
+
+test_dirs = sorted(glob.glob(os.path.join(projects_dir, "0[78]", "*", "*")))
+
+
+# Translates with the optimizations in modes, "+" separated: vm for the
+# VM passes, inline, prune, peephole, cache_top, shared_calls and the
+# speed or size profile.
+def translate(program: Program, modes: str) -> list[str]:
+    modes_set = set(modes.split("+"))
+    if "inline" in modes_set:
+        program = inline_functions(program)
+    if "prune" in modes_set:
+        program, _ = eliminate_dead_functions(program)
+    if "vm" in modes_set:
+        program = optimize(program)
+    asm = translate_program(
+        program,
+        cache_top="cache_top" in modes_set,
+        shared_calls="shared_calls" in modes_set,
+        profile=next((p for p in ("speed", "size") if p in modes_set), None),
+    )
+    lines = list(iter_code_lines(asm.splitlines()))
+    return peephole(lines) if "peephole" in modes_set else lines
+
+
+modes = [
+    "plain",
+    "vm",
+    "peephole",
+    "cache_top",
+    "shared_calls",
+    "speed",
+    "size",
+    "vm+prune+cache_top+shared_calls+peephole",
+    "vm+prune+shared_calls+size+peephole",
+    "inline+prune+cache_top+speed",
+]
+
+
+@pytest.mark.parametrize("dirpath", test_dirs, ids=os.path.basename)
+@pytest.mark.parametrize("mode", modes)
+def test_project_scripts(dirpath, mode, tmp_path):
+    name = os.path.basename(dirpath)
+    shutil.copytree(dirpath, tmp_path / name)
+    program = read_program(sorted(glob.glob(str(tmp_path / name / "*.vm"))))
+    with open(tmp_path / name / f"{name}.asm", "w") as w:
+        w.write("".join(f"{line}\n" for line in translate(program, mode)))
+    result = run_script(str(tmp_path / name / f"{name}.tst"), str(tmp_path))
+    assert result["status"] == "pass", result["message"]
+
+
+def test_cache_top_saves_cycles():
+    program = read_program(
+        glob.glob(
+            os.path.join(
+                projects_dir, "08", "FunctionCalls", "FibonacciElement", "*.vm"
+            )
+        )
+    )
+    cycles = []
+    for mode in ("plain", "cache_top"):
+        cpu = HackCPU(assemble(translate(program, mode)))
+        cpu.run(10000)
+        assert cpu.halted
+        assert (cpu.ram[0], cpu.ram[261]) == (262, 3)
+        cycles.append(cpu.cycles)
+    assert cycles[1] < cycles[0] * 0.85
+
+
+# With the whole OS, Seven only fits in the ROM with some optimization
+@pytest.mark.parametrize(
+    "mode", ["cache_top", "prune+cache_top+shared_calls", "inline+prune+cache_top"]
+)
+def test_seven_with_os(mode):
+    program = read_program(glob.glob(os.path.join(projects_dir, "11", "Seven", "*.vm")))
+    program.update(read_os())
+    vm = VM(link(program))
+    vm.run()
+    cpu = HackCPU(assemble(translate(program, mode)), jit=True)
+    cpu.run(7_000_000)
+    assert cpu.ram[16384:24576] == vm.ram[16384:24576]
+
+
+def test_shared_calls_size():
+    program = read_program(glob.glob(os.path.join(projects_dir, "11", "Pong", "*.vm")))
+    program.update(read_os())
+    inline = rom_size(translate_program(program))
+    shared = rom_size(translate_program(program, shared_calls=True))
+    assert inline > ROM_SIZE
+    assert shared < inline * 0.8
+
+
+def test_parallel_translation_is_deterministic():
+    program = read_program(glob.glob(os.path.join(projects_dir, "11", "Pong", "*.vm")))
+    program.update(read_os())
+    serial = translate_program(program, shared_calls=True, jobs=1)
+    assert translate_program(program, shared_calls=True, jobs=4) == serial
+    assert translate_program(program, shared_calls=True, jobs=4) == serial
+    # the labels the translator makes are unique across the files
+    labels = [line for line in serial.splitlines() if line.startswith("(")]
+    assert len(labels) == len(set(labels))
+
+
+def test_cached_objects(tmp_path):
+    program = read_program(glob.glob(os.path.join(projects_dir, "11", "Pong", "*.vm")))
+    program.update(read_os())
+    cache = BuildCache(str(tmp_path))
+    asm = translate_program(program, cache_top=True)
+    assert translate_program(program, cache_top=True, cache=cache) == asm
+    assert (cache.hits, cache.misses) == (0, len(program))
+    assert translate_program(program, cache_top=True, cache=cache) == asm
+    assert cache.hits == len(program)
+    # only the changed file is translated again
+    program["Main"] = program["Main"][:-1]
+    translate_program(program, cache_top=True, cache=cache)
+    assert cache.misses == len(program) + 1
+
+
+@pytest.mark.parametrize("cache_top", [False, True])
+def test_in_memory_hack(cache_top):
+    program = read_program(glob.glob(os.path.join(projects_dir, "11", "Pong", "*.vm")))
+    program.update(read_os())
+    asm = translate_program(program, cache_top, shared_calls=True)
+    words = translate_to_hack(program, cache_top, shared_calls=True)
+    assert words == assemble(iter_code_lines(asm.splitlines()))
+
+
+@pytest.mark.parametrize("form", comparison_costs)
+def test_comparison_costs(form):
+    def run(op: str, x: int, y: int) -> HackCPU:
+        program = {"Main": parse_vm(f"push constant {x}\npush constant {y}\n{op}")}
+        forms = {"eq": form, "gt": form, "lt": form}
+        asm = translate_files(program, forms=forms) + write_end_loop()
+        asm += write_comparison_routine("eq")
+        cpu = HackCPU(assemble(iter_code_lines(asm.splitlines())))
+        cpu.ram[0] = 256
+        cpu.run(1000)
+        return cpu
+
+    # an add is 6 words and 6 cycles
+    cost = comparison_costs[form]
+    for x, y, result in [(1, 1, -1), (1, 2, 0)]:
+        cpu = run("eq", x, y)
+        assert cpu.ram[256] == result
+        assert cpu.cycles - run("add", x, y).cycles + 6 <= cost.cycles
+    assert cpu.cycles - run("add", x, y).cycles + 6 == cost.cycles
+    assert len(cpu.rom) - len(run("add", 1, 2).rom) + 6 == cost.words
+
+
+def test_size_profile_inlines_rare_comparisons():
+    program = {"Main": parse_vm("eq\n" * 10 + "lt")}
+    forms = comparison_forms(program, "size")
+    assert forms == {"eq": "routine", "lt": "inline", "gt": "inline"}
+    assert set(comparison_forms(program, "speed").values()) == {"inline"}
+
+
+def test_tail_calls_save_cycles_and_stack():
+    program = {"Main": parse_vm(count_program.format(n=1000))}
+    cycles = []
+    for tail_calls in (False, True):
+        cpu = HackCPU(
+            translate_to_hack(eliminate_tail_calls(program) if tail_calls else program)
+        )
+        cpu.run(1_000_000)
+        assert cpu.halted and cpu.ram[16] == 1000
+        assert any(cpu.ram[2048:16384]) != tail_calls
+        cycles.append(cpu.cycles)
+    assert cycles[1] < cycles[0] * 0.85
+
+
+def test_superoptimized_patterns():
+    patterns = default_patterns()
+    assert patterns
+    # every pattern, with a push between them so they don't run together
+    program = {
+        "Main": [
+            command
+            for sequence in patterns
+            for command in [*sequence, *parse_vm("push constant 3")]
+        ]
+    }
+    results = []
+    for profile in (None, "speed"):
+        asm = translate_program(program, profile=profile)
+        cpu = HackCPU(assemble(iter_code_lines(asm.splitlines())))
+        cpu.ram[0:5] = array("h", [1000, 900, 800, 3000, 3010])
+        cpu.run(10000)
+        # R13-R15 are scratch
+        ram = list(cpu.ram[0:13]) + list(cpu.ram[800 : cpu.ram[0]])
+        results.append((rom_size(asm), ram, list(cpu.ram[3000:3020])))
+    assert results[1][1:] == results[0][1:]
+    assert results[1][0] < results[0][0] * 0.75
+
+
+def run_main(monkeypatch, *args: str):
+    monkeypatch.setattr(sys, "argv", ["VMTranslator.py", *args])
+    VMTranslator.main()
+
+
+def test_cli_emit_before_path(tmp_path, monkeypatch):
+    shutil.copytree(
+        os.path.join(projects_dir, "07", "StackArithmetic", "SimpleAdd"),
+        tmp_path / "SimpleAdd",
+    )
+    os.remove(tmp_path / "SimpleAdd" / "SimpleAdd.asm")
+    path = str(tmp_path / "SimpleAdd") + "/"
+    run_main(monkeypatch, "--no-cache", "--emit", "hack", path)
+    assert os.path.exists(tmp_path / "SimpleAdd" / "SimpleAdd.hack")
+    assert not os.path.exists(tmp_path / "SimpleAdd" / "SimpleAdd.asm")
+    run_main(monkeypatch, "--no-cache", "--emit", "hack", "--emit", "asm", path)
+    assert os.path.exists(tmp_path / "SimpleAdd" / "SimpleAdd.asm")
+
+
+def test_cli_inline_before_path(tmp_path, monkeypatch, capsys):
+    (tmp_path / "Main").mkdir()
+    (tmp_path / "Main" / "Sys.vm").write_text(
+        "function Sys.init 0\ncall Sys.one 0\npop temp 0\nlabel END\ngoto END\n"
+        "function Sys.one 0\npush constant 1\npush constant 1\nadd\nreturn\n"
+    )
+    path = str(tmp_path / "Main") + "/"
+    run_main(monkeypatch, "--no-cache", "--inline", path)
+    assert "Inlined 1 calls" in capsys.readouterr().out
+    run_main(monkeypatch, "--no-cache", "--inline", "--inline-budget", "2", path)
+    assert "Inlined 0 calls" in capsys.readouterr().out
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import tempfile
+
+
+def default_cache_dir(name: str) -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "nand2tetris", name)
+
+
+def file_digest(filepath: str) -> str:
+    with open(filepath, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+# On-disk cache of build outputs keyed by content hashes.
+# Entries are plain files named by their key; the mtime of an entry is its
+# last use, so eviction removes the least recently used entries first.
+# hits and misses count this process's gets; workers using their own copy
+# of a cache report through their results instead.
+class BuildCache:
+    def __init__(self, cachedir: str, max_bytes: int = 64 * 1024 * 1024):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cachedir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(part.encode())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cachedir, key)
+
+    def get(self, key: str) -> bytes | None:
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        # write then rename, so concurrent readers never see partial entries
+        fd, tmppath = tempfile.mkstemp(dir=self.cachedir, prefix=".tmp")
+        with os.fdopen(fd, "wb") as w:
+            w.write(data)
+        os.replace(tmppath, self._entry_path(key))
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        with os.scandir(self.cachedir) as it:
+            for entry in it:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self) -> int:
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        return evicted
@@ -0,0 +1,25 @@
+import os
+
+from buildcache import BuildCache
+
+
+class TestBuildCache:
+    def test_get_put(self, tmp_path):
+        cache = BuildCache(str(tmp_path))
+        key = cache.key("1", "hack", "contents")
+        assert key != cache.key("2", "hack", "contents")
+        assert cache.get(key) is None
+        cache.put(key, b"0000000000000000\n")
+        assert cache.get(key) == b"0000000000000000\n"
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache = BuildCache(str(tmp_path), max_bytes=20)
+        for i, key in enumerate(["a", "b", "c"]):
+            cache.put(key, b"0123456789")
+            os.utime(tmp_path / key, (i, i))
+        os.utime(tmp_path / "a", (10, 10))
+
+        assert cache.evict() == 1
+        assert sorted(os.listdir(tmp_path)) == ["a", "c"]
+        assert cache.size() == 20
@@ -0,0 +1,261 @@
+from collections.abc import Callable
+from typing import TypedDict
+
+# Peephole optimizer over Hack assembly: labels, @values and C-instructions
+# without comments, as Assembler.iter_code_lines gives them.
+
+
+class RuleSavings(TypedDict):
+    instructions: int
+    # estimated, counting every rewritten site as run once
+    cycles: int
+
+
+PeepholeReport = dict[str, RuleSavings]
+
+# Window rules, pattern -> replacement. "@{x}" matches any A-instruction
+# and binds x, which has to match everywhere it's used in the pattern.
+window_rules: dict[str, tuple[list[str], list[str]]] = {
+    # the pop half of push followed by pop
+    "increment_decrement": (["@{x}", "M=M+1", "@{x}", "M=M-1"], ["@{x}"]),
+    "increment_decrement_load": (
+        ["@{x}", "M=M+1", "@{x}", "AM=M-1"],
+        ["@{x}", "A=M"],
+    ),
+    # SP never points at itself, so writing through it leaves it as it was
+    "stack_reload": (["@SP", "A=M", "M=D", "@SP", "A=M"], ["@SP", "A=M", "M=D"]),
+    "store_load": (["M=D", "D=M"], ["M=D"]),
+    # what's past the top of the stack is never read
+    "dead_stack_store": (["@SP", "A=M", "M=D", "A=A-1"], ["@SP", "A=M-1"]),
+    "dead_push": (["@SP", "A=M", "M=D", "@{y}", "M=D"], ["@{y}", "M=D"]),
+    "merge_decrement": (["M=M-1", "A=M"], ["AM=M-1"]),
+    "zero_offset_push": (
+        ["@0", "D=A", "@{x}", "A=M+D", "D=M"],
+        ["@{x}", "A=M", "D=M"],
+    ),
+    "one_offset_push": (
+        ["@1", "D=A", "@{x}", "A=M+D", "D=M"],
+        ["@{x}", "A=M+1", "D=M"],
+    ),
+    "zero_offset_pop": (["@0", "D=A", "@{x}", "D=M+D"], ["@{x}", "D=M"]),
+    "one_offset_pop": (["@1", "D=A", "@{x}", "D=M+D"], ["@{x}", "D=M+1"]),
+    # pop to temp, pointer or static doesn't need the address in R13
+    "direct_pop": (
+        ["@{x}", "D=A", "@R13", "M=D", "@SP", "AM=M-1", "D=M", "@R13", "A=M", "M=D"],
+        ["@SP", "AM=M-1", "D=M", "@{x}", "M=D"],
+    ),
+    # Rules ending in @{y} need the next instruction to load A, as they
+    # leave a different value in A.
+    "push_increment": (
+        ["@SP", "A=M", "M=D", "@SP", "M=M+1", "@{y}"],
+        ["@SP", "M=M+1", "A=M-1", "M=D", "@{y}"],
+    ),
+    "push_pop": (
+        ["@SP", "M=M+1", "A=M-1", "M=D", "@SP", "AM=M-1", "D=M"],
+        ["@SP", "A=M", "M=D"],
+    ),
+    "push_reload": (
+        ["@SP", "M=M+1", "A=M-1", "M=D", "@SP", "A=M-1"],
+        ["@SP", "M=M+1", "A=M-1", "M=D"],
+    ),
+    "store_not": (["M=D", "M=!M"], ["M=!D"]),
+    "store_neg": (["M=D", "M=-M"], ["M=-D"]),
+    "zero_constant": (["@0", "D=A", "@{y}"], ["D=0", "@{y}"]),
+    "one_constant": (["@1", "D=A", "@{y}"], ["D=1", "@{y}"]),
+    # an A load nothing reads
+    "dead_load": (["@{x}", "@{y}"], ["@{y}"]),
+}
+
+
+def _is_label(line: str) -> bool:
+    return line[0] == "("
+
+
+def _is_jump(line: str) -> bool:
+    return ";" in line
+
+
+def _parts(line: str) -> tuple[str, str, str]:
+    dest, _, rest = line.rpartition("=")
+    comp, _, jump = rest.partition(";")
+    return dest, comp, jump
+
+
+def _match(pattern: list[str], lines: list[str], start: int) -> dict[str, str] | None:
+    if start + len(pattern) > len(lines):
+        return None
+    bound: dict[str, str] = {}
+    for i, expected in enumerate(pattern):
+        line = lines[start + i]
+        if expected[:2] == "@{":
+            if line[0] != "@":
+                return None
+            if bound.setdefault(expected[2:-1], line[1:]) != line[1:]:
+                return None
+        elif expected != line:
+            return None
+    return bound
+
+
+def _apply_window(
+    lines: list[str], pattern: list[str], replacement: list[str]
+) -> tuple[list[str], int]:
+    result: list[str] = []
+    rewritten = 0
+    # cheap check on the first line before matching the whole window
+    first = "@" if pattern[0][:2] == "@{" else pattern[0]
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.startswith(first) or (bound := _match(pattern, lines, i)) is None:
+            result.append(line)
+            i += 1
+            continue
+        result += [
+            f"@{bound[line[2:-1]]}" if line[:2] == "@{" else line
+            for line in replacement
+        ]
+        rewritten += 1
+        i += len(pattern)
+    return result, rewritten
+
+
+# A D value overwritten before it's read, D=x followed by D=y where y
+# doesn't read D.
+def remove_dead_stores(lines: list[str]) -> tuple[list[str], int]:
+    result: list[str] = []
+    for line in lines:
+        if result and line[0] not in "@(" and not _is_jump(line):
+            dest, comp, _ = _parts(line)
+            previous = result[-1]
+            if (
+                dest == "D"
+                and "D" not in comp
+                and previous[0] not in "@("
+                and not _is_jump(previous)
+                and _parts(previous)[0] == "D"
+            ):
+                result.pop()
+        result.append(line)
+    return result, len(lines) - len(result)
+
+
+def _label_targets(lines: list[str]) -> dict[str, int]:
+    targets = {}
+    for i, line in enumerate(lines):
+        if _is_label(line):
+            targets[line[1:-1]] = i
+    return targets
+
+
+# The unconditional jump at a label, @y 0;JMP right after (x), so jumps to
+# x can go straight to y.
+def _jump_at(lines: list[str], label: str, targets: dict[str, int]) -> str | None:
+    i = targets[label] + 1
+    while i < len(lines) and _is_label(lines[i]):
+        i += 1
+    if (
+        i + 1 < len(lines)
+        and lines[i][0] == "@"
+        and lines[i + 1] == "0;JMP"
+        and lines[i][1:] in targets
+    ):
+        return lines[i][1:]
+    return None
+
+
+# Jumps to a label that only jumps on go straight to the final target.
+# The fall through of a conditional jump must not read the changed A.
+def thread_jumps(lines: list[str]) -> tuple[list[str], int]:
+    targets = _label_targets(lines)
+    result = list(lines)
+    threaded = 0
+    for i in range(len(lines) - 1):
+        line = lines[i]
+        if line[0] != "@" or line[1:] not in targets or not _is_jump(lines[i + 1]):
+            continue
+        after = lines[i + 2] if i + 2 < len(lines) else "@"
+        if lines[i + 1] != "0;JMP" and after[0] not in "@(":
+            continue
+        label = line[1:]
+        seen = {label}
+        while (
+            next_label := _jump_at(lines, label, targets)
+        ) and next_label not in seen:
+            seen.add(next_label)
+            label = next_label
+        if label != line[1:]:
+            result[i] = f"@{label}"
+            threaded += 1
+    return result, 2 * threaded
+
+
+# @x 0;JMP (x) falls through anyway
+def remove_jumps_to_next(lines: list[str]) -> tuple[list[str], int]:
+    result: list[str] = []
+    for line in lines:
+        if (
+            _is_label(line)
+            and len(result) >= 2
+            and result[-1] == "0;JMP"
+            and result[-2] == f"@{line[1:-1]}"
+        ):
+            del result[-2:]
+        result.append(line)
+    return result, len(lines) - len(result)
+
+
+# nothing after an unconditional jump runs until the next label
+def remove_unreachable(lines: list[str]) -> tuple[list[str], int]:
+    result: list[str] = []
+    reachable = True
+    for line in lines:
+        if _is_label(line):
+            reachable = True
+        if reachable:
+            result.append(line)
+        if line == "0;JMP":
+            reachable = False
+    return result, 0
+
+
+# Rules return the rewritten lines and the cycles they save
+Rule = Callable[[list[str]], tuple[list[str], int]]
+
+rules: dict[str, Rule] = {
+    **{
+        name: lambda lines, rule=rule: _apply_window(lines, *rule)
+        for name, rule in window_rules.items()
+    },
+    "dead_store": remove_dead_stores,
+    "jump_threading": thread_jumps,
+    "jump_to_next": remove_jumps_to_next,
+    "unreachable": remove_unreachable,
+}
+
+
+def _cycles(name: str, result: int) -> int:
+    if name in window_rules:
+        # result is the number of rewritten sites
+        pattern, replacement = window_rules[name]
+        return result * (len(pattern) - len(replacement))
+    return result
+
+
+def peephole(lines: list[str], report: PeepholeReport | None = None) -> list[str]:
+    changed = True
+    while changed:
+        changed = False
+        for name, rule in rules.items():
+            optimized, result = rule(lines)
+            if optimized == lines:
+                continue
+            changed = True
+            if report is not None:
+                savings = report.setdefault(name, {"instructions": 0, "cycles": 0})
+                savings["instructions"] += sum(
+                    not _is_label(line) for line in lines
+                ) - sum(not _is_label(line) for line in optimized)
+                savings["cycles"] += _cycles(name, result)
+            lines = optimized
+    return lines
@@ -0,0 +1,61 @@
+import glob
+import os
+
+from Assembler import assemble, iter_code_lines
+from CPUEmulator import HackCPU
+from hackopt import PeepholeReport, peephole
+from VMTranslator import translate_program
+from vmcode import parse_vm, read_program
+
+projects_dir = os.path.join(os.path.dirname(__file__), "..", "projects")
+
+
+def translated(text: str) -> list[str]:
+    return list(
+        iter_code_lines(translate_program({"Main": parse_vm(text)}).splitlines())
+    )
+
+
+class TestPeephole:
+    def test_push_then_pop(self):
+        report: PeepholeReport = {}
+        lines = peephole(translated("push constant 7\npop temp 0"), report)
+        assert lines[:5] == ["@7", "D=A", "@5", "M=D", "(END_LOOP)"]
+        assert report["direct_pop"] == {"instructions": 5, "cycles": 5}
+
+    def test_push_reload_only_after_sp(self):
+        lines = ["@SP", "M=M+1", "A=M-1", "M=D", "@SP", "A=M-1", "M=0"]
+        assert peephole(lines) == ["@SP", "M=M+1", "A=M-1", "M=D", "M=0"]
+        # A was LCL - 1, not SP - 1
+        lines = ["@LCL", "M=M+1", "A=M-1", "M=D", "@SP", "A=M-1", "M=0"]
+        assert peephole(lines) == lines
+
+    def test_jump_threading(self):
+        lines = ["@A", "0;JMP", "(A)", "@B", "0;JMP", "(B)", "@B", "0;JMP"]
+        assert peephole(lines) == ["@B", "0;JMP", "(A)", "(B)", "@B", "0;JMP"]
+
+    def test_conditional_jump_keeps_a_for_fall_through(self):
+        lines = ["@A", "D;JNE", "M=D", "(A)", "@B", "0;JMP", "(B)"]
+        assert peephole(lines)[0] == "@A"
+
+    def test_fewer_cycles_same_results(self):
+        program = read_program(
+            glob.glob(
+                os.path.join(
+                    projects_dir, "08", "ProgramFlow", "FibonacciSeries", "*.vm"
+                )
+            )
+        )
+        lines = list(iter_code_lines(translate_program(program).splitlines()))
+        cpus = []
+        for code in (lines, peephole(lines)):
+            cpu = HackCPU(assemble(code))
+            cpu.ram[0:3] = type(cpu.ram)("h", [256, 300, 400])
+            cpu.ram[400:402] = type(cpu.ram)("h", [10, 3000])
+            cpu.run(10000)
+            assert cpu.halted
+            cpus.append(cpu)
+        plain, optimized = cpus
+        assert list(optimized.ram[3000:3010]) == list(plain.ram[3000:3010])
+        assert list(plain.ram[3000:3010]) == [0, 1, 1, 2, 3, 5, 8, 13, 21, 34]
+        assert optimized.cycles < plain.cycles * 0.7
@@ -0,0 +1,79 @@
+import mmap
+import struct
+import sys
+from array import array
+from collections.abc import Iterable, Sequence
+from typing import Literal
+
+BYTEORDER = Literal["little", "big"]
+
+# Packed ROM image: a 12 byte little-endian header followed by the words.
+#   magic      4s  b"HROM"
+#   version    B   ROM_VERSION
+#   byteorder  B   0 little, 1 big (byte order of the words, not the header)
+#   reserved   H
+#   length     I   number of words
+ROM_MAGIC = b"HROM"
+ROM_VERSION = 1
+ROM_HEADER = struct.Struct("<4sBBHI")
+
+byteorder_codes = {"little": 0, "big": 1}
+
+
+def pack_rom_image(words: Iterable[int], byteorder: BYTEORDER = "little") -> bytes:
+    packed = words if isinstance(words, array) else array("H", words)
+    if byteorder != sys.byteorder:
+        packed = array("H", packed)
+        packed.byteswap()
+    header = ROM_HEADER.pack(
+        ROM_MAGIC, ROM_VERSION, byteorder_codes[byteorder], 0, len(packed)
+    )
+    return b"".join((header, packed))
+
+
+def write_rom_image(
+    words: Iterable[int], rompath: str, byteorder: BYTEORDER = "little"
+):
+    with open(rompath, "wb") as w:
+        w.write(pack_rom_image(words, byteorder))
+
+
+# Words are a zero-copy view over the mmapped file when the image has the
+# native byte order, otherwise they are copied and swapped into an array.
+def load_rom_image(rompath: str) -> Sequence[int]:
+    with open(rompath, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(mapped) < ROM_HEADER.size:
+        raise ValueError(f"{rompath} is too short to be a ROM image")
+    magic, version, byteorder, _, length = ROM_HEADER.unpack_from(mapped)
+    if magic != ROM_MAGIC:
+        raise ValueError(f"{rompath} is not a ROM image")
+    if version != ROM_VERSION:
+        raise ValueError(f"Unsupported ROM image version {version} in {rompath}")
+    end = ROM_HEADER.size + 2 * length
+    if len(mapped) < end:
+        raise ValueError(f"{rompath} is truncated")
+
+    words = memoryview(mapped)[ROM_HEADER.size : end].cast("H")
+    if byteorder != byteorder_codes[sys.byteorder]:
+        swapped = array("H", words)
+        swapped.byteswap()
+        return swapped
+    return words
+
+
+def read_hack_text(hackpath: str) -> array:
+    with open(hackpath, "r") as f:
+        return array("H", (int(line, 2) for line in f.read().split()))
+
+
+def is_rom_image(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(ROM_MAGIC)) == ROM_MAGIC
+
+
+def load_rom(path: str) -> Sequence[int]:
+    if is_rom_image(path):
+        return load_rom_image(path)
+    return read_hack_text(path)
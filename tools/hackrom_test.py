@@ -0,0 +1,25 @@
+import os
+
+import pytest
+from hackrom import load_rom, load_rom_image, read_hack_text, write_rom_image
+
+projects_dir = os.path.join(os.path.dirname(__file__), "..", "projects")
+
+
+class TestRomImage:
+    @pytest.mark.parametrize("byteorder", ["little", "big"])
+    def test_round_trip(self, tmp_path, byteorder):
+        hackpath = os.path.join(projects_dir, "06", "pong", "Pong.hack")
+        rompath = str(tmp_path / "Pong.rom")
+        words = read_hack_text(hackpath)
+        write_rom_image(words, rompath, byteorder)
+
+        assert os.path.getsize(rompath) == 12 + 2 * len(words)
+        assert list(load_rom_image(rompath)) == list(words)
+        assert list(load_rom(rompath)) == list(words)
+
+    def test_rejects_text(self):
+        hackpath = os.path.join(projects_dir, "06", "add", "Add.hack")
+        with pytest.raises(ValueError):
+            load_rom_image(hackpath)
+        assert len(load_rom(hackpath)) == 6
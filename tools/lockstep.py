@@ -0,0 +1,129 @@
+from collections.abc import Iterable
+
+import numpy as np
+from CPUEmulator import RAM_SIZE, ROM_SIZE, find_halt_pcs
+
+# One decoded C-instruction, as (uses M, zx, nx, zy, ny, f, no, dest, jump)
+DecodedBatchInstruction = tuple[int, int, int, int, int, int, int, int, int]
+
+
+def decode_batch(word: int) -> DecodedBatchInstruction | int:
+    if not word & 0x8000:
+        return word
+    return (
+        (word >> 12) & 1,
+        *((word >> bit) & 1 for bit in range(11, 5, -1)),
+        (word >> 3) & 0b111,
+        word & 0b111,
+    )
+
+
+# N independent Hack machines running one ROM in lockstep, with RAM as an
+# (N, 32768) int16 array. Every instruction is applied with vectorized
+# operations to all machines at the same pc. int16 arithmetic wraps like
+# the Hack ALU, so no masking is needed.
+# Machines whose pcs diverge after a conditional jump are stepped as separate
+# groups until they meet again.
+class HackCPUBatch:
+    def __init__(self, rom: Iterable[int], n: int):
+        words = list(rom)
+        if len(words) > ROM_SIZE:
+            raise ValueError(f"Program of {len(words)} words does not fit ROM")
+        self.n = n
+        self.program = [decode_batch(word) for word in words]
+        self.program += [0] * (ROM_SIZE - len(self.program))
+        self.halt_pcs = find_halt_pcs(words)
+
+        self.ram = np.zeros((n, RAM_SIZE), dtype=np.int16)
+        self.a = np.zeros(n, dtype=np.int16)
+        self.d = np.zeros(n, dtype=np.int16)
+        self.pc = np.zeros(n, dtype=np.int32)
+        self.halted = np.zeros(n, dtype=bool)
+        # cycle at which each machine halted, or -1
+        self.halted_at = np.full(n, -1, dtype=np.int64)
+        self.cycles = 0
+        self._rows = np.arange(n)
+
+    def reset(self):
+        self.pc[:] = 0
+        self.halted[:] = False
+        self.halted_at[:] = -1
+        self.cycles = 0
+
+    # Runs until every machine halted or max_cycles lockstep cycles passed,
+    # returns the number of cycles run.
+    def run(self, max_cycles: int) -> int:
+        start = self.cycles
+        pc = self.pc
+        halted = self.halted
+        for _ in range(max_cycles):
+            active = ~halted
+            if not active.any():
+                break
+            pcs = pc[active]
+            first = int(pcs[0])
+            if (pcs == first).all():
+                rows = slice(None) if active.all() else np.nonzero(active)[0]
+                self._execute(first, rows)
+            else:
+                # grouped before any group runs, so a machine that jumps to
+                # a pc still to be visited doesn't step twice
+                groups = [
+                    (int(p), np.nonzero(active & (pc == p))[0]) for p in np.unique(pcs)
+                ]
+                for p, rows in groups:
+                    self._execute(p, rows)
+            self.cycles += 1
+        return self.cycles - start
+
+    def _execute(self, pc: int, rows: slice | np.ndarray):
+        instruction = self.program[pc]
+        if isinstance(instruction, int):
+            self.a[rows] = instruction
+            self.pc[rows] += 1
+            return
+
+        uses_m, zx, nx, zy, ny, f, no, dest, jump = instruction
+        a = self.a[rows]
+        if uses_m or dest & 0b001:
+            addresses = a.astype(np.intp) & 0x7FFF
+            row_indices = self._rows[rows]
+
+        x = np.zeros_like(a) if zx else self.d[rows]
+        if uses_m:
+            y = self.ram[row_indices, addresses]
+        else:
+            y = a
+        if zy:
+            y = np.zeros_like(a)
+        if nx:
+            x = ~x
+        if ny:
+            y = ~y
+        out = x + y if f else x & y
+        if no:
+            out = ~out
+
+        if dest & 0b001:
+            self.ram[row_indices, addresses] = out
+        if dest & 0b010:
+            self.d[rows] = out
+        if dest & 0b100:
+            self.a[rows] = out
+
+        if not jump:
+            self.pc[rows] += 1
+            return
+        taken = np.zeros(out.shape, dtype=bool)
+        if jump & 0b100:
+            taken |= out < 0
+        if jump & 0b010:
+            taken |= out == 0
+        if jump & 0b001:
+            taken |= out > 0
+        target = self.a[rows].astype(np.int32) & 0x7FFF
+        self.pc[rows] = np.where(taken, target, self.pc[rows] + 1)
+        if pc in self.halt_pcs and taken.any():
+            halting = self._rows[rows][taken]
+            self.halted[halting] = True
+            self.halted_at[halting] = self.cycles + 1
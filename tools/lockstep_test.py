@@ -0,0 +1,59 @@
+import os
+
+import pytest
+from Assembler import assemble
+from CPUEmulator import HackCPU
+
+np = pytest.importorskip("numpy")
+from lockstep import HackCPUBatch
+
+projects_dir = os.path.join(os.path.dirname(__file__), "..", "projects")
+
+
+class TestHackCPUBatch:
+    def test_mult_sweep(self):
+        rom = HackCPU.from_file(
+            os.path.join(projects_dir, "04", "mult", "Mult.asm")
+        ).rom
+        r0, r1 = (g.ravel() for g in np.meshgrid(np.arange(16), np.arange(-8, 8)))
+        batch = HackCPUBatch(rom, len(r0))
+        batch.ram[:, 0] = r0
+        batch.ram[:, 1] = r1
+        batch.ram[:, 2] = -1
+
+        batch.run(1000)
+        assert batch.halted.all()
+        assert (batch.ram[:, 2] == r0 * r1).all()
+
+    def test_matches_single_machine(self):
+        rom = HackCPU.from_file(os.path.join(projects_dir, "06", "max", "Max.asm")).rom
+        inputs = [(3, 5), (5, 3), (-20000, 10000), (0, 0)]
+        batch = HackCPUBatch(rom, len(inputs))
+        for i, (x, y) in enumerate(inputs):
+            batch.ram[i, 0], batch.ram[i, 1] = x, y
+        batch.run(100)
+
+        for i, (x, y) in enumerate(inputs):
+            cpu = HackCPU(rom)
+            cpu.ram[0], cpu.ram[1] = x, y
+            cpu.run(100)
+            assert batch.halted_at[i] == cpu.cycles
+            assert batch.ram[i, 2] == cpu.ram[2] == max(x, y)
+            assert (batch.a[i], batch.d[i], batch.pc[i]) == (cpu.a, cpu.d, cpu.pc)
+
+    def test_diverging_machines(self):
+        rom = assemble(
+            "@R0 D=M @SKIP D;JGT @R1 (SKIP) M=M+1 @7 D=A (END) @END 0;JMP".split()
+        )
+        inputs = [1, -1]
+        for cycles in (6, 100):
+            batch = HackCPUBatch(rom, len(inputs))
+            batch.ram[:, 0] = inputs
+            batch.run(cycles)
+            for i, r0 in enumerate(inputs):
+                cpu = HackCPU(rom)
+                cpu.ram[0] = r0
+                cpu.run(cycles)
+                assert batch.pc[i] == cpu.pc
+                assert (batch.ram[i, :16] == cpu.ram[:16]).all()
+                assert batch.halted_at[i] == (cpu.cycles if cpu.halted else -1)
@@ -1,3 +1,4 @@
+import glob
 import os
 from typing import Iterable
 
@@ -6,7 +7,9 @@ from genericpath import isdir, isfile
 
 def get_vm_filepaths(path: str) -> list[str]:
     dirpath = os.path.dirname(path)
-    filenames = os.listdir(dirpath)
+    # sorted so the files, and the program built from them, are always in
+    # the same order
+    filenames = sorted(os.listdir(dirpath))
     return [
         os.path.join(dirpath, filename)
         for filename in filenames
@@ -14,6 +17,28 @@ def get_vm_filepaths(path: str) -> list[str]:
     ]
 
 
+def find_filepaths(paths: Iterable[str], ext: str) -> list[str]:
+    filepaths = []
+    for path in paths:
+        if isdir(path):
+            for dirpath, _, filenames in sorted(os.walk(path)):
+                filepaths += [
+                    os.path.join(dirpath, filename)
+                    for filename in sorted(filenames)
+                    if os.path.splitext(filename)[1] == f".{ext}"
+                ]
+        elif any(c in path for c in "*?["):
+            # matched directories are searched, matched files filtered
+            for match in sorted(glob.glob(path, recursive=True)):
+                if isdir(match):
+                    filepaths += find_filepaths([match], ext)
+                elif os.path.splitext(match)[1] == f".{ext}":
+                    filepaths.append(match)
+        else:
+            filepaths.append(path)
+    return list(dict.fromkeys(filepaths))
+
+
 def get_asm_filepath_from_path(path: str) -> str:
     if isfile(path):
         dirpath = os.path.dirname(path)
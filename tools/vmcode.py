@@ -0,0 +1,84 @@
+import os
+from typing import NamedTuple
+
+from utils import get_filename_no_ext
+
+
+# One VM command, e.g. Command("push", "local", 2), Command("add"),
+# Command("call", "Math.multiply", 2)
+class Command(NamedTuple):
+    op: str
+    arg1: str = ""
+    arg2: int = 0
+
+
+arithmetic_ops = {"add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"}
+segments = {
+    "constant",
+    "local",
+    "argument",
+    "this",
+    "that",
+    "pointer",
+    "temp",
+    "static",
+}
+
+
+def format_command(command: Command) -> str:
+    if command.op in arithmetic_ops or command.op == "return":
+        return command.op
+    if command.op in ("label", "goto", "if-goto"):
+        return f"{command.op} {command.arg1}"
+    return f"{command.op} {command.arg1} {command.arg2}"
+
+
+def parse_vm(text: str, filename: str = "<vm>") -> list[Command]:
+    commands = []
+    for number, line in enumerate(text.splitlines(), 1):
+        words = line.split("//", 1)[0].split()
+        if not words:
+            continue
+        op = words[0]
+        try:
+            if op in arithmetic_ops or op == "return":
+                commands.append(Command(op))
+            elif op in ("label", "goto", "if-goto"):
+                commands.append(Command(op, words[1]))
+            elif op in ("push", "pop", "function", "call"):
+                commands.append(Command(op, words[1], int(words[2])))
+            else:
+                raise ValueError(f"Unknown command {op}")
+        except (IndexError, ValueError) as e:
+            raise ValueError(f"{filename}:{number}: {line.strip()}: {e}")
+    return commands
+
+
+def read_vm_file(filepath: str) -> list[Command]:
+    with open(filepath, "r") as f:
+        return parse_vm(f.read(), filepath)
+
+
+# A program is its .vm files by class (file) name, in a stable order
+Program = dict[str, list[Command]]
+
+
+def read_program(filepaths: list[str]) -> Program:
+    return {get_filename_no_ext(path): read_vm_file(path) for path in filepaths}
+
+
+os_dir = os.path.join(os.path.dirname(__file__), "OS")
+
+
+def read_os() -> Program:
+    return read_program(
+        sorted(
+            os.path.join(os_dir, filename)
+            for filename in os.listdir(os_dir)
+            if filename.endswith(".vm")
+        )
+    )
+
+
+class VMError(Exception):
+    pass
@@ -0,0 +1,457 @@
+from collections.abc import Callable
+
+from CPUEmulator import to_word
+from vmcode import Command, Program
+
+# Passes rewrite one file's commands, each is run to a fixed point with
+# the others. Labels are scoped by function, like the translator's.
+Pass = Callable[[list[Command]], list[Command]]
+
+# commands removed by each pass
+OptimizeReport = dict[str, int]
+
+binary_ops: dict[str, Callable[[int, int], int]] = {
+    "add": lambda x, y: x + y,
+    "sub": lambda x, y: x - y,
+    "and": lambda x, y: x & y,
+    "or": lambda x, y: x | y,
+    "eq": lambda x, y: -(x == y),
+    "gt": lambda x, y: -(x > y),
+    "lt": lambda x, y: -(x < y),
+}
+
+# ops that only leave true (-1) or false (0) on the stack
+boolean_ops = {"eq", "gt", "lt"}
+
+
+def _push_value(value: int) -> list[Command]:
+    value = to_word(value)
+    if value >= 0:
+        return [Command("push", "constant", value)]
+    return [Command("push", "constant", ~value), Command("not")]
+
+
+def _is_constant(command: Command) -> bool:
+    return command.op == "push" and command.arg1 == "constant"
+
+
+# push constant a; push constant b; op -> push constant (a op b), negative
+# results as push constant ~r; not. Also drops not; not.
+def fold_constants(commands: list[Command]) -> list[Command]:
+    result: list[Command] = []
+    for command in commands:
+        if (
+            command.op in binary_ops
+            and len(result) >= 2
+            and _is_constant(result[-1])
+            and _is_constant(result[-2])
+        ):
+            y = result.pop().arg2
+            x = result.pop().arg2
+            result += _push_value(binary_ops[command.op](x, y))
+        elif command.op == "not" and result and result[-1].op == "not":
+            result.pop()
+        else:
+            result.append(command)
+    return result
+
+
+# Nothing after a goto or return runs until the next label or function.
+def remove_unreachable(commands: list[Command]) -> list[Command]:
+    result: list[Command] = []
+    reachable = True
+    for command in commands:
+        if command.op in ("label", "function"):
+            reachable = True
+        if reachable:
+            result.append(command)
+        if command.op in ("goto", "return"):
+            reachable = False
+    return result
+
+
+def remove_unused_labels(commands: list[Command]) -> list[Command]:
+    function = ""
+    used: set[tuple[str, str]] = set()
+    for command in commands:
+        if command.op == "function":
+            function = command.arg1
+        elif command.op in ("goto", "if-goto"):
+            used.add((function, command.arg1))
+
+    result: list[Command] = []
+    function = ""
+    for command in commands:
+        if command.op == "function":
+            function = command.arg1
+        if command.op != "label" or (function, command.arg1) in used:
+            result.append(command)
+    return result
+
+
+# push x i; pop x i writes back the value that's already there. Also drops
+# goto L; label L.
+def remove_push_pop(commands: list[Command]) -> list[Command]:
+    result: list[Command] = []
+    for command in commands:
+        previous = result[-1] if result else None
+        if (
+            previous is not None
+            and previous.op == "push"
+            and command.op == "pop"
+            and previous[1:] == command[1:]
+        ):
+            result.pop()
+        elif (
+            previous is not None
+            and previous.op == "goto"
+            and command.op == "label"
+            and previous.arg1 == command.arg1
+        ):
+            result[-1] = command
+        else:
+            result.append(command)
+    return result
+
+
+# For a boolean condition,
+#   not; if-goto A; goto B; label A -> if-goto B; label A
+#   if-goto A; goto B; label A -> not; if-goto B; label A
+# so the fall through is the true branch, as the Jack compiler's if
+# statements are.
+def invert_branches(commands: list[Command]) -> list[Command]:
+    result: list[Command] = []
+    i = 0
+    while i < len(commands):
+        window = commands[i : i + 3]
+        if (
+            len(window) == 3
+            and [c.op for c in window] == ["if-goto", "goto", "label"]
+            and window[0].arg1 == window[2].arg1
+            and len(result) >= 1
+        ):
+            branch = Command("if-goto", window[1].arg1)
+            if (
+                result[-1].op == "not"
+                and len(result) >= 2
+                and result[-2].op in boolean_ops
+            ):
+                result[-1] = branch
+                result.append(window[2])
+                i += 3
+                continue
+            if result[-1].op in boolean_ops:
+                result += [Command("not"), branch, window[2]]
+                i += 3
+                continue
+        result.append(commands[i])
+        i += 1
+    return result
+
+
+passes: dict[str, Pass] = {
+    "fold_constants": fold_constants,
+    "remove_unreachable": remove_unreachable,
+    "remove_unused_labels": remove_unused_labels,
+    "remove_push_pop": remove_push_pop,
+    "invert_branches": invert_branches,
+}
+
+
+def optimize_commands(
+    commands: list[Command], report: OptimizeReport | None = None
+) -> list[Command]:
+    changed = True
+    while changed:
+        changed = False
+        for name, run_pass in passes.items():
+            optimized = run_pass(commands)
+            if optimized != commands:
+                changed = True
+                if report is not None:
+                    report[name] = report.get(name, 0) + len(commands) - len(optimized)
+                commands = optimized
+    return commands
+
+
+def optimize(program: Program, report: OptimizeReport | None = None) -> Program:
+    return {
+        cls: optimize_commands(commands, report) for cls, commands in program.items()
+    }
+
+
+def _function_bodies(commands: list[Command]) -> list[tuple[str, list[Command]]]:
+    # code before the first function is kept under the name ""
+    bodies: list[tuple[str, list[Command]]] = [("", [])]
+    for command in commands:
+        if command.op == "function":
+            bodies.append((command.arg1, []))
+        bodies[-1][1].append(command)
+    return bodies
+
+
+def call_graph(program: Program) -> dict[str, set[str]]:
+    graph: dict[str, set[str]] = {}
+    for commands in program.values():
+        for name, body in _function_bodies(commands):
+            graph.setdefault(name, set()).update(
+                command.arg1 for command in body if command.op == "call"
+            )
+    return graph
+
+
+# Drops the functions that can't be called from Sys.init, returning the
+# remaining program and the dropped functions by file. Programs without
+# Sys.init are kept whole.
+def eliminate_dead_functions(
+    program: Program, root: str = "Sys.init"
+) -> tuple[Program, Program]:
+    graph = call_graph(program)
+    if root not in graph:
+        return program, {}
+    reachable = {"", root}
+    pending = ["", root]
+    while pending:
+        for callee in graph.get(pending.pop(), ()):
+            if callee not in reachable:
+                reachable.add(callee)
+                pending.append(callee)
+
+    kept: Program = {}
+    dropped: Program = {}
+    for cls, commands in program.items():
+        for name, body in _function_bodies(commands):
+            target = kept if name in reachable else dropped
+            target.setdefault(cls, []).extend(body)
+    return kept, dropped
+
+
+# temp 0-7, what inlined arguments, locals and saved pointers are kept in
+TEMP_SIZE = 8
+
+# commands in a function body, without function and the final return, for
+# it to be inlined
+DEFAULT_INLINE_BUDGET = 12
+
+# call sites inlined for each function
+InlineReport = dict[str, int]
+
+# Sys.halt never returns, and the emulators tell a program has ended by
+# the call to it
+never_inlined = {"Sys.halt"}
+
+stack_effects = {
+    "push": 1,
+    "pop": -1,
+    "if-goto": -1,
+    **{op: -1 for op in binary_ops},
+    "neg": 0,
+    "not": 0,
+}
+
+
+# The stack depth before each command of a function body, relative to
+# its start, None for the commands after a goto or return up to the next
+# label. None for the whole body when jumps to a label disagree on the
+# depth, or a label is only reached by jumping back to it.
+def _stack_depths(body: list[Command]) -> list[int | None] | None:
+    depths: list[int | None] = []
+    depth: int | None = 0
+    label_depths: dict[str, int] = {}
+    for command in body:
+        if command.op == "label":
+            known = label_depths.get(command.arg1, depth)
+            if known is None or depth not in (None, known):
+                return None
+            depth = label_depths[command.arg1] = known
+        depths.append(depth)
+        if depth is None:
+            continue
+        if command.op in ("goto", "if-goto"):
+            depth += stack_effects.get(command.op, 0)
+            if label_depths.setdefault(command.arg1, depth) != depth:
+                return None
+        elif command.op == "call":
+            depth += 1 - command.arg2
+        elif command.op in stack_effects:
+            depth += stack_effects[command.op]
+        if depth < 0:
+            return None
+        if command.op in ("goto", "return"):
+            depth = None
+    return depths
+
+
+# Whether every return leaves exactly the return value on the function's
+# stack, so the inlined body leaves the caller's stack as the call would.
+def _returns_one_value(body: list[Command]) -> bool:
+    depths = _stack_depths(body)
+    return depths is not None and all(
+        depth in (None, 1)
+        for command, depth in zip(body, depths)
+        if command.op == "return"
+    )
+
+
+def _inlinable(body: list[Command], budget: int) -> bool:
+    return (
+        len(body) - 2 <= budget
+        and body[-1].op == "return"
+        and all(command.op != "call" for command in body)
+        and _returns_one_value(body[1:])
+    )
+
+
+# The body of function f for a call f number_args, with arguments and
+# locals in temp slots the body doesn't use and the pointers it sets
+# restored after. Labels are renamed by prefix. None when temp is too
+# small or the body reads past its arguments.
+def _inline_call(
+    body: list[Command], number_args: int, prefix: str
+) -> list[Command] | None:
+    function, *commands, _ = body
+    used = {c.arg2 for c in commands if c.arg1 == "temp"}
+    pointers = sorted({c.arg2 for c in commands if c[:2] == ("pop", "pointer")})
+    free = [slot for slot in range(TEMP_SIZE) if slot not in used]
+    if number_args + function.arg2 + len(pointers) > len(free):
+        return None
+    arguments = free[:number_args]
+    locals_ = free[number_args : number_args + function.arg2]
+    saved = free[number_args + function.arg2 :]
+    slots = {"argument": arguments, "local": locals_}
+
+    result = [Command("pop", "temp", slot) for slot in reversed(arguments)]
+    for slot in locals_:
+        result += [Command("push", "constant", 0), Command("pop", "temp", slot)]
+    for pointer, slot in zip(pointers, saved):
+        result += [Command("push", "pointer", pointer), Command("pop", "temp", slot)]
+    returns = False
+    for command in commands:
+        op, segment, index = command
+        if segment in slots and op in ("push", "pop"):
+            if index >= len(slots[segment]):
+                return None
+            command = Command(op, "temp", slots[segment][index])
+        elif op in ("label", "goto", "if-goto"):
+            command = Command(op, f"{prefix}.{segment}")
+        elif op == "return":
+            command = Command("goto", f"{prefix}.RETURN")
+            returns = True
+        result.append(command)
+    if returns:
+        result.append(Command("label", f"{prefix}.RETURN"))
+    for pointer, slot in zip(pointers, saved):
+        result += [Command("push", "temp", slot), Command("pop", "pointer", pointer)]
+    return result
+
+
+# Replaces calls to small leaf functions with their bodies, saving the
+# frame save and restore of the call and return. The functions themselves
+# are kept, eliminate_dead_functions drops the ones no longer called.
+# Bodies using statics are only inlined in their own file.
+def inline_functions(
+    program: Program,
+    budget: int = DEFAULT_INLINE_BUDGET,
+    report: InlineReport | None = None,
+) -> Program:
+    inlinable = {
+        name: (cls, body)
+        for cls, commands in program.items()
+        for name, body in _function_bodies(commands)
+        if name and name not in never_inlined and _inlinable(body, budget)
+    }
+    uses_statics = {
+        name
+        for name, (_, body) in inlinable.items()
+        if any(command.arg1 == "static" for command in body)
+    }
+
+    result: Program = {}
+    for cls, commands in program.items():
+        inlined: list[Command] = []
+        sites = 0
+        for command in commands:
+            callee = command.arg1
+            code = None
+            if (
+                command.op == "call"
+                and callee in inlinable
+                and (callee not in uses_statics or inlinable[callee][0] == cls)
+            ):
+                code = _inline_call(
+                    inlinable[callee][1], command.arg2, f"{callee}.{sites}"
+                )
+            if code is None:
+                inlined.append(command)
+                continue
+            inlined += code
+            sites += 1
+            if report is not None:
+                report[callee] = report.get(callee, 0) + 1
+        result[cls] = inlined
+    return result
+
+
+# tail calls rewritten in each function
+TailCallReport = dict[str, int]
+
+TAIL_CALL_LABEL = "TAIL_CALL"
+
+
+# A function calling itself and returning the result, call f n; return in
+# f, reuses its frame: the arguments are popped over its own, the locals
+# zeroed and it jumps back to its start. The stack then doesn't grow with
+# the recursion. Only when the arguments are all that's on the working
+# stack, and f uses at least n arguments so they're within its frame.
+def _eliminate_tail_calls(body: list[Command]) -> tuple[list[Command], int]:
+    function = body[0]
+    depths = _stack_depths(body)
+    arguments = 1 + max(
+        (c.arg2 for c in body if c.arg1 == "argument" and c.op in ("push", "pop")),
+        default=-1,
+    )
+    if depths is None or Command("label", TAIL_CALL_LABEL) in body:
+        return body, 0
+
+    result = [function, Command("label", TAIL_CALL_LABEL)]
+    rewritten = 0
+    i = 1
+    while i < len(body):
+        command = body[i]
+        if (
+            command[:2] == ("call", function.arg1)
+            and i + 1 < len(body)
+            and body[i + 1].op == "return"
+            and depths[i] == command.arg2 <= arguments
+        ):
+            result += [
+                Command("pop", "argument", index)
+                for index in reversed(range(command.arg2))
+            ]
+            for index in range(function.arg2):
+                result += [
+                    Command("push", "constant", 0),
+                    Command("pop", "local", index),
+                ]
+            result.append(Command("goto", TAIL_CALL_LABEL))
+            rewritten += 1
+            i += 2
+            continue
+        result.append(command)
+        i += 1
+    return (result, rewritten) if rewritten else (body, 0)
+
+
+def eliminate_tail_calls(
+    program: Program, report: TailCallReport | None = None
+) -> Program:
+    result: Program = {}
+    for cls, commands in program.items():
+        result[cls] = []
+        for name, body in _function_bodies(commands):
+            if name:
+                body, rewritten = _eliminate_tail_calls(body)
+                if rewritten and report is not None:
+                    report[name] = rewritten
+            result[cls] += body
+    return result
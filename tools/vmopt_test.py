@@ -0,0 +1,326 @@
+import glob
+import os
+
+from VMEmulator import VM, link
+from vmcode import Command, format_command, parse_vm, read_os, read_program
+from vmopt import (
+    InlineReport,
+    OptimizeReport,
+    TailCallReport,
+    eliminate_dead_functions,
+    eliminate_tail_calls,
+    inline_functions,
+    optimize,
+    optimize_commands,
+)
+
+projects_dir = os.path.join(os.path.dirname(__file__), "..", "projects")
+
+
+def optimized(text: str, report: OptimizeReport | None = None) -> str:
+    return "\n".join(
+        format_command(command) for command in optimize_commands(parse_vm(text), report)
+    )
+
+
+class TestPasses:
+    def test_fold_constants(self):
+        assert optimized("push constant 7\npush constant 8\nadd") == "push constant 15"
+        # 32767 + 1 wraps to -32768 = ~32767
+        assert (
+            optimized("push constant 32767\npush constant 1\nadd")
+            == "push constant 32767\nnot"
+        )
+        assert (
+            optimized("push constant 1\npush constant 2\nlt") == "push constant 0\nnot"
+        )
+
+    def test_unreachable_and_unused_labels(self):
+        report: OptimizeReport = {}
+        text = """
+            function Main.f 0
+            goto END
+            push constant 1
+            label END
+            label UNUSED
+            push constant 0
+            return
+            push constant 2
+            """
+        assert optimized(text, report) == "function Main.f 0\npush constant 0\nreturn"
+        assert report == {
+            "remove_unreachable": 2,
+            "remove_unused_labels": 2,
+            "remove_push_pop": 1,
+        }
+
+    def test_push_pop(self):
+        assert optimized("push local 1\npop local 1\npush local 1\npop local 2") == (
+            "push local 1\npop local 2"
+        )
+
+    def test_invert_branches(self):
+        text = """
+            function Main.f 0
+            push argument 0
+            push constant 0
+            {}
+            if-goto IF_TRUE0
+            goto IF_FALSE0
+            label IF_TRUE0
+            push constant 1
+            return
+            label IF_FALSE0
+            push constant 2
+            return
+            """
+        assert optimized(text.format("lt")).split("\n")[3:6] == [
+            "lt",
+            "not",
+            "if-goto IF_FALSE0",
+        ]
+        # add may leave any value, which not doesn't invert
+        assert "goto IF_FALSE0" in optimized(text.format("add")).split("\n")
+
+
+def test_same_results_as_unoptimized():
+    program = read_program(glob.glob(os.path.join(projects_dir, "11", "Seven", "*.vm")))
+    program.update(read_os())
+    report: OptimizeReport = {}
+    vm = VM(link(program))
+    vm.run()
+    optimized_vm = VM(link(optimize(program, report)))
+    optimized_vm.run()
+    assert vm.halted and optimized_vm.halted
+    assert optimized_vm.steps < vm.steps
+    assert all(removed > 0 for removed in report.values())
+    # values left on the stack past SP may differ
+    assert optimized_vm.ram[16:256] == vm.ram[16:256]
+    assert optimized_vm.ram[2048:] == vm.ram[2048:]
+
+
+class TestDeadFunctions:
+    def test_drops_what_sys_init_cant_call(self):
+        program = {
+            "Sys": parse_vm("function Sys.init 0\ncall Main.main 0\nreturn"),
+            "Main": parse_vm(
+                """
+                function Main.main 0
+                call Main.helper 0
+                return
+                function Main.helper 0
+                call Main.helper 0
+                return
+                function Main.unused 0
+                call Main.main 0
+                return
+                """
+            ),
+        }
+        kept, dropped = eliminate_dead_functions(program)
+        assert [c.arg1 for c in kept["Main"] if c.op == "function"] == [
+            "Main.main",
+            "Main.helper",
+        ]
+        assert dropped == {
+            "Main": parse_vm("function Main.unused 0\ncall Main.main 0\nreturn")
+        }
+
+    def test_without_sys_init(self):
+        program = {"Main": parse_vm("function Main.f 0\nreturn")}
+        assert eliminate_dead_functions(program) == (program, {})
+
+    def test_same_results_with_os(self):
+        program = read_program(
+            glob.glob(os.path.join(projects_dir, "11", "ConvertToBin", "*.vm"))
+        )
+        program.update(read_os())
+        kept, dropped = eliminate_dead_functions(program)
+        assert "Screen" in dropped and "Main" not in dropped
+        vm = VM(link(program))
+        vm.ram[8000] = 19
+        vm.run()
+        pruned_vm = VM(link(kept))
+        pruned_vm.ram[8000] = 19
+        pruned_vm.run()
+        assert pruned_vm.halted and pruned_vm.steps == vm.steps
+        assert list(pruned_vm.ram[8001:8017]) == [1, 1, 0, 0, 1] + [0] * 11
+
+
+class TestInlining:
+    def run(self, program) -> VM:
+        vm = VM(link(program))
+        vm.run(100000)
+        assert vm.halted
+        return vm
+
+    def test_inlines_leaf_functions(self):
+        program = {
+            "Main": parse_vm(
+                """
+                function Main.start 1
+                push constant 3000
+                pop pointer 1
+                push constant 42
+                pop that 0
+                push constant 7
+                pop pointer 0
+                push constant 3
+                neg
+                call Main.abs 1
+                push constant 3000
+                call Main.getter 1
+                add
+                push pointer 0
+                add
+                pop static 0
+                label END
+                goto END
+                function Main.abs 0
+                push argument 0
+                push constant 0
+                lt
+                if-goto NEGATIVE
+                push argument 0
+                return
+                label NEGATIVE
+                push argument 0
+                neg
+                return
+                function Main.getter 1
+                push argument 0
+                pop pointer 0
+                push this 0
+                pop local 0
+                push local 0
+                return
+                """
+            )
+        }
+        report: InlineReport = {}
+        inlined = inline_functions(program, report=report)
+        assert report == {"Main.abs": 1, "Main.getter": 1}
+        start = inlined["Main"][: inlined["Main"].index(Command("label", "END"))]
+        assert Command("call", "Main.abs", 1) not in start
+        vm = self.run(program)
+        inlined_vm = self.run(inlined)
+        # the caller's THIS is restored after the getter's
+        assert inlined_vm.ram[16] == vm.ram[16] == 3 + 42 + 7
+
+    def test_keeps_calls_it_cant_inline(self):
+        program = {
+            "Main": parse_vm(
+                """
+                function Main.start 0
+                call Main.caller 0
+                call Other.static 0
+                call Main.big 0
+                return
+                function Main.caller 0
+                call Main.big 0
+                return
+                function Main.big 0
+                """
+                + "push constant 1\npop temp 0\n" * 7
+                + "push constant 0\nreturn"
+            ),
+            "Other": parse_vm("function Other.static 0\npush static 0\nreturn"),
+        }
+        assert inline_functions(program, budget=10) == program
+
+    def test_same_results_with_os(self):
+        program = read_program(
+            glob.glob(os.path.join(projects_dir, "11", "ConvertToBin", "*.vm"))
+        )
+        program.update(read_os())
+        report: InlineReport = {}
+        inlined = inline_functions(program, report=report)
+        assert "Math.abs" in report and "Sys.halt" not in report
+        vm = VM(link(program))
+        vm.ram[8000] = 19
+        vm.run()
+        inlined_vm = VM(link(inlined))
+        inlined_vm.ram[8000] = 19
+        inlined_vm.run()
+        assert inlined_vm.halted and inlined_vm.steps < vm.steps
+        assert inlined_vm.ram[2048:] == vm.ram[2048:]
+        assert list(inlined_vm.ram[8001:8017]) == [1, 1, 0, 0, 1] + [0] * 11
+
+
+# count(n, total) counts n down in a local, returning total + n
+count_program = """
+    function Sys.init 0
+    push constant {n}
+    push constant 0
+    call Main.count 2
+    pop static 0
+    label END
+    goto END
+    function Main.count 1
+    push argument 0
+    push constant 0
+    eq
+    not
+    if-goto IF_FALSE0
+    push argument 1
+    return
+    label IF_FALSE0
+    push local 0
+    push constant 1
+    add
+    pop local 0
+    push argument 0
+    push constant 1
+    sub
+    push argument 1
+    push local 0
+    add
+    call Main.count 2
+    return
+    """
+
+
+class TestTailCalls:
+    def test_reuses_the_frame(self):
+        program = {"Main": parse_vm(count_program.format(n=20000))}
+        report: TailCallReport = {}
+        rewritten = eliminate_tail_calls(program, report)
+        assert report == {"Main.count": 1}
+        assert rewritten["Main"][-3:] == parse_vm(
+            "push constant 0\npop local 0\ngoto TAIL_CALL"
+        )
+        vm = VM(link(rewritten))
+        vm.run(1_000_000)
+        assert vm.halted and vm.ram[16] == 20000
+        # the stack stayed below the heap
+        assert not any(vm.ram[2048:])
+
+    def test_same_results(self):
+        program = {"Main": parse_vm(count_program.format(n=100))}
+        vm = VM(link(program))
+        vm.run()
+        tail_vm = VM(link(eliminate_tail_calls(program)))
+        tail_vm.run()
+        assert vm.ram[16] == tail_vm.ram[16] == 100
+
+    def test_only_calls_with_just_the_arguments_on_the_stack(self):
+        program = {
+            "Main": parse_vm(
+                """
+                function Main.f 0
+                push argument 0
+                push argument 0
+                call Main.f 1
+                return
+                function Main.g 0
+                push argument 0
+                call Main.g 2
+                return
+                function Main.h 0
+                push argument 0
+                call Main.f 1
+                return
+                """
+            )
+        }
+        assert eliminate_tail_calls(program) == program
@@ -0,0 +1,394 @@
+import math
+import os
+from array import array
+from collections.abc import Callable
+
+from CPUEmulator import to_word
+from vmcode import Command, os_dir, read_vm_file
+
+HEAP_BASE = 2048
+HEAP_END = 16384
+SCREEN = 16384
+SCREEN_ROWS = 23
+SCREEN_COLUMNS = 64
+CHAR_HEIGHT = 11
+
+NEWLINE = 128
+BACKSPACE = 129
+DOUBLE_QUOTE = 34
+
+
+# Glyphs from the Output.create calls in the OS's Output.initMap, each a
+# run of 12 constants: the character then its 11 rows.
+def read_font(
+    filepath: str = os.path.join(os_dir, "Output.vm")
+) -> dict[int, list[int]]:
+    commands = read_vm_file(filepath)
+    font = {}
+    for i, command in enumerate(commands):
+        if command == Command("call", "Output.create", 12) and i >= 12:
+            pushed = commands[i - 12 : i]
+            if all(c.op == "push" and c.arg1 == "constant" for c in pushed):
+                font[pushed[0].arg2] = [c.arg2 for c in pushed[1:]]
+    return font
+
+
+# Python versions of the OS classes, sharing the VM's RAM. Each class is
+# replaced as a whole since its functions share private state. String
+# objects are [capacity, length, chars...] on the heap.
+class NativeOS:
+    def __init__(self, ram: array):
+        self.ram = ram
+        self.halted = False
+        self.error: int | None = None
+        # what Output printed, for running programs headless
+        self.console: list[str] = []
+        self.font = read_font()
+        self.free: list[list[int]] = []
+        self.color = True
+        self.row = 0
+        self.column = 0
+        self.memory_init()
+
+    def sys_halt(self) -> int:
+        self.halted = True
+        return 0
+
+    def sys_error(self, code: int) -> int:
+        self.console.append(f"ERR{code}")
+        self.error = code
+        return self.sys_halt()
+
+    def sys_wait(self, duration: int) -> int:
+        if duration < 0:
+            return self.sys_error(1)
+        return 0
+
+    # Memory: first fit over a list of free [address, size] blocks, every
+    # block has its size in the word before it
+    def memory_init(self) -> int:
+        self.free = [[HEAP_BASE, HEAP_END - HEAP_BASE]]
+        return 0
+
+    def memory_peek(self, address: int) -> int:
+        return self.ram[address & 0x7FFF]
+
+    def memory_poke(self, address: int, value: int) -> int:
+        self.ram[address & 0x7FFF] = value
+        return 0
+
+    def memory_alloc(self, size: int) -> int:
+        if size <= 0:
+            return self.sys_error(5)
+        for block in self.free:
+            if block[1] > size:
+                address = block[0]
+                block[0] += size + 1
+                block[1] -= size + 1
+                if block[1] == 0:
+                    self.free.remove(block)
+                self.ram[address] = size + 1
+                return address + 1
+        return self.sys_error(6)
+
+    def memory_deAlloc(self, address: int) -> int:
+        block = [address - 1, self.ram[address - 1]]
+        self.free.append(block)
+        self.free.sort()
+        merged: list[list[int]] = []
+        for block in self.free:
+            if merged and merged[-1][0] + merged[-1][1] == block[0]:
+                merged[-1][1] += block[1]
+            else:
+                merged.append(block)
+        self.free = merged
+        return 0
+
+    def array_new(self, size: int) -> int:
+        if size <= 0:
+            return self.sys_error(2)
+        return self.memory_alloc(size)
+
+    def array_dispose(self, this: int) -> int:
+        return self.memory_deAlloc(this)
+
+    def math_init(self) -> int:
+        return 0
+
+    def math_abs(self, x: int) -> int:
+        return to_word(abs(x))
+
+    def math_multiply(self, x: int, y: int) -> int:
+        return to_word(x * y)
+
+    def math_divide(self, x: int, y: int) -> int:
+        if y == 0:
+            return self.sys_error(3)
+        quotient = abs(x) // abs(y)
+        return to_word(quotient if (x < 0) == (y < 0) else -quotient)
+
+    def math_min(self, x: int, y: int) -> int:
+        return min(x, y)
+
+    def math_max(self, x: int, y: int) -> int:
+        return max(x, y)
+
+    def math_sqrt(self, x: int) -> int:
+        if x < 0:
+            return self.sys_error(4)
+        return math.isqrt(x)
+
+    def string_new(self, capacity: int) -> int:
+        if capacity < 0:
+            return self.sys_error(14)
+        this = self.memory_alloc(capacity + 2)
+        self.ram[this] = capacity
+        self.ram[this + 1] = 0
+        return this
+
+    def string_dispose(self, this: int) -> int:
+        return self.memory_deAlloc(this)
+
+    def string_length(self, this: int) -> int:
+        return self.ram[this + 1]
+
+    def string_charAt(self, this: int, index: int) -> int:
+        if not 0 <= index < self.ram[this + 1]:
+            return self.sys_error(15)
+        return self.ram[this + 2 + index]
+
+    def string_setCharAt(self, this: int, index: int, c: int) -> int:
+        if not 0 <= index < self.ram[this + 1]:
+            return self.sys_error(16)
+        self.ram[this + 2 + index] = c
+        return 0
+
+    def string_appendChar(self, this: int, c: int) -> int:
+        length = self.ram[this + 1]
+        if length >= self.ram[this]:
+            return self.sys_error(17)
+        self.ram[this + 2 + length] = c
+        self.ram[this + 1] = length + 1
+        return this
+
+    def string_eraseLastChar(self, this: int) -> int:
+        if self.ram[this + 1] == 0:
+            return self.sys_error(18)
+        self.ram[this + 1] -= 1
+        return 0
+
+    def string_intValue(self, this: int) -> int:
+        chars = self.string_chars(this)
+        sign = -1 if chars[:1] == "-" else 1
+        digits = ""
+        for c in chars[sign < 0 :]:
+            if not c.isdigit():
+                break
+            digits += c
+        return to_word(sign * int(digits or "0"))
+
+    def string_setInt(self, this: int, value: int) -> int:
+        digits = str(value)
+        if len(digits) > self.ram[this]:
+            return self.sys_error(19)
+        for i, c in enumerate(digits):
+            self.ram[this + 2 + i] = ord(c)
+        self.ram[this + 1] = len(digits)
+        return 0
+
+    def string_newLine(self) -> int:
+        return NEWLINE
+
+    def string_backSpace(self) -> int:
+        return BACKSPACE
+
+    def string_doubleQuote(self) -> int:
+        return DOUBLE_QUOTE
+
+    def string_chars(self, this: int) -> str:
+        length = self.ram[this + 1]
+        return "".join(chr(c & 0x7F) for c in self.ram[this + 2 : this + 2 + length])
+
+    def screen_init(self) -> int:
+        self.color = True
+        return 0
+
+    def screen_clearScreen(self) -> int:
+        self.ram[SCREEN : SCREEN + 8192] = array("h", bytes(2 * 8192))
+        return 0
+
+    def screen_setColor(self, color: int) -> int:
+        self.color = color != 0
+        return 0
+
+    def _set_bits(self, address: int, mask: int):
+        word = self.ram[address] & 0xFFFF
+        word = word | mask if self.color else word & ~mask
+        self.ram[address] = to_word(word)
+
+    def _horizontal_line(self, x1: int, x2: int, y: int):
+        row = SCREEN + 32 * y
+        for word in range(x1 // 16, x2 // 16 + 1):
+            low = max(x1 - 16 * word, 0)
+            high = min(x2 - 16 * word, 15)
+            self._set_bits(row + word, ((1 << (high + 1)) - 1) & ~((1 << low) - 1))
+
+    def screen_drawPixel(self, x: int, y: int) -> int:
+        if not (0 <= x < 512 and 0 <= y < 256):
+            return self.sys_error(7)
+        self._set_bits(SCREEN + 32 * y + x // 16, 1 << (x % 16))
+        return 0
+
+    def screen_drawLine(self, x1: int, y1: int, x2: int, y2: int) -> int:
+        if not all(0 <= x < 512 for x in (x1, x2)) or not all(
+            0 <= y < 256 for y in (y1, y2)
+        ):
+            return self.sys_error(8)
+        if y1 == y2:
+            self._horizontal_line(min(x1, x2), max(x1, x2), y1)
+            return 0
+        dx, dy = abs(x2 - x1), -abs(y2 - y1)
+        sx, sy = (1 if x1 < x2 else -1), (1 if y1 < y2 else -1)
+        error = dx + dy
+        while True:
+            self._set_bits(SCREEN + 32 * y1 + x1 // 16, 1 << (x1 % 16))
+            if x1 == x2 and y1 == y2:
+                return 0
+            if 2 * error >= dy:
+                error += dy
+                x1 += sx
+            if 2 * error <= dx:
+                error += dx
+                y1 += sy
+
+    def screen_drawRectangle(self, x1: int, y1: int, x2: int, y2: int) -> int:
+        if not (0 <= x1 <= x2 < 512 and 0 <= y1 <= y2 < 256):
+            return self.sys_error(9)
+        for y in range(y1, y2 + 1):
+            self._horizontal_line(x1, x2, y)
+        return 0
+
+    def screen_drawCircle(self, x: int, y: int, r: int) -> int:
+        if not (0 <= x < 512 and 0 <= y < 256):
+            return self.sys_error(12)
+        if not (0 <= r <= 181 and r <= x < 512 - r and r <= y < 256 - r):
+            return self.sys_error(13)
+        for dy in range(-r, r + 1):
+            half = math.isqrt(r * r - dy * dy)
+            self._horizontal_line(x - half, x + half, y + dy)
+        return 0
+
+    def output_init(self) -> int:
+        self.row = 0
+        self.column = 0
+        return 0
+
+    def _draw_char(self, c: int):
+        glyph = self.font.get(c, self.font[0])
+        # like the OS, character cells start one pixel row down
+        address = SCREEN + 32 + self.row * CHAR_HEIGHT * 32 + self.column // 2
+        for i, bits in enumerate(glyph):
+            word = self.ram[address + 32 * i] & 0xFFFF
+            if self.column % 2:
+                word = (word & 0x00FF) | (bits << 8)
+            else:
+                word = (word & 0xFF00) | bits
+            self.ram[address + 32 * i] = to_word(word)
+
+    def output_moveCursor(self, row: int, column: int) -> int:
+        if not (0 <= row < SCREEN_ROWS and 0 <= column < SCREEN_COLUMNS):
+            return self.sys_error(20)
+        self.row = row
+        self.column = column
+        self._draw_char(32)
+        return 0
+
+    def output_printChar(self, c: int) -> int:
+        if c == NEWLINE:
+            return self.output_println()
+        if c == BACKSPACE:
+            return self.output_backSpace()
+        self._draw_char(c)
+        self.console.append(chr(c))
+        self.column += 1
+        if self.column == SCREEN_COLUMNS:
+            self.output_println()
+        return 0
+
+    def output_printString(self, s: int) -> int:
+        for c in self.string_chars(s):
+            self.output_printChar(ord(c))
+        return 0
+
+    def output_printInt(self, i: int) -> int:
+        for c in str(i):
+            self.output_printChar(ord(c))
+        return 0
+
+    def output_println(self) -> int:
+        self.console.append("\n")
+        self.column = 0
+        self.row = (self.row + 1) % SCREEN_ROWS
+        return 0
+
+    def output_backSpace(self) -> int:
+        if self.console and self.console[-1] != "\n":
+            self.console.pop()
+        if self.column > 0:
+            self.column -= 1
+        elif self.row > 0:
+            self.row -= 1
+            self.column = SCREEN_COLUMNS - 1
+        self._draw_char(32)
+        return 0
+
+
+NativeFunction = Callable[..., int]
+
+# OS functions with native versions, Keyboard and Sys.init stay VM code
+native_classes = {
+    "Sys": ["halt", "error", "wait"],
+    "Memory": ["init", "peek", "poke", "alloc", "deAlloc"],
+    "Array": ["new", "dispose"],
+    "Math": ["init", "abs", "multiply", "divide", "min", "max", "sqrt"],
+    "String": [
+        "new",
+        "dispose",
+        "length",
+        "charAt",
+        "setCharAt",
+        "appendChar",
+        "eraseLastChar",
+        "intValue",
+        "setInt",
+        "newLine",
+        "backSpace",
+        "doubleQuote",
+    ],
+    "Screen": [
+        "init",
+        "clearScreen",
+        "setColor",
+        "drawPixel",
+        "drawLine",
+        "drawRectangle",
+        "drawCircle",
+    ],
+    "Output": [
+        "init",
+        "moveCursor",
+        "printChar",
+        "printString",
+        "printInt",
+        "println",
+        "backSpace",
+    ],
+}
+
+
+def bind_natives(native: NativeOS) -> dict[str, NativeFunction]:
+    return {
+        f"{cls}.{name}": getattr(native, f"{cls.lower()}_{name}")
+        for cls, names in native_classes.items()
+        for name in names
+    }
@@ -0,0 +1,55 @@
+import json
+import os
+from functools import cache
+
+from vmcode import Command, format_command, parse_vm
+
+# Superoptimized Hack code for common VM command sequences, as found by
+# VMSuperoptimizer.py. The table is JSON:
+#   {"version": PATTERN_TABLE_VERSION,
+#    "patterns": [{"vm": [commands], "hack": [instructions],
+#                  "uses": n, "template_words": n}, ...]}
+# Bump the version whenever the meaning of an entry changes.
+PATTERN_TABLE_VERSION = 1
+
+# the longest sequence a pattern can replace
+MAX_PATTERN_LENGTH = 4
+
+default_patterns_path = os.path.join(os.path.dirname(__file__), "vmpatterns.json")
+
+# VM commands -> the assembly replacing them, one instruction per line
+PatternTable = dict[tuple[Command, ...], str]
+
+
+def load_patterns(path: str = default_patterns_path) -> PatternTable:
+    with open(path, "r") as f:
+        table = json.load(f)
+    if table.get("version") != PATTERN_TABLE_VERSION:
+        raise ValueError(
+            f"Unsupported pattern table version {table.get('version')} in {path},"
+            " regenerate it with VMSuperoptimizer.py"
+        )
+    return {
+        tuple(parse_vm("\n".join(pattern["vm"]), path)): "".join(
+            f"{line}\n" for line in pattern["hack"]
+        )
+        for pattern in table["patterns"]
+    }
+
+
+# the table the translator uses for -O, none when it hasn't been generated
+@cache
+def default_patterns() -> PatternTable:
+    if not os.path.exists(default_patterns_path):
+        return {}
+    return load_patterns(default_patterns_path)
+
+
+def write_patterns(patterns: list[dict], path: str = default_patterns_path):
+    with open(path, "w") as w:
+        json.dump({"version": PATTERN_TABLE_VERSION, "patterns": patterns}, w, indent=1)
+        w.write("\n")
+
+
+def format_pattern(commands: tuple[Command, ...]) -> list[str]:
+    return [format_command(command) for command in commands]